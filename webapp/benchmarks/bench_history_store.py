@@ -0,0 +1,79 @@
+"""
+Benchmark: the memory-mapped history store at full study size.
+
+Writes a synthetic store (default 200 stations x 21 years of hours,
+~37M values), then measures opening it, the RSS that costs, taking
+station/time slices (views) and reading them, and streaming all of it as
+backtest blocks.
+
+Usage (from webapp/):
+    python benchmarks/bench_history_store.py [--stations 200] [--years 21] [--dir /tmp/ews-history]
+"""
+
+import argparse
+import os
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "ews.settings")
+
+import django  # noqa: E402
+
+django.setup()
+
+import numpy as np  # noqa: E402
+
+from dashboard import services  # noqa: E402
+from dashboard.history_store import HistoryStore  # noqa: E402
+
+
+def rss_mb():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * resource.getpagesize() / 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--stations", type=int, default=200)
+    parser.add_argument("--years", type=int, default=21)
+    parser.add_argument("--dir", default="/tmp/ews-history")
+    args = parser.parse_args()
+
+    ids = [str(60000 + i) for i in range(args.stations)]
+    hours = args.years * 8766
+    first_hour = 289272  # 2003-01-01
+    t0 = time.perf_counter()
+    store = HistoryStore.create(args.dir, ids, first_hour, hours)
+    rng = np.random.default_rng(1)
+    for row in range(len(ids)):
+        store.data[row] = rng.gamma(2.0, 5.0, hours).astype(np.float32)
+    store.close()
+    del store
+    print(f"write  : {len(ids)} x {hours} = {len(ids) * hours / 1e6:.1f}M values "
+          f"in {time.perf_counter() - t0:.1f}s")
+
+    before = rss_mb()
+    t0 = time.perf_counter()
+    store = services.load_history_store(args.dir)
+    print(f"open   : {(time.perf_counter() - t0) * 1e3:.2f} ms, RSS +{rss_mb() - before:.1f} MB")
+
+    t0 = time.perf_counter()
+    first, views = store.select(ids[:40], first_hour + 8766 * 10, first_hour + 8766 * 11)
+    took = time.perf_counter() - t0
+    shared = all(np.shares_memory(v, store.data) for v in views.values())
+    print(f"select : 40 stations x 1 year in {took * 1e6:.0f} us (views: {shared}), RSS +{rss_mb() - before:.1f} MB")
+
+    t0 = time.perf_counter()
+    total = sum(float(np.nanmean(v)) for v in views.values())
+    print(f"read   : touched in {(time.perf_counter() - t0) * 1e3:.1f} ms (mean {total / 40:.2f}), "
+          f"RSS +{rss_mb() - before:.1f} MB")
+
+    t0 = time.perf_counter()
+    n = sum(len(block) for _, block in store.blocks(ids))
+    print(f"blocks : {n} hours streamed in {time.perf_counter() - t0:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
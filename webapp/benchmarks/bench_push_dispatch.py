@@ -0,0 +1,113 @@
+"""
+Benchmark: APNs fan-out, old one-at-a-time sending vs APNsDispatcher.
+
+Uses httpx.MockTransport as a fake APNs that answers after a fixed
+latency (standing in for the network round trip) and reports every
+--invalid-every'th token as unregistered (410). The old path is
+replayed as it was: a new client and a freshly signed JWT per device,
+one request at a time.
+
+To try a real HTTP/2 server instead, set APNS_HOST to its URL and
+pass --live (uses the APNS_* key settings).
+
+Usage (from webapp/):
+    python benchmarks/bench_push_dispatch.py [--devices 5000] [--latency-ms 20]
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "ews.settings")
+
+import django  # noqa: E402
+
+django.setup()
+
+import httpx  # noqa: E402
+import jwt  # noqa: E402
+from cryptography.hazmat.primitives import serialization  # noqa: E402
+from cryptography.hazmat.primitives.asymmetric import ec  # noqa: E402
+
+from dashboard import push  # noqa: E402
+
+
+def make_key():
+    key = ec.generate_private_key(ec.SECP256R1())
+    return key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    ).decode()
+
+
+def mock_apns(latency, invalid_every):
+    def handler(request):
+        time.sleep(latency)
+        token = request.url.path.rsplit("/", 1)[-1]
+        if invalid_every and int(token, 16) % invalid_every == 0:
+            return httpx.Response(410, json={"reason": "Unregistered"})
+        return httpx.Response(200)
+    return httpx.MockTransport(handler)
+
+
+def old_send_all(tokens, payload, transport, key):
+    """The previous implementation: new client and JWT for every device."""
+    sent = failed = 0
+    for token in tokens:
+        auth = jwt.encode({"iss": "TEAM", "iat": int(time.time())}, key,
+                          algorithm="ES256", headers={"alg": "ES256", "kid": "KEY"})
+        with httpx.Client(transport=transport) as client:
+            response = client.post(
+                f"{push.APNS_HOST_PROD}/3/device/{token}",
+                headers={"authorization": f"bearer {auth}", "apns-topic": push.APNS_BUNDLE_ID},
+                json=payload,
+                timeout=10.0,
+            )
+        if response.status_code == 200:
+            sent += 1
+        else:
+            failed += 1
+    return sent, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--devices", type=int, default=5000)
+    parser.add_argument("--old-devices", type=int, default=200, help="devices for the (slow) old path")
+    parser.add_argument("--latency-ms", type=float, default=20.0)
+    parser.add_argument("--in-flight", type=int, default=push.MAX_IN_FLIGHT)
+    parser.add_argument("--invalid-every", type=int, default=50)
+    parser.add_argument("--live", action="store_true", help="send to APNS_HOST instead of the mock")
+    args = parser.parse_args()
+
+    tokens = [f"{i:064x}" for i in range(1, args.devices + 1)]
+    payload = {"aps": {"alert": {"title": "Air Quality Alert: Toronto", "body": "HIGH"}, "sound": "default"}}
+    latency = args.latency_ms / 1000
+
+    if args.live:
+        dispatcher = push.APNsDispatcher(max_in_flight=args.in_flight)
+    else:
+        key = make_key()
+        transport = mock_apns(latency, args.invalid_every)
+        old_tokens = tokens[:args.old_devices]
+        t0 = time.perf_counter()
+        sent, failed = old_send_all(old_tokens, payload, transport, key)
+        old_rate = len(old_tokens) / (time.perf_counter() - t0)
+        print(f"old (sequential)  : {sent} sent, {failed} failed, {old_rate:8.0f}/s "
+              f"-> {args.devices / old_rate:8.1f}s for {args.devices} devices")
+        dispatcher = push.APNsDispatcher(
+            transport=transport, max_in_flight=args.in_flight,
+            key_content=key, key_id="KEY", team_id="TEAM",
+        )
+
+    result = dispatcher.send_many(tokens, json.dumps(payload).encode())
+    dispatcher.close()
+    print(f"dispatcher (x{args.in_flight:<4d}): {result}  invalid={len(result.invalid_tokens)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""
+Benchmark: RateLimitMiddleware's check, old vs new.
+
+The old limiter kept a list of request timestamps per client in the cache
+(get, filter, append, set, then another get for the headers). The new one
+is a sliding window counter: one cache.incr per request.
+
+Measures time per check for one busy client and for many clients, the
+per-client cache state size, and how many requests get through when
+threads hit the same client concurrently (the old get/set loses updates).
+Runs against the configured cache (LocMemCache unless REDIS_URL is set).
+
+Usage (from webapp/):
+    python benchmarks/bench_rate_limiter.py [--limit 1000] [--requests 20000]
+"""
+
+import argparse
+import os
+import pickle
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "ews.settings")
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.conf import settings  # noqa: E402
+from django.core.cache import cache  # noqa: E402
+
+from dashboard.middleware import RateLimitMiddleware  # noqa: E402
+
+
+class LegacyRateLimiter:
+    """The previous timestamp-list implementation (check + _get_remaining)."""
+
+    def __init__(self, limit, window):
+        self.limit, self.window = limit, window
+
+    def check(self, client_id):
+        cache_key = f"legacy:{client_id}"
+        now = time.time()
+        timestamps = cache.get(cache_key, [])
+        cutoff = now - self.window
+        timestamps = [ts for ts in timestamps if ts > cutoff]
+        if len(timestamps) >= self.limit:
+            return False
+        timestamps.append(now)
+        cache.set(cache_key, timestamps, timeout=self.window + 10)
+        # _get_remaining: second read for the headers
+        timestamps = cache.get(cache_key, [])
+        len([ts for ts in timestamps if ts > time.time() - self.window])
+        return True
+
+
+class CounterRateLimiter:
+    def __init__(self, limit, window):
+        self.middleware = RateLimitMiddleware(lambda request: None)
+        self.middleware.DEFAULT_LIMITS = {"default": (limit, window)}
+
+    def check(self, client_id):
+        return self.middleware._check_rate_limit(client_id, "default")[0]
+
+
+def time_checks(limiter, clients, requests):
+    t0 = time.perf_counter()
+    for i in range(requests):
+        limiter.check(clients[i % len(clients)])
+    return (time.perf_counter() - t0) / requests
+
+
+def concurrent_allowed(limiter, client_id, threads, per_thread):
+    allowed = []
+    lock = threading.Lock()
+
+    def worker():
+        n = sum(1 for _ in range(per_thread) if limiter.check(client_id))
+        with lock:
+            allowed.append(n)
+
+    pool = [threading.Thread(target=worker) for _ in range(threads)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    return sum(allowed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--limit", type=int, default=1000, help="requests per window")
+    parser.add_argument("--window", type=int, default=60)
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--clients", type=int, default=500)
+    parser.add_argument("--threads", type=int, default=8)
+    args = parser.parse_args()
+
+    limiters = {
+        "timestamp list": lambda: LegacyRateLimiter(args.limit, args.window),
+        "window counter": lambda: CounterRateLimiter(args.limit, args.window),
+    }
+
+    backend = settings.CACHES["default"]["BACKEND"].rsplit(".", 1)[-1]
+    print(f"limit={args.limit}/{args.window}s requests={args.requests} cache={backend}")
+    for name, make in limiters.items():
+        cache.clear()
+        hot = time_checks(make(), ["hot"], args.requests)
+        cache.clear()
+        spread = time_checks(make(), [f"c{i}" for i in range(args.clients)], args.requests)
+        cache.clear()
+        allowed = concurrent_allowed(make(), "shared", args.threads, args.limit)
+        print(f"{name:15s}: {hot * 1e6:8.1f} us/check (1 client)  "
+              f"{spread * 1e6:8.1f} us/check ({args.clients} clients)  "
+              f"allowed {allowed}/{args.limit} under {args.threads} threads")
+
+    # Per-client state at the limit
+    legacy_state = [time.time()] * args.limit
+    print(f"state per client: timestamp list {len(pickle.dumps(legacy_state))} bytes, "
+          f"window counter {len(pickle.dumps(args.limit)) * 2} bytes")
+
+
+if __name__ == "__main__":
+    main()
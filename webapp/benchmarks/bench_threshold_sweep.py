@@ -0,0 +1,78 @@
+"""
+Benchmark: threshold sweep throughput against worker count.
+
+Builds a synthetic History (random hourly readings for every station
+with occasional smoke episodes at the target stations), then scores the
+same candidate grid with 1, 2, 4, ... worker processes and reports
+candidates per second and the speedup over one worker.
+
+Usage (from webapp/):
+    python benchmarks/bench_threshold_sweep.py [--hours 50000] [--candidates 2000]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "ews.settings")
+
+import django  # noqa: E402
+
+django.setup()
+
+import numpy as np  # noqa: E402
+
+from dashboard import backtest, services, sweep  # noqa: E402
+
+
+def synthetic_blocks(stations, hours, seed):
+    rng = np.random.default_rng(seed)
+    ids = backtest.History.station_ids(stations)
+    targets = [ids.index(city["naps_id"]) for city in services.CITIES.values()]
+    for start in range(0, hours, backtest.BLOCK_HOURS):
+        n = min(backtest.BLOCK_HOURS, hours - start)
+        block = rng.gamma(2.0, 5.0, (n, len(ids)))
+        block[rng.random(block.shape) < 0.2] = np.nan
+        # A few smoke episodes per block: high readings upwind, then in the cities
+        for onset in rng.integers(48, max(n - 48, 49), size=2):
+            block[onset - 24:onset, :] += rng.gamma(4.0, 12.0)
+            block[onset:onset + 24, targets] += 30.0
+        yield 400000 + start, block
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--hours", type=int, default=50000)
+    parser.add_argument("--candidates", type=int, default=2000)
+    parser.add_argument("--max-workers", type=int, default=os.cpu_count())
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    stations = services.load_all_stations()
+    t0 = time.perf_counter()
+    history = backtest.History.prepare(stations, synthetic_blocks(stations, args.hours, args.seed))
+    print(f"history: {len(history)} hours x {len(stations)} stations in {time.perf_counter() - t0:.1f}s")
+
+    values = {
+        "rule1": sweep.parse_values("20:80:2.5"),
+        "rule2_distant": sweep.parse_values("20:60:5"),
+        "rule2_intermediate": sweep.parse_values("10:40:5"),
+        "rule3": sweep.parse_values("20:80:5"),
+        "city_elevated": sweep.parse_values("15:30:5"),
+    }
+    candidates = sweep.candidates(values, samples=args.candidates, seed=args.seed)
+
+    workers, base = 1, None
+    while workers <= args.max_workers:
+        t0 = time.perf_counter()
+        sweep.run(history, candidates, workers=workers)
+        rate = len(candidates) / (time.perf_counter() - t0)
+        base = base or rate
+        print(f"workers {workers:3d}: {rate:8.1f} candidates/s  speedup {rate / base:5.2f}x")
+        workers *= 2
+
+
+if __name__ == "__main__":
+    main()
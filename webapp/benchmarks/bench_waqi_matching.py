@@ -0,0 +1,102 @@
+"""
+Benchmark: matching our stations to WAQI stations.
+
+Compares the old linear scan (every station against every WAQI entry)
+with services.WaqiIndex on a synthetic bbox response.
+
+Usage (from webapp/):
+    python benchmarks/bench_waqi_matching.py [--waqi 10000] [--repeat 5]
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "ews.settings")
+
+import django  # noqa: E402
+
+django.setup()
+
+from dashboard import services  # noqa: E402
+
+
+def linear_match(stations, waqi_stations):
+    readings = {}
+    for st in stations:
+        best_dist = services.MATCH_RADIUS_KM
+        best_pm = None
+        for ws in waqi_stations:
+            d = services._haversine(st["lat"], st["lon"], ws["lat"], ws["lon"])
+            if d < best_dist:
+                best_dist = d
+                best_pm = ws["pm25"]
+        if best_pm is not None:
+            readings[st["id"]] = best_pm
+    return readings
+
+
+def index_match(stations, waqi_stations):
+    readings = {}
+    index = services.WaqiIndex(waqi_stations)
+    for st in stations:
+        ws, _ = index.nearest(st["lat"], st["lon"])
+        if ws is not None:
+            readings[st["id"]] = ws["pm25"]
+    return readings
+
+
+def synthetic_waqi(stations, n, rng):
+    """n WAQI stations spread over the stations' bbox, some near our stations."""
+    lats = [s["lat"] for s in stations]
+    lons = [s["lon"] for s in stations]
+    result = []
+    for i in range(n):
+        if i % 4 == 0:
+            anchor = rng.choice(stations)
+            lat = anchor["lat"] + rng.uniform(-0.3, 0.3)
+            lon = anchor["lon"] + rng.uniform(-0.3, 0.3)
+        else:
+            lat = rng.uniform(min(lats) - 0.5, max(lats) + 0.5)
+            lon = rng.uniform(min(lons) - 0.5, max(lons) + 0.5)
+        result.append({"lat": lat, "lon": lon, "pm25": round(rng.uniform(0, 150), 1), "name": f"w{i}"})
+    return result
+
+
+def best_of(fn, repeat, *args):
+    best = float("inf")
+    out = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        out = fn(*args)
+        best = min(best, time.perf_counter() - t0)
+    return best, out
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--waqi", type=int, default=10000, help="WAQI stations in the response")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    stations = [s for s in services.load_all_stations() if s.get("lat") and s.get("lon")]
+    waqi = synthetic_waqi(stations, args.waqi, rng)
+
+    t_build, _ = best_of(services.WaqiIndex, args.repeat, waqi)
+    t_index, got = best_of(index_match, args.repeat, stations, waqi)
+    t_linear, expected = best_of(linear_match, args.repeat, stations, waqi)
+
+    assert got == expected, "index and linear scan disagree"
+    print(f"stations={len(stations)} waqi={len(waqi)} matched={len(got)}")
+    print(f"linear scan : {t_linear * 1000:9.2f} ms")
+    print(f"grid index  : {t_index * 1000:9.2f} ms (build {t_build * 1000:.2f} ms)")
+    print(f"speedup     : {t_linear / t_index:9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
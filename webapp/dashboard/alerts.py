@@ -0,0 +1,91 @@
+"""
+City alert transitions.
+
+Each refresh recomputes city_alerts from scratch. This module compares the
+new level of each city (LOW when there is no alert) with the level stored
+in CityAlertState and emits an AlertEvent only for real transitions, so
+notifications go out once per change instead of once per refresh:
+
+  - escalation:    the level rises above the last announced level. This
+                   starts an event (event_started_at, peak_level) that
+                   lasts EVENT_COOLDOWN_HOURS.
+  - de-escalation: the level falls below the last announced level
+                   (to LOW means the alert is over).
+
+While an event lasts, only a rise above its peak_level is announced:
+de-escalations and returns to a level already reached stay quiet, so a
+city flapping around a level boundary sends at most one push per level
+per event. A city still below its announced level when the event ends
+gets its de-escalation then.
+"""
+
+import datetime
+from collections import namedtuple
+
+from . import services
+from .models import CityAlertState
+
+LEVEL_NAMES = [lvl["name"] for lvl in services.ALERT_LEVELS]
+LEVEL_RANK = {name: i for i, name in enumerate(LEVEL_NAMES)}
+EVENT_COOLDOWN = datetime.timedelta(hours=services.EVENT_COOLDOWN_HOURS)
+
+ESCALATION = "escalation"
+DE_ESCALATION = "de-escalation"
+
+# One transition of a city's alert level: from the last announced level to
+# the new one. `alert` is the new city_alerts entry.
+AlertEvent = namedtuple("AlertEvent", ["city", "kind", "from_level", "to_level", "at", "alert"])
+
+
+def advance(state, level, now):
+    """Move `state` to `level`; return the event kind or None.
+
+    Updates the CityAlertState instance in place (not saved).
+    """
+    rank = LEVEL_RANK[level]
+    kind = None
+    in_event = state.event_started_at is not None and now - state.event_started_at < EVENT_COOLDOWN
+    if in_event:
+        if rank > LEVEL_RANK[state.peak_level]:
+            state.peak_level = level
+            kind = ESCALATION
+    elif rank > LEVEL_RANK[state.announced_level]:
+        state.event_started_at = now
+        state.peak_level = level
+        kind = ESCALATION
+    elif rank < LEVEL_RANK[state.announced_level]:
+        kind = DE_ESCALATION
+
+    if kind is not None:
+        state.announced_level = level
+    state.level = level
+    return kind
+
+
+def detect_transitions(city_alerts, now):
+    """Advance every city's state to `city_alerts` and return the events.
+
+    Reads and writes the states in one query each; call inside the refresh
+    transaction so concurrent refreshes can't both announce a change.
+    """
+    states = {
+        s.city: s for s in CityAlertState.objects.select_for_update().filter(city__in=list(city_alerts))
+    }
+    events = []
+    for city, alert in city_alerts.items():
+        level = alert.get("level_name", LEVEL_NAMES[0]) if alert.get("alert") else LEVEL_NAMES[0]
+        state = states.get(city) or CityAlertState(city=city)
+        states[city] = state
+        previous = state.announced_level
+        kind = advance(state, level, now)
+        if kind is not None:
+            events.append(AlertEvent(city, kind, previous, level, now, alert))
+
+    if states:
+        CityAlertState.objects.bulk_create(
+            list(states.values()),
+            update_conflicts=True,
+            unique_fields=["city"],
+            update_fields=["level", "announced_level", "peak_level", "event_started_at", "updated_at"],
+        )
+    return events
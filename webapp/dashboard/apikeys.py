@@ -0,0 +1,186 @@
+"""
+API key authentication and per-key rate limiting for /api/v1/*.
+
+With a shared cache (REDIS_URL set) the database stays out of the
+request path:
+  - Key lookups are cached in-process for LOCAL_TTL seconds and in the
+    shared cache for SHARED_TTL seconds (unknown/revoked keys too, so
+    bad keys don't hit the database either). Saving or deleting an
+    APIKey (revocation, account deletion) deletes the shared entry via a
+    signal in models.py; other processes drop it within LOCAL_TTL.
+  - Requests are counted per key and clock hour with an atomic cache
+    increment, so concurrent requests can't race on the count.
+  - last_used is kept in the cache too. flush() copies it and the hourly
+    count back to APIKey; it runs from the refresh cron/worker, never
+    inside an API request.
+
+Without one, each process would have its own cache: a revoked key would
+keep working on other instances and every instance would allow the full
+limit. So the fallback is the database: one lookup and one conditional
+UPDATE per request, counting in APIKey.requests_this_hour.
+"""
+
+import datetime
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F
+from django.utils import timezone
+
+from .models import APIKey
+
+WINDOW = 3600         # Rate limit window: one clock hour (limit is APIKey.RATE_LIMIT)
+
+LOCAL_TTL = 10        # In-process key lookup cache (bounds revocation delay)
+SHARED_TTL = 300      # Shared cache key lookup
+LOCAL_MAX = 10000     # Entries before the in-process cache is cleared
+
+KEY_CACHE = "apikey:{}"             # sha256(key) -> APIKey id (0 = no active key)
+COUNT_KEY = "apikey:count:{}:{}"    # (APIKey id, hour start epoch) -> requests
+USED_KEY = "apikey:used:{}"         # APIKey id -> last request epoch
+
+_local = {}           # key -> (expires monotonic, APIKey id or 0)
+_local_lock = threading.Lock()
+
+
+def shared_cache():
+    """True when the cache is shared by every process (Redis)."""
+    return bool(getattr(settings, "REDIS_URL", None))
+
+
+def _cache_key(key):
+    # Hash so raw keys never appear as cache key names
+    return KEY_CACHE.format(hashlib.sha256(key.encode()).hexdigest())
+
+
+def _db_lookup(key):
+    return APIKey.objects.filter(key=key, is_active=True).values_list("id", flat=True).first()
+
+
+def lookup(key):
+    """Return the id of the active APIKey `key`, or None."""
+    if not shared_cache():
+        return _db_lookup(key)
+
+    now = time.monotonic()
+    entry = _local.get(key)
+    if entry is not None and entry[0] > now:
+        return entry[1] or None
+
+    key_id = cache.get(_cache_key(key))
+    if key_id is None:
+        key_id = _db_lookup(key) or 0
+        cache.set(_cache_key(key), key_id, SHARED_TTL)
+
+    with _local_lock:
+        if len(_local) >= LOCAL_MAX:
+            _local.clear()
+        _local[key] = (now + LOCAL_TTL, key_id)
+    return key_id or None
+
+
+def invalidate(key):
+    """Forget a key's cached lookup (called by the APIKey save/delete signals)."""
+    cache.delete(_cache_key(key))
+    with _local_lock:
+        _local.pop(key, None)
+
+
+def _hour_start(now):
+    return int(now) - int(now) % WINDOW
+
+
+def _as_datetime(epoch):
+    return datetime.datetime.fromtimestamp(epoch, tz=datetime.timezone.utc)
+
+
+def usage_many(key_ids, now=None):
+    """{key_id: (requests this hour, last_used)} for several keys at once."""
+    hour = _hour_start(time.time() if now is None else now)
+    if not shared_cache():
+        rows = APIKey.objects.filter(id__in=key_ids).values_list(
+            "id", "requests_this_hour", "hour_started", "last_used")
+        usage = {key_id: (0, None) for key_id in key_ids}
+        for key_id, count, started, last_used in rows:
+            usage[key_id] = (count if started == _as_datetime(hour) else 0, last_used)
+        return usage
+
+    counts = {COUNT_KEY.format(key_id, hour): key_id for key_id in key_ids}
+    used = {USED_KEY.format(key_id): key_id for key_id in key_ids}
+    values = cache.get_many(list(counts) + list(used))
+    last_used = {key_id: values[k] for k, key_id in used.items() if k in values}
+    return {
+        key_id: (values.get(k, 0), _as_datetime(last_used[key_id]) if key_id in last_used else None)
+        for k, key_id in counts.items()
+    }
+
+
+def reset_seconds(now=None):
+    now = time.time() if now is None else now
+    return WINDOW - int(now) % WINDOW
+
+
+def hit(key_id):
+    """Count one request. Returns (allowed, remaining, reset_seconds)."""
+    now = time.time()
+    hour = _hour_start(now)
+    count = _count_cache(key_id, hour, now) if shared_cache() else _count_db(key_id, hour)
+
+    reset = reset_seconds(now)
+    if count > APIKey.RATE_LIMIT:
+        return False, 0, reset
+    return True, APIKey.RATE_LIMIT - count, reset
+
+
+def _count_cache(key_id, hour, now):
+    counter = COUNT_KEY.format(key_id, hour)
+    cache.add(counter, 0, WINDOW + 60)
+    try:
+        count = cache.incr(counter)
+    except ValueError:
+        # Evicted between add and incr: start over
+        cache.set(counter, 1, WINDOW + 60)
+        count = 1
+    if count <= APIKey.RATE_LIMIT:
+        cache.set(USED_KEY.format(key_id), int(now), None)
+    return count
+
+
+def _count_db(key_id, hour):
+    # Each UPDATE is atomic, so concurrent requests on any instance can't
+    # exceed the limit: count within the current hour while under the
+    # limit, or start a new hour. A concurrent request may start the hour
+    # first, hence the second try.
+    started = _as_datetime(hour)
+    keys = APIKey.objects.filter(id=key_id)
+    for _ in range(2):
+        if keys.filter(hour_started=started, requests_this_hour__lt=APIKey.RATE_LIMIT).update(
+                requests_this_hour=F("requests_this_hour") + 1, last_used=timezone.now()):
+            return keys.values_list("requests_this_hour", flat=True).first()
+        if keys.exclude(hour_started=started).update(
+                hour_started=started, requests_this_hour=1, last_used=timezone.now()):
+            return 1
+    return APIKey.RATE_LIMIT + 1
+
+
+def flush():
+    """Copy cached last_used / hourly counts to APIKey in one bulk update.
+
+    Only needed with a shared cache (the database fallback writes as it
+    counts). Called from the refresh cron endpoint and worker.
+    """
+    if not shared_cache():
+        return 0
+
+    key_ids = list(APIKey.objects.filter(is_active=True).values_list("id", flat=True))
+    hour = _hour_start(time.time())
+    rows = [
+        APIKey(id=key_id, last_used=last_used, requests_this_hour=count, hour_started=_as_datetime(hour))
+        for key_id, (count, last_used) in usage_many(key_ids).items()
+        if last_used is not None
+    ]
+    APIKey.objects.bulk_update(rows, ["last_used", "requests_this_hour", "hour_started"])
+    return len(rows)
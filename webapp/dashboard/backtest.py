@@ -0,0 +1,251 @@
+"""
+Historical backtest of the three-rule detector.
+
+Replays hourly PM2.5 history in time order and scores the alerts the
+detector would have issued against what each target city then measured
+(its NAPS station, services.CITIES[...]["naps_id"]):
+
+  - warning:      the first hour the rules fire (engine.rules_fired) while
+                  no warning is open and the city is not inside an event.
+  - event:        an hour the city reading reaches CITY_ELEVATED_THRESHOLD,
+                  at least EVENT_COOLDOWN_HOURS after the previous event
+                  started. Alerts within the cooldown belong to that event.
+  - detected:     an event that starts within EVALUATION_WINDOW_HOURS of an
+                  open warning (lead time = event start - warning start).
+  - false alarm:  a warning whose window passes without an event. Windows
+                  with no city readings at all are counted as unverified.
+  - Rule 2 fires when an intermediate confirmation follows a distant
+    trigger within CONFIRMATION_WINDOW_HOURS.
+
+The regression workbooks only hold per-station summaries, so the hourly
+history comes from ReadingHistory (live refreshes and bulk-loaded
+archives) as blocks of a [hours, stations] matrix. The station readings
+are reduced block by block to a few threshold-independent numbers per
+hour and city (engine.city_features), so memory depends on the number of
+hours, not on the number of rows, and one prepared History can be scored
+against any number of threshold sets.
+"""
+
+import numpy as np
+
+from . import engine, services
+from .models import ReadingHistory
+
+BLOCK_HOURS = 24 * 30   # Hours per streamed block
+DAILY_HOLD_HOURS = 23   # A daily mean (EPA "Daily" stations) stands for its whole day
+CHUNK_SIZE = 20000      # Rows per database fetch
+
+
+def history_blocks(station_ids, start=None, end=None, block_hours=BLOCK_HOURS):
+    """Yield (first_hour, block) from ReadingHistory in time order.
+
+    Hours are counted from the Unix epoch; block is a [block_hours,
+    len(station_ids)] float array with NaN where there is no reading.
+    Every hour from the first reading to the last is covered, so block
+    rows are consecutive hours (the last block ends at the last reading).
+    Daily WAQI rollups are skipped.
+    """
+    column = {sid: i for i, sid in enumerate(station_ids)}
+    rows = ReadingHistory.objects.filter(station__in=list(column)).exclude(
+        source=ReadingHistory.SOURCE_WAQI_DAILY
+    )
+    if start is not None:
+        rows = rows.filter(observed_at__gte=start)
+    if end is not None:
+        rows = rows.filter(observed_at__lt=end)
+    rows = rows.order_by("observed_at").values_list("observed_at", "station", "pm25")
+
+    first = block = hour = None
+    for observed_at, station, pm25 in rows.iterator(chunk_size=CHUNK_SIZE):
+        hour = int(observed_at.timestamp()) // 3600
+        if block is None:
+            first = hour
+            block = np.full((block_hours, len(column)), np.nan)
+        while hour >= first + block_hours:
+            yield first, block
+            first += block_hours
+            block = np.full((block_hours, len(column)), np.nan)
+        block[hour - first, column[station]] = pm25
+    if block is not None:
+        yield first, block[:hour - first + 1]
+
+
+def months_of(first_hour, n):
+    """Calendar month (1-12) of each of n hours from first_hour."""
+    hours = np.arange(first_hour, first_hour + n).astype("datetime64[h]")
+    return hours.astype("datetime64[M]").astype(np.int64) % 12 + 1
+
+
+def _hold(values, hold, carry):
+    """Forward-fill each column of `values` for up to hold[column] hours.
+
+    `carry` holds the preceding (unfilled) rows so fills continue across
+    blocks; returns the filled rows of `values` only.
+    """
+    stacked = np.vstack([carry, values])
+    index = np.arange(len(stacked))[:, None]
+    last = np.maximum.accumulate(np.where(np.isnan(stacked), -1, index), axis=0)
+    ok = (last >= 0) & (index - last <= hold)
+    filled = np.where(ok, stacked[np.maximum(last, 0), np.arange(stacked.shape[1])], np.nan)
+    return filled[len(carry):]
+
+
+class History:
+    """Threshold-independent backtest inputs: one row per hour, one column per city.
+
+    Build with History.prepare(); score with score().
+    """
+
+    def __init__(self, city_names, first_hour, features, city_pm):
+        self.city_names = city_names
+        self.first_hour = first_hour
+        self.features = features    # engine.CityFeatures of [hours, cities] arrays
+        self.city_pm = city_pm      # Target city readings (NaN where missing)
+        self.distant_window = None  # features.distant maxed over the Rule 2 window
+        self.confirmation_hours = None
+        # Hours with a city reading before each hour: checks windows in O(1)
+        self.city_data = np.vstack([
+            np.zeros((1, len(city_names)), dtype=np.int64),
+            np.cumsum(~np.isnan(city_pm), axis=0),
+        ])
+
+    def __len__(self):
+        return len(self.city_pm)
+
+    @classmethod
+    def prepare(cls, stations, blocks=None, months=None,
+                confirmation_hours=services.CONFIRMATION_WINDOW_HOURS):
+        """Reduce streamed history to per-hour city features.
+
+        blocks: iterable of (first_hour, [hours, ids] array) in time order,
+        where ids = History.station_ids(stations); defaults to
+        history_blocks() over all of ReadingHistory. months: optional set
+        of months (1-12) to keep, e.g. the May-September fire season.
+        """
+        table = services.station_table(stations)
+        ids = cls.station_ids(stations)
+        column = {sid: i for i, sid in enumerate(ids)}
+        table_cols = np.array([column[sid] for sid in table.ids], dtype=np.int64)
+        city_cols = np.array(
+            [column[services.CITIES[name]["naps_id"]] for name in table.city_names], dtype=np.int64)
+        hold = np.array(
+            [DAILY_HOLD_HOURS if str(st.get("data_type", "")).lower() == "daily" else 0
+             for st in stations], dtype=np.int64)
+
+        if blocks is None:
+            blocks = history_blocks(ids)
+        parts, city_parts = [], []
+        first_hour = next_hour = None
+        carry = np.empty((0, len(table)))
+        last_row = np.full(len(table), np.nan)
+        for start, block in blocks:
+            if first_hour is None:
+                first_hour = next_hour = start
+            if start != next_hour:
+                raise ValueError(f"blocks must be consecutive (expected hour {next_hour}, got {start})")
+            next_hour = start + len(block)
+            if months is not None:
+                block = np.where(np.isin(months_of(start, len(block)), list(months))[:, None], block, np.nan)
+
+            raw = block[:, table_cols]
+            pm = _hold(raw, hold, carry)
+            carry = raw[-DAILY_HOLD_HOURS:]
+            prev = np.vstack([last_row[None, :], pm[:-1]])
+            last_row = pm[-1]
+
+            parts.append(engine.city_features(table, pm, prev, services.LEVEL_MINS))
+            city_parts.append(block[:, city_cols])
+
+        if first_hour is None:
+            n_cities = len(table.city_names)
+            empty = np.empty((0, n_cities))
+            features = engine.CityFeatures(empty, empty, empty, empty, empty.astype(np.int64))
+            history = cls(table.city_names, 0, features, empty)
+        else:
+            features = engine.CityFeatures(*(np.concatenate(f) for f in zip(*parts)))
+            history = cls(table.city_names, first_hour, features, np.concatenate(city_parts))
+        history.set_confirmation_window(confirmation_hours)
+        return history
+
+    @staticmethod
+    def station_ids(stations):
+        """Columns of the history blocks: predictor stations, then target stations."""
+        targets = [city["naps_id"] for city in services.CITIES.values()]
+        return list(dict.fromkeys([st["id"] for st in stations] + targets))
+
+    def set_confirmation_window(self, hours):
+        """Let a distant trigger count for Rule 2 for `hours` hours."""
+        distant = self.features.distant
+        padded = np.vstack([np.full((max(hours, 1) - 1, distant.shape[1]), -np.inf), distant])
+        windows = np.lib.stride_tricks.sliding_window_view(padded, max(hours, 1), axis=0)
+        self.distant_window = windows.max(axis=-1)
+        self.confirmation_hours = hours
+
+
+def _score_city(fired, elevated, city_data, window, cooldown):
+    """Walk one city's alert and event hours in time order. Returns counts and lead times."""
+    n = len(fired)
+    counts = {"events": 0, "detected": 0, "warnings": 0, "false_alarms": 0, "unverified": 0}
+    leads = []
+    warning = last_event = None
+
+    def expire(start):
+        # A window with no city reading at all can't confirm or refute a warning
+        end = min(start + window + 1, n)
+        counts["false_alarms" if city_data[end] > city_data[start + 1] else "unverified"] += 1
+
+    for t in np.flatnonzero(fired | elevated).tolist():
+        if warning is not None and t - warning > window:
+            expire(warning)
+            warning = None
+        in_event = last_event is not None and t - last_event < cooldown
+        if fired[t] and warning is None and not in_event:
+            warning = t
+            counts["warnings"] += 1
+        if elevated[t] and not in_event:
+            counts["events"] += 1
+            last_event = t
+            if warning is not None:
+                counts["detected"] += 1
+                leads.append(t - warning)
+                warning = None
+    # A warning whose window runs past the data is left open (not scored)
+    if warning is not None and warning + window < n:
+        expire(warning)
+    return counts, leads
+
+
+def _summarize(counts, leads):
+    scored = counts["detected"] + counts["false_alarms"]
+    summary = dict(counts)
+    summary["missed"] = counts["events"] - counts["detected"]
+    summary["detection_rate"] = round(counts["detected"] / counts["events"], 4) if counts["events"] else None
+    # Share of scored warnings not followed by an event
+    summary["false_alarm_rate"] = round(counts["false_alarms"] / scored, 4) if scored else None
+    summary["lead_hours"] = {
+        "min": min(leads), "median": float(np.median(leads)),
+        "mean": round(float(np.mean(leads)), 1), "max": max(leads),
+    } if leads else None
+    return summary
+
+
+def score(history, thresholds=services.DEFAULT_THRESHOLDS,
+          city_threshold=services.CITY_ELEVATED_THRESHOLD,
+          evaluation_hours=services.EVALUATION_WINDOW_HOURS,
+          cooldown_hours=services.EVENT_COOLDOWN_HOURS):
+    """Score one threshold set over a prepared History.
+
+    thresholds: engine.Thresholds; its fields and city_threshold may be
+    per-city arrays ordered like history.city_names. Returns
+    {city: summary dict}.
+    """
+    fired = engine.rules_fired(history.features, thresholds, distant=history.distant_window)
+    with np.errstate(invalid="ignore"):
+        elevated = history.city_pm >= np.asarray(city_threshold, dtype=np.float64)
+
+    results = {}
+    for c, city in enumerate(history.city_names):
+        counts, leads = _score_city(
+            fired[:, c], elevated[:, c], history.city_data[:, c], evaluation_hours, cooldown_hours)
+        results[city] = _summarize(counts, leads)
+    return results
@@ -0,0 +1,279 @@
+"""
+Array-backed evaluation engine for the three-rule detector.
+
+Station metadata is held as NumPy columns (slope, intercept, R, tier,
+distance, target-city index) so predictions, alert levels, R²-weighted
+city means and rule triggers are computed with a handful of vectorized
+operations instead of per-station Python loops.
+
+This module has no Django or services dependency: thresholds and alert
+level boundaries are passed in by the caller (see services.evaluate).
+"""
+
+from collections import namedtuple
+
+import numpy as np
+
+
+# Rule thresholds in µg/m³. Each field may be a scalar or an array with one
+# entry per city in StationTable.city_names (for per-city tuning).
+Thresholds = namedtuple("Thresholds", [
+    "rule1",               # Regional station trigger
+    "rule2_distant",       # Distant (600+ km) station trigger
+    "rule2_intermediate",  # Intermediate (200-600 km) confirmation
+    "rule3",               # Corridor station trigger
+])
+
+RULE_NONE, RULE1, RULE2, RULE3 = 0, 1, 2, 3
+RULE_NAMES = {RULE1: "rule1", RULE2: "rule2", RULE3: "rule3"}
+
+# Threshold-independent rule inputs for a block of hours, as [hours, cities]
+# arrays (see city_features). Category maxima are -inf where a city has no
+# reading in that category.
+CityFeatures = namedtuple("CityFeatures", [
+    "regional",    # Highest regional station reading (Rule 1)
+    "distant",     # Highest distant station reading (Rule 2 trigger)
+    "sustained",   # Highest min(reading, previous hour) of intermediate stations (Rule 2)
+    "corridor",    # Highest corridor station reading (Rule 3)
+    "city_level",  # Alert level index of the R²-weighted city prediction
+])
+
+
+class StationTable:
+    """Column-oriented, read-only view of a station list."""
+
+    def __init__(self, stations, lead_fn=None):
+        self.stations = stations
+        self.ids = [st["id"] for st in stations]
+        self.slope = np.array([st["slope"] for st in stations], dtype=np.float64)
+        self.intercept = np.array([st["intercept"] for st in stations], dtype=np.float64)
+        self.R = np.array([st["R"] for st in stations], dtype=np.float64)
+        self.tier = np.array([st["tier"] for st in stations], dtype=np.int64)
+        self.dist = np.array([st["distance"] for st in stations], dtype=np.float64)
+
+        # Target cities in first-seen order; city_idx maps each row to one
+        labels = [st.get("target_city", "") for st in stations]
+        self.city_names = list(dict.fromkeys(labels))
+        lookup = {name: i for i, name in enumerate(self.city_names)}
+        self.city_idx = np.array([lookup[c] for c in labels], dtype=np.int64)
+
+        # R² weight, floored at 0.1 so every station counts somewhat
+        self.weight = np.maximum(self.R * self.R, 0.1)
+
+        # Static station categories used by the three rules
+        self.regional = (self.tier == 1) & (self.dist <= 600)
+        self.distant = self.dist > 600
+        self.intermediate = (self.dist >= 200) & (self.dist <= 600)
+        self.corridor = (self.tier >= 2) & (self.dist <= 400)
+
+        self.lead = [lead_fn(st["tier"], st["distance"]) for st in stations] if lead_fn else None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def gather(self, values):
+        """Align a {station_id: value} dict to table rows (NaN where absent)."""
+        return np.fromiter(
+            (values.get(sid, np.nan) for sid in self.ids),
+            dtype=np.float64, count=len(self.ids),
+        )
+
+
+class Evaluation:
+    """Result of evaluate_arrays.
+
+    Station arrays are ordered by predicted PM2.5 descending (ties keep
+    table order) and contain only rows that had a reading:
+      rows       - table row index
+      predicted  - prediction rounded to 0.1 µg/m³
+      level      - alert level index (from the unrounded prediction)
+
+    City arrays are indexed like StationTable.city_names:
+      count, weighted, max_predicted, rule, trigger_a, trigger_b, city_level, alert
+    trigger_a/trigger_b are table rows of the triggering stations (-1 if none).
+    city_order lists city indexes in order of their highest-ranked station.
+    """
+
+    __slots__ = (
+        "rows", "predicted", "level", "city_order", "count", "weighted",
+        "max_predicted", "rule", "trigger_a", "trigger_b", "city_level", "alert",
+    )
+
+
+def level_index(values, level_mins):
+    """Map PM2.5 values to alert level indexes using sorted level minimums."""
+    idx = np.searchsorted(level_mins, values, side="right") - 1
+    return np.clip(idx, 0, len(level_mins) - 1)
+
+
+def _first_per_city(city, mask, n_cities):
+    """Position of the first True in `mask` for each city (-1 if none)."""
+    first = np.full(n_cities, -1, dtype=np.int64)
+    pos = np.flatnonzero(mask)
+    if pos.size:
+        cities, idx = np.unique(city[pos], return_index=True)
+        first[cities] = pos[idx]
+    return first
+
+
+def _take(values, pos, fill):
+    """values[pos] where pos >= 0, `fill` elsewhere (safe for empty values)."""
+    if values.size == 0:
+        return np.full(pos.shape, fill, dtype=values.dtype)
+    return np.where(pos >= 0, values[np.maximum(pos, 0)], fill)
+
+
+def _per_city(value, city):
+    """Broadcast a scalar or per-city threshold array to station rows."""
+    value = np.asarray(value, dtype=np.float64)
+    return value if value.ndim == 0 else value[city]
+
+
+def evaluate_arrays(table, pm, prev, thresholds, level_mins):
+    """Run the three-rule detector over readings aligned to `table`.
+
+    pm, prev: float arrays of len(table) with NaN for stations without a
+    reading. Pass prev=None when there are no previous readings (Rule 2
+    is then skipped, as in services.evaluate).
+    """
+    n_cities = len(table.city_names)
+
+    rows = np.flatnonzero(~np.isnan(pm))
+    raw = table.slope[rows] * pm[rows] + table.intercept[rows]
+    # Python's round() is correctly rounded; np.round (x*10, rint, /10) can
+    # disagree on half-way values, which would change published numbers.
+    predicted = np.array([round(v, 1) for v in raw.tolist()], dtype=np.float64)
+    order = np.argsort(-predicted, kind="stable")
+    rows = rows[order]
+    predicted = predicted[order]
+    # Station levels use the unrounded prediction
+    level = level_index(raw[order], level_mins)
+
+    city = table.city_idx[rows]
+    pm_rows = pm[rows]
+
+    # R²-weighted mean per city (bincount sums in row order, like the loop)
+    weight = table.weight[rows]
+    weight_total = np.bincount(city, weights=weight, minlength=n_cities)
+    weighted_sum = np.bincount(city, weights=weight * predicted, minlength=n_cities)
+    count = np.bincount(city, minlength=n_cities)
+    weighted = np.divide(
+        weighted_sum, weight_total,
+        out=np.zeros(n_cities), where=weight_total > 0,
+    )
+
+    # Rows are sorted descending, so the first row per city is its maximum
+    first_any = _first_per_city(city, np.ones(rows.size, dtype=bool), n_cities)
+    max_predicted = _take(predicted, first_any, 0.0)
+
+    # Rule 1: regional station over trigger
+    r1 = _first_per_city(
+        city, table.regional[rows] & (pm_rows >= _per_city(thresholds.rule1, city)), n_cities)
+
+    # Rule 2: distant trigger + sustained intermediate confirmation
+    if prev is not None:
+        prev_rows = np.nan_to_num(prev[rows], nan=0.0)
+        inter_th = _per_city(thresholds.rule2_intermediate, city)
+        r2a = _first_per_city(
+            city, table.distant[rows] & (pm_rows >= _per_city(thresholds.rule2_distant, city)),
+            n_cities)
+        r2b = _first_per_city(
+            city, table.intermediate[rows] & (pm_rows >= inter_th) & (prev_rows >= inter_th),
+            n_cities)
+        r2 = (r2a >= 0) & (r2b >= 0)
+    else:
+        r2a = r2b = np.full(n_cities, -1, dtype=np.int64)
+        r2 = np.zeros(n_cities, dtype=bool)
+
+    # Rule 3: corridor station over trigger
+    r3 = _first_per_city(
+        city, table.corridor[rows] & (pm_rows >= _per_city(thresholds.rule3, city)), n_cities)
+
+    rule = np.select(
+        [r1 >= 0, r2, r3 >= 0], [RULE1, RULE2, RULE3], default=RULE_NONE)
+    trigger_a = np.select([rule == RULE1, rule == RULE2, rule == RULE3], [r1, r2a, r3], default=-1)
+    trigger_b = np.where(rule == RULE2, r2b, -1)
+    trigger_a = _take(rows, trigger_a, -1)
+    trigger_b = _take(rows, trigger_b, -1)
+
+    city_level = level_index(weighted, level_mins)
+
+    result = Evaluation()
+    result.rows = rows
+    result.predicted = predicted
+    result.level = level
+    present = np.flatnonzero(first_any >= 0)
+    result.city_order = present[np.argsort(first_any[present], kind="stable")]
+    result.count = count
+    result.weighted = weighted
+    result.max_predicted = max_predicted
+    result.rule = rule
+    result.trigger_a = trigger_a
+    result.trigger_b = trigger_b
+    result.city_level = city_level
+    # Only issue an alert if the weighted prediction is above LOW
+    result.alert = (rule != RULE_NONE) & (city_level > 0)
+    return result
+
+
+def _city_max(table, values, category):
+    """Per-city row maximum of values[:, category] (-inf where none)."""
+    out = np.full((values.shape[0], len(table.city_names)), -np.inf)
+    for c in range(len(table.city_names)):
+        cols = np.flatnonzero(category & (table.city_idx == c))
+        if cols.size:
+            out[:, c] = values[:, cols].max(axis=1)
+    return out
+
+
+def city_features(table, pm, prev, level_mins):
+    """Rule inputs per hour and city for a block of hours.
+
+    pm, prev: [hours, len(table)] arrays, NaN where there is no reading;
+    prev holds each row's previous hour. A rule fires for a set of
+    thresholds exactly when the matching maximum reaches its threshold,
+    so one pass over the readings serves any number of threshold sets
+    (see rules_fired). Predictions are rounded with np.round, which can
+    differ from evaluate_arrays on exact half-way values.
+    """
+    present = ~np.isnan(pm)
+    readings = np.where(present, pm, -np.inf)
+    sustained = np.minimum(readings, np.nan_to_num(prev, nan=0.0))
+
+    # R²-weighted mean prediction per city, as a matrix product
+    member = (table.city_idx[:, None] == np.arange(len(table.city_names))) * table.weight[:, None]
+    predicted = np.round(table.slope * np.where(present, pm, 0.0) + table.intercept, 1) * present
+    weight_total = present.astype(np.float64) @ member
+    weighted = np.divide(
+        predicted @ member, weight_total,
+        out=np.zeros_like(weight_total), where=weight_total > 0,
+    )
+
+    return CityFeatures(
+        regional=_city_max(table, readings, table.regional),
+        distant=_city_max(table, readings, table.distant),
+        sustained=_city_max(table, sustained, table.intermediate),
+        corridor=_city_max(table, readings, table.corridor),
+        city_level=level_index(weighted, level_mins),
+    )
+
+
+def rules_fired(features, thresholds, distant=None):
+    """[hours, cities] bool: would the detector alert for `thresholds`.
+
+    Threshold fields may be per-city arrays, as in evaluate_arrays.
+    `distant` replaces features.distant for the Rule 2 trigger, e.g. with
+    its maximum over a confirmation window.
+    """
+    distant = features.distant if distant is None else distant
+    rule2 = (
+        (distant >= np.asarray(thresholds.rule2_distant, dtype=np.float64))
+        & (features.sustained >= np.asarray(thresholds.rule2_intermediate, dtype=np.float64))
+    )
+    rule = (
+        (features.regional >= np.asarray(thresholds.rule1, dtype=np.float64))
+        | rule2
+        | (features.corridor >= np.asarray(thresholds.rule3, dtype=np.float64))
+    )
+    # Only alert if the weighted prediction is above LOW
+    return rule & (features.city_level > 0)
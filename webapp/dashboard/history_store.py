@@ -0,0 +1,162 @@
+"""
+Columnar, memory-mapped store for hourly PM2.5 history.
+
+A store is a directory with:
+  pm25-<stations>x<hours>-<build>.f32
+             - float32 matrix [stations, hours], station-major: each
+               station's series is one contiguous run of 4-byte values
+               (NaN = no reading)
+  meta.json  - format, station ids (row order), first hour, hour count and
+               the name of the data file
+Every build writes a new data file and then replaces meta.json, so the
+single rename of meta.json switches readers from one build to the next:
+a reader always maps the data file its meta.json names, with its shape.
+
+Hours are counted from the Unix epoch and the time axis is a dense grid
+(column i is first_hour + i), so the time index is the two numbers in
+meta.json. Opening a store only reads meta.json and maps the matrix; pages
+are read (and count towards RSS) when a slice is first touched, and
+slices are views into the mapping, not copies.
+
+Build one from ReadingHistory with `manage.py build_history_store`; open
+it with services.load_history_store().
+"""
+
+import datetime
+import json
+import os
+import time
+
+import numpy as np
+
+FORMAT = 1
+DATA_FILE = "pm25.f32"     # Data file of stores whose meta.json names none
+META_FILE = "meta.json"
+
+
+def to_hour(value):
+    """Epoch hour of a datetime (naive = UTC) or an int epoch hour."""
+    if value is None or isinstance(value, (int, np.integer)):
+        return value
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=datetime.timezone.utc)
+    return int(value.timestamp()) // 3600
+
+
+class HistoryStore:
+    """A store directory (see module docstring). Use open() or create()."""
+
+    def __init__(self, path, meta, data, pending=None):
+        self.path = path
+        self.meta = meta
+        self.station_ids = meta["stations"]
+        self.first_hour = meta["first_hour"]
+        self.hours = meta["hours"]
+        self.rows = {sid: i for i, sid in enumerate(self.station_ids)}
+        self.data = data
+        self._pending = pending   # Unpublished data file (create())
+
+    @classmethod
+    def open(cls, path):
+        """Map an existing store read-only."""
+        with open(os.path.join(path, META_FILE), "r") as f:
+            meta = json.load(f)
+        if meta.get("format") != FORMAT:
+            raise ValueError(f"Unsupported history store format: {meta.get('format')}")
+        data = np.memmap(
+            os.path.join(path, meta.get("data_file", DATA_FILE)), dtype=np.float32, mode="r",
+            shape=(len(meta["stations"]), meta["hours"]),
+        )
+        return cls(path, meta, data)
+
+    @classmethod
+    def create(cls, path, station_ids, first_hour, hours):
+        """Create an empty (all-NaN) store of `hours` >= 1 hours, replacing any store at `path`.
+
+        The new data file is written next to the old one and close()
+        publishes it by replacing meta.json; readers that already mapped
+        the old store keep it.
+        """
+        os.makedirs(path, exist_ok=True)
+        data_file = f"pm25-{len(station_ids)}x{hours}-{time.time_ns()}.f32"
+        data = np.memmap(
+            os.path.join(path, data_file), dtype=np.float32, mode="w+", shape=(len(station_ids), hours))
+        data[:] = np.nan
+        meta = {
+            "format": FORMAT,
+            "created_at": int(time.time()),
+            "stations": list(station_ids),
+            "first_hour": first_hour,
+            "hours": hours,
+            "data_file": data_file,
+        }
+        return cls(path, meta, data, pending=data_file)
+
+    def close(self):
+        """Flush writes; for a store from create(), publish it."""
+        self.data.flush()
+        if self._pending:
+            meta_path = os.path.join(self.path, META_FILE)
+            try:
+                with open(meta_path, "r") as f:
+                    previous = json.load(f).get("data_file", DATA_FILE)
+            except (FileNotFoundError, json.JSONDecodeError):
+                previous = None
+            tmp = meta_path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(self.meta, f)
+            os.replace(tmp, meta_path)
+            # Keep the previous build for readers that read its meta.json
+            # just before the switch; older and abandoned builds go
+            for name in os.listdir(self.path):
+                if name.startswith("pm25") and name.endswith(".f32") and name not in (self._pending, previous):
+                    os.remove(os.path.join(self.path, name))
+            self._pending = None
+
+    def __len__(self):
+        return self.hours
+
+    @property
+    def last_hour(self):
+        return self.first_hour + self.hours - 1
+
+    def _columns(self, start, end):
+        """Column range for [start, end) (datetimes or epoch hours, None = open)."""
+        lo = 0 if start is None else min(max(to_hour(start) - self.first_hour, 0), self.hours)
+        hi = self.hours if end is None else min(max(to_hour(end) - self.first_hour, lo), self.hours)
+        return lo, hi
+
+    def series(self, station_id, start=None, end=None):
+        """One station's readings for [start, end) as a view (None if unknown).
+
+        Returns (first_hour, float32 array).
+        """
+        row = self.rows.get(station_id)
+        lo, hi = self._columns(start, end)
+        return self.first_hour + lo, (None if row is None else self.data[row, lo:hi])
+
+    def select(self, station_ids=None, start=None, end=None):
+        """{station_id: view} for the known stations of a set, over [start, end).
+
+        Returns (first_hour, dict); every view covers the same hours.
+        """
+        lo, hi = self._columns(start, end)
+        ids = self.station_ids if station_ids is None else station_ids
+        return self.first_hour + lo, {
+            sid: self.data[self.rows[sid], lo:hi] for sid in ids if sid in self.rows
+        }
+
+    def blocks(self, station_ids, start=None, end=None, block_hours=24 * 30):
+        """Yield (first_hour, [hours, len(station_ids)] float64 block) in time order.
+
+        Same shape as backtest.history_blocks, so a store can replace the
+        database as the source of a backtest. Unknown stations are NaN.
+        """
+        lo, hi = self._columns(start, end)
+        rows = np.array([self.rows.get(sid, -1) for sid in station_ids], dtype=np.int64)
+        known = np.flatnonzero(rows >= 0)
+        for c0 in range(lo, hi, block_hours):
+            c1 = min(c0 + block_hours, hi)
+            block = np.full((c1 - c0, len(station_ids)), np.nan)
+            block[:, known] = self.data[rows[known], c0:c1].T
+            yield self.first_hour + c0, block
@@ -0,0 +1,327 @@
+"""
+Bulk ingestion of NAPS and U.S. EPA AQS PM2.5 archives into ReadingHistory.
+
+Reads CSV files, or CSV files inside zip archives, one row at a time and
+writes readings in large batches:
+  - PostgreSQL: COPY into a temporary table, then one INSERT ... SELECT
+    ... ON CONFLICT DO NOTHING per batch
+  - SQLite: executemany of INSERT ... ON CONFLICT DO NOTHING
+so memory stays at one batch whatever the archive size. Rows already
+stored (same station, hour and city) are skipped, so re-running is safe.
+
+Supported layouts, detected from each file's header row:
+  - NAPS hourly ("NAPS ID", "Date", "H01".."H24"; hours in local standard
+    time, converted to UTC from the province)
+  - EPA AQS hourly ("State Code", "Date GMT", "Time GMT", "Sample Measurement")
+  - EPA AQS daily ("State Code", "Date Local", "Arithmetic Mean"; stored at
+    00:00 UTC of the day, like the daily means the regressions used)
+
+Station ids are normalized to the form used in the regression workbooks:
+NAPS ids without leading zeros, EPA sites as state + county (3 digits) +
+site (4 digits), also without leading zeros. Readings are stored with
+city="" since they aren't tied to one target city.
+"""
+
+import csv
+import datetime
+import functools
+import io
+import itertools
+import json
+import os
+import zipfile
+
+from django.db import connection, transaction
+
+from .models import ReadingHistory
+
+SOURCE_NAPS = "naps"
+SOURCE_EPA = "epa"
+
+BATCH_SIZE = 50000
+MISSING = -999.0   # NAPS missing-value marker (anything at or below is skipped)
+
+# Hours to add to NAPS local standard time to get UTC
+PROVINCE_UTC_OFFSET = {
+    "NL": 3.5, "NS": 4, "NB": 4, "PE": 4, "QC": 5, "ON": 5, "NU": 5,
+    "MB": 6, "SK": 6, "AB": 7, "NT": 7, "YT": 8, "BC": 8,
+}
+
+# EPA parameter codes for PM2.5 mass (FRM/FEM and non-FRM)
+EPA_PM25_PARAMETERS = {"88101", "88502"}
+
+FIELDS = ("station", "city", "observed_at", "pm25", "source")
+
+
+def normalize_naps_id(value):
+    return str(int(value.strip()))
+
+
+def normalize_epa_id(state, county, site):
+    return str(int(state) * 10_000_000 + int(county) * 10_000 + int(site))
+
+
+def _col(header, *names):
+    """Index of the first column whose name contains one of `names` (case-insensitive)."""
+    lowered = [h.lower() for h in header]
+    for name in names:
+        for i, h in enumerate(lowered):
+            if name in h:
+                return i
+    return None
+
+
+def _parse_date(value):
+    value = value.strip()
+    if "-" in value:
+        return datetime.datetime.strptime(value[:10], "%Y-%m-%d")
+    return datetime.datetime.strptime(value[:8], "%Y%m%d")
+
+
+def _hour_str(dt):
+    # Naive UTC hour, as Django stores datetimes (the writer adds the offset for PostgreSQL)
+    return dt.isoformat(" ", "hours") + ":00:00"
+
+
+@functools.lru_cache(maxsize=4096)
+def _naps_day_hours(date, offset):
+    """UTC hour strings for H01..H24 of a NAPS date (local standard time)."""
+    # H01 is the hour ending 01:00, i.e. starting 00:00 (half-hour offsets round down)
+    start = (_parse_date(date) + datetime.timedelta(hours=offset)).replace(minute=0)
+    return tuple(_hour_str(start + datetime.timedelta(hours=h)) for h in range(24))
+
+
+def _naps_rows(header, rows, stations):
+    id_col = _col(header, "naps id", "naps_id", "identifiant")
+    date_col = _col(header, "date")
+    prov_col = _col(header, "province", "p/t")
+    hour_cols = [_col(header, f"h{h:02d}") for h in range(1, 25)]
+    if id_col is None or date_col is None or None in hour_cols:
+        raise ValueError("NAPS file without NAPS ID/Date/H01-H24 columns")
+
+    for row in rows:
+        try:
+            sid = normalize_naps_id(row[id_col])
+            if stations is not None and sid not in stations:
+                yield None
+                continue
+            offset = PROVINCE_UTC_OFFSET.get(row[prov_col].strip().upper(), 5) if prov_col is not None else 5
+            hours = _naps_day_hours(row[date_col].strip(), offset)
+        except (ValueError, IndexError):
+            yield None
+            continue
+        values = []
+        for hour, col in zip(hours, hour_cols):
+            try:
+                pm = float(row[col])
+            except (ValueError, IndexError):
+                continue
+            if pm > MISSING:
+                values.append((sid, hour, pm))
+        yield values
+
+
+def _epa_hourly_rows(header, rows, stations):
+    state, county, site = _col(header, "state code"), _col(header, "county code"), _col(header, "site num")
+    param = _col(header, "parameter code")
+    date_col, time_col = _col(header, "date gmt"), _col(header, "time gmt")
+    value_col = _col(header, "sample measurement")
+
+    for row in rows:
+        try:
+            if param is not None and row[param] not in EPA_PM25_PARAMETERS:
+                yield None
+                continue
+            sid = normalize_epa_id(row[state], row[county], row[site])
+            if stations is not None and sid not in stations:
+                yield None
+                continue
+            pm = float(row[value_col])
+            hour = int(row[time_col][:2])
+        except (ValueError, IndexError):
+            yield None
+            continue
+        yield [(sid, f"{row[date_col][:10]} {hour:02d}:00:00", pm)]
+
+
+def _epa_daily_rows(header, rows, stations):
+    state, county, site = _col(header, "state code"), _col(header, "county code"), _col(header, "site num")
+    param = _col(header, "parameter code")
+    date_col = _col(header, "date local")
+    value_col = _col(header, "arithmetic mean")
+
+    for row in rows:
+        try:
+            if param is not None and row[param] not in EPA_PM25_PARAMETERS:
+                yield None
+                continue
+            sid = normalize_epa_id(row[state], row[county], row[site])
+            if stations is not None and sid not in stations:
+                yield None
+                continue
+            pm = float(row[value_col])
+        except (ValueError, IndexError):
+            yield None
+            continue
+        yield [(sid, f"{row[date_col][:10]} 00:00:00", pm)]
+
+
+def detect_layout(header):
+    """(source, row parser) for a header row, or None if it isn't one."""
+    names = " ".join(h.lower() for h in header)
+    if "naps" in names and "h24" in names:
+        return SOURCE_NAPS, _naps_rows
+    if "state code" in names and "sample measurement" in names:
+        return SOURCE_EPA, _epa_hourly_rows
+    if "state code" in names and "arithmetic mean" in names:
+        return SOURCE_EPA, _epa_daily_rows
+    return None
+
+
+def open_members(path):
+    """Yield (member name, text stream) for a CSV file or each CSV in a zip."""
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as zf:
+            for name in sorted(zf.namelist()):
+                if name.lower().endswith((".csv", ".txt")):
+                    with zf.open(name) as raw:
+                        yield name, io.TextIOWrapper(raw, encoding="utf-8-sig", errors="replace", newline="")
+    else:
+        with open(path, "r", encoding="utf-8-sig", errors="replace", newline="") as f:
+            yield os.path.basename(path), f
+
+
+class BatchWriter:
+    """Buffers (station, observed_at, pm25, source) rows and bulk-inserts them."""
+
+    def __init__(self, batch_size=BATCH_SIZE):
+        self.batch_size = batch_size
+        self.rows = []
+        self.table = ReadingHistory._meta.db_table
+        self.postgres = connection.vendor == "postgresql"
+        self.read = 0      # Readings flushed
+        self.written = 0   # Readings inserted (the rest were already stored)
+
+    def add(self, values, source):
+        self.rows.extend((sid, "", ts, pm, source) for sid, ts, pm in values)
+
+    def full(self):
+        return len(self.rows) >= self.batch_size
+
+    def flush(self):
+        if not self.rows:
+            return 0
+        with transaction.atomic(), connection.cursor() as cursor:
+            if self.postgres:
+                inserted = self._copy(cursor)
+            else:
+                cursor.executemany(
+                    f"INSERT INTO {self.table} ({', '.join(FIELDS)}) VALUES (%s, %s, %s, %s, %s) "
+                    "ON CONFLICT DO NOTHING",
+                    self.rows,
+                )
+                inserted = cursor.rowcount
+        self.read += len(self.rows)
+        self.written += inserted
+        self.rows = []
+        return inserted
+
+    def _copy(self, cursor):
+        cursor.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS ingest_readings "
+            "(station varchar(20), city varchar(50), observed_at timestamptz, "
+            "pm25 double precision, source varchar(12)) ON COMMIT DELETE ROWS"
+        )
+        buf = io.StringIO()
+        for sid, city, ts, pm, source in self.rows:
+            buf.write(f"{sid}\t{city}\t{ts}+00\t{pm}\t{source}\n")
+        buf.seek(0)
+        copy_sql = f"COPY ingest_readings ({', '.join(FIELDS)}) FROM STDIN"
+        if hasattr(cursor.cursor, "copy_expert"):   # psycopg2
+            cursor.cursor.copy_expert(copy_sql, buf)
+        else:                                       # psycopg 3
+            with cursor.cursor.copy(copy_sql) as copy:
+                copy.write(buf.getvalue())
+        cursor.execute(
+            f"INSERT INTO {self.table} ({', '.join(FIELDS)}) "
+            f"SELECT {', '.join(FIELDS)} FROM ingest_readings ON CONFLICT DO NOTHING"
+        )
+        return cursor.rowcount
+
+
+class Checkpoint:
+    """Resume position per archive: {key: {"member": name, "rows": n, "done": [names]}}.
+
+    Saved after every committed batch, so an interrupted ingestion restarts
+    at the last batch boundary. Archives are keyed by path, size and mtime,
+    so a changed file starts over.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path, "r") as f:
+                self.state = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.state = {}
+
+    @staticmethod
+    def key(path):
+        st = os.stat(path)
+        return f"{os.path.abspath(path)}:{st.st_size}:{int(st.st_mtime)}"
+
+    def get(self, archive):
+        return self.state.setdefault(self.key(archive), {"member": None, "rows": 0, "done": []})
+
+    def save(self):
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.state, f)
+        os.replace(tmp, self.path)
+
+
+def ingest_archive(path, writer, checkpoint, stations=None, progress=None):
+    """Stream one file or zip into `writer`, resuming from `checkpoint`.
+
+    stations: set of ids to keep (None keeps all). progress(member, rows)
+    is called after each batch. Returns the number of data rows read.
+    """
+    state = checkpoint.get(path)
+    total = 0
+    for member, stream in open_members(path):
+        if member in state["done"]:
+            continue
+        skip = state["rows"] if state["member"] == member else 0
+        reader = csv.reader(stream)
+        layout = None
+        for header in reader:
+            layout = detect_layout(header)
+            if layout is not None:
+                break
+        if layout is None:
+            state["done"].append(member)
+            continue
+
+        source, parse = layout
+        # Rows before the checkpoint were committed already: skip them unparsed
+        for _ in itertools.islice(reader, skip):
+            pass
+        rows = skip
+        for values in parse(header, reader, stations):
+            rows += 1
+            if values:
+                writer.add(values, source)
+            if writer.full():
+                writer.flush()
+                state["member"], state["rows"] = member, rows
+                checkpoint.save()
+                if progress:
+                    progress(member, rows)
+        writer.flush()
+        total += rows - skip
+        state["done"].append(member)
+        state["member"], state["rows"] = None, 0
+        checkpoint.save()
+        if progress:
+            progress(member, rows)
+    return total
@@ -0,0 +1,86 @@
+"""
+Backtest the three-rule detector over the stored hourly history.
+
+Streams ReadingHistory (live refreshes and bulk-loaded NAPS/EPA archives),
+or with --store the memory-mapped history store, through dashboard.backtest
+and prints detection rate, false alarm rate and lead times per city, using
+the thresholds and windows in services (with any per-city overrides from
+data/thresholds.json).
+
+Usage:
+    python manage.py backtest --months 5-9
+    python manage.py backtest --start 2003-01-01 --end 2024-01-01 --json
+"""
+
+import datetime
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from dashboard import backtest, services
+
+
+def parse_months(value):
+    """"5-9" or "5,6,7" -> set of month numbers."""
+    months = set()
+    for part in value.split(","):
+        lo, _, hi = part.partition("-")
+        months.update(range(int(lo), int(hi or lo) + 1))
+    if not months <= set(range(1, 13)):
+        raise CommandError(f"Invalid months: {value}")
+    return months
+
+
+def parse_date(value):
+    try:
+        return datetime.datetime.strptime(value, "%Y-%m-%d").replace(tzinfo=datetime.timezone.utc)
+    except ValueError:
+        raise CommandError(f"Invalid date (expected YYYY-MM-DD): {value}")
+
+
+def _rate(value):
+    return "-" if value is None else f"{value:.1%}"
+
+
+class Command(BaseCommand):
+    help = "Backtest the alert rules against stored hourly history."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--start", type=parse_date, help="First day (YYYY-MM-DD, UTC)")
+        parser.add_argument("--end", type=parse_date, help="Day after the last (YYYY-MM-DD, UTC)")
+        parser.add_argument("--months", type=parse_months, help='Months to include, e.g. "5-9" for the fire season')
+        parser.add_argument("--store", action="store_true",
+                            help="Read the memory-mapped history store instead of the database")
+        parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+
+    def handle(self, *args, **options):
+        stations = services.load_all_stations()
+        ids = backtest.History.station_ids(stations)
+        if options["store"]:
+            store = services.load_history_store()
+            if store is None:
+                raise CommandError("No history store; run manage.py build_history_store first.")
+            blocks = store.blocks(ids, start=options["start"], end=options["end"])
+        else:
+            blocks = backtest.history_blocks(ids, start=options["start"], end=options["end"])
+        history = backtest.History.prepare(stations, blocks, months=options["months"])
+        thresholds, city_threshold = services.city_thresholds(history.city_names)
+        results = backtest.score(history, thresholds, city_threshold=city_threshold)
+
+        if options["json"]:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+        if not len(history):
+            self.stdout.write("No hourly history to backtest.")
+            return
+
+        first = datetime.datetime.fromtimestamp(history.first_hour * 3600, tz=datetime.timezone.utc)
+        self.stdout.write(f"{len(history)} hours from {first:%Y-%m-%d %H:00} UTC")
+        for city, r in results.items():
+            lead = r["lead_hours"]
+            lead = f"lead {lead['min']}-{lead['max']} h (median {lead['median']:g})" if lead else "no lead times"
+            self.stdout.write(self.style.SUCCESS(
+                f"{city:10s} events {r['events']:4d}  detected {_rate(r['detection_rate']):>6s}  "
+                f"warnings {r['warnings']:4d}  false alarms {_rate(r['false_alarm_rate']):>6s}  "
+                f"unverified {r['unverified']:3d}  {lead}"
+            ))
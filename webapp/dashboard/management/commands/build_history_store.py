@@ -0,0 +1,59 @@
+"""
+Build the columnar hourly history store from ReadingHistory.
+
+Streams the table in time order into a float32 [stations, hours]
+memory-mapped matrix (see dashboard/history_store.py), so memory stays
+flat however many rows there are. Backtests and sweeps read the store
+with --store instead of querying the database.
+
+Usage:
+    python manage.py build_history_store [--out data/history] [--start 2003-01-01]
+"""
+
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Max, Min
+
+from dashboard import backtest, services
+from dashboard.history_store import HistoryStore, to_hour
+from dashboard.models import ReadingHistory
+
+from .backtest import parse_date
+
+
+class Command(BaseCommand):
+    help = "Write ReadingHistory to the memory-mapped hourly history store."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--out", default=services.HISTORY_STORE_DIR, help="Store directory")
+        parser.add_argument("--start", type=parse_date)
+        parser.add_argument("--end", type=parse_date)
+
+    def handle(self, *args, **options):
+        t0 = time.monotonic()
+        rows = ReadingHistory.objects.exclude(source=ReadingHistory.SOURCE_WAQI_DAILY)
+        if options["start"]:
+            rows = rows.filter(observed_at__gte=options["start"])
+        if options["end"]:
+            rows = rows.filter(observed_at__lt=options["end"])
+        bounds = rows.aggregate(first=Min("observed_at"), last=Max("observed_at"))
+        if bounds["first"] is None:
+            raise CommandError("No hourly readings to store.")
+
+        station_ids = sorted(rows.values_list("station", flat=True).distinct())
+        first_hour = to_hour(bounds["first"])
+        hours = to_hour(bounds["last"]) - first_hour + 1
+        store = HistoryStore.create(options["out"], station_ids, first_hour, hours)
+
+        blocks = backtest.history_blocks(station_ids, start=options["start"], end=options["end"])
+        for start, block in blocks:
+            col = start - first_hour
+            store.data[:, col:col + len(block)] = block.T
+        store.close()
+
+        size = store.data.nbytes / 1e6
+        self.stdout.write(self.style.SUCCESS(
+            f"Stored {len(station_ids)} stations x {hours} hours ({size:.1f} MB) "
+            f"in {options['out']} in {time.monotonic() - t0:.1f}s"
+        ))
@@ -0,0 +1,26 @@
+"""
+Compile the regression workbooks into data/station_catalog.json.
+
+Run at build time so request handlers never have to parse Excel.
+"""
+
+from django.core.management.base import BaseCommand
+
+from dashboard import services
+
+
+class Command(BaseCommand):
+    help = "Compile *_PM25_EWS_Regression.xlsx workbooks into the station catalog."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--output", default=services.CATALOG_PATH,
+            help="Path to write the catalog to (default: %(default)s)",
+        )
+
+    def handle(self, *args, **options):
+        catalog = services.write_station_catalog(options["output"])
+        counts = ", ".join(f"{city}: {len(rows)}" for city, rows in catalog["cities"].items())
+        self.stdout.write(self.style.SUCCESS(
+            f"Wrote {options['output']} (format {catalog['format']}; {counts})"
+        ))
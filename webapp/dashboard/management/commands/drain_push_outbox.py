@@ -0,0 +1,49 @@
+"""
+Send queued push notifications from the PushOutbox.
+
+Run as a long-lived worker next to the web app (several can run at once
+on Postgres), or with --once from cron:
+
+    python manage.py drain_push_outbox
+"""
+
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from dashboard import push
+from dashboard.models import PushOutbox
+
+PURGE_INTERVAL = 3600  # Seconds between deleting old receipts
+
+
+class Command(BaseCommand):
+    help = "Deliver queued push notifications, retrying transient failures."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true", help="Drain what is due, then exit")
+        parser.add_argument("--batch-size", type=int, default=push.DRAIN_BATCH)
+        parser.add_argument("--idle-sleep", type=float, default=5.0,
+                            help="Seconds to wait when nothing is due (default: %(default)s)")
+
+    def handle(self, *args, **options):
+        dispatcher = push.get_dispatcher()
+        if not dispatcher.configured:
+            raise CommandError("APNs is not configured (APNS_KEY_ID, APNS_TEAM_ID, APNS key)")
+
+        last_purge = 0.0
+        while True:
+            if time.monotonic() - last_purge >= PURGE_INTERVAL:
+                removed = PushOutbox.purge()
+                last_purge = time.monotonic()
+                if removed:
+                    self.stdout.write(f"Purged {removed} old delivery receipts")
+
+            result = push.drain_outbox(options["batch_size"], dispatcher=dispatcher)
+            if result is not None:
+                errors = ", ".join(f"{reason}: {n}" for reason, n in result.errors.most_common(5))
+                self.stdout.write(f"{result}" + (f" [{errors}]" if errors else ""))
+                continue
+            if options["once"]:
+                break
+            time.sleep(options["idle_sleep"])
@@ -0,0 +1,73 @@
+"""
+Load NAPS / U.S. EPA AQS hourly PM2.5 archives into ReadingHistory.
+
+Streams CSV files and zip archives row by row (see dashboard/ingest.py)
+and writes in large batches. Only stations that appear in the regression
+workbooks (and the target stations) are kept unless --all-stations is
+given. Progress is checkpointed after every batch; re-running the same
+command resumes where it stopped.
+
+Usage:
+    python manage.py ingest_history archives/PM25_2003.csv archives/hourly_88101_2003.zip ...
+    python manage.py ingest_history archives/ --batch-size 100000
+"""
+
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from dashboard import ingest, services
+
+
+class Command(BaseCommand):
+    help = "Bulk-load NAPS / EPA hourly PM2.5 archives into ReadingHistory."
+
+    def add_arguments(self, parser):
+        parser.add_argument("paths", nargs="+", help="CSV files, zip archives or directories of them")
+        parser.add_argument("--batch-size", type=int, default=ingest.BATCH_SIZE)
+        parser.add_argument("--checkpoint", default=os.path.join(services.DATA_DIR, "ingest_checkpoint.json"))
+        parser.add_argument("--restart", action="store_true", help="Ignore the checkpoint and read everything")
+        parser.add_argument("--all-stations", action="store_true",
+                            help="Keep stations that are not in the regression workbooks")
+
+    def handle(self, *args, **options):
+        files = []
+        for path in options["paths"]:
+            if os.path.isdir(path):
+                files.extend(
+                    os.path.join(path, name) for name in sorted(os.listdir(path))
+                    if name.lower().endswith((".csv", ".txt", ".zip"))
+                )
+            elif os.path.isfile(path):
+                files.append(path)
+            else:
+                raise CommandError(f"No such file or directory: {path}")
+
+        stations = None
+        if not options["all_stations"]:
+            stations = {c["naps_id"] for c in services.CITIES.values()}
+            for city_key in services.CITIES:
+                stations.update(st["id"] for st in services.load_candidate_stations(city_key))
+
+        checkpoint = ingest.Checkpoint(options["checkpoint"])
+        if options["restart"]:
+            checkpoint.state = {}
+        writer = ingest.BatchWriter(options["batch_size"])
+        t0 = time.monotonic()
+
+        def progress(member, rows):
+            elapsed = time.monotonic() - t0
+            self.stdout.write(f"  {member}: row {rows:,}, {writer.read:,} readings "
+                              f"({writer.read / max(elapsed, 1e-9):,.0f}/s)")
+
+        rows = 0
+        for path in files:
+            self.stdout.write(path)
+            rows += ingest.ingest_archive(path, writer, checkpoint, stations=stations, progress=progress)
+
+        elapsed = time.monotonic() - t0
+        self.stdout.write(self.style.SUCCESS(
+            f"Read {rows:,} rows: {writer.read:,} readings ({writer.written:,} new) in {elapsed:.1f}s "
+            f"({writer.read / max(elapsed, 1e-9):,.0f}/s)"
+        ))
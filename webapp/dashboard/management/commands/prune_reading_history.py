@@ -0,0 +1,20 @@
+"""
+Apply the ReadingHistory retention policy.
+
+Hourly WAQI readings older than ReadingHistory.HOURLY_RETENTION are
+replaced by one daily mean per station and city. Run daily (cron).
+"""
+
+from django.core.management.base import BaseCommand
+
+from dashboard.models import ReadingHistory
+
+
+class Command(BaseCommand):
+    help = "Roll up old hourly WAQI readings into daily means."
+
+    def handle(self, *args, **options):
+        removed, written = ReadingHistory.rollup()
+        self.stdout.write(self.style.SUCCESS(
+            f"Rolled up {removed} hourly rows into {written} daily rows"
+        ))
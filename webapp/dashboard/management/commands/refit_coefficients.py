@@ -0,0 +1,102 @@
+"""
+Refit the station regressions from the stored hourly history.
+
+Fits every candidate station of every city against its target station
+(see dashboard/refit.py), applies the README selection criteria and
+prints what changed against the stations currently served. With --write
+the result is saved as a new coefficient set in data/coefficients/;
+--activate makes load_stations serve it.
+
+Usage:
+    python manage.py refit_coefficients --store
+    python manage.py refit_coefficients --store --write --activate
+    python manage.py refit_coefficients --use 20260501T120000Z   # re-activate a saved set
+"""
+
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from dashboard import backtest, refit, services
+
+from .backtest import parse_date, parse_months
+
+
+class Command(BaseCommand):
+    help = "Refit station slopes/intercepts from hourly history and write a coefficient set."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--store", action="store_true",
+                            help="Read the memory-mapped history store instead of the database")
+        parser.add_argument("--start", type=parse_date)
+        parser.add_argument("--end", type=parse_date)
+        parser.add_argument("--months", type=parse_months, default=parse_months("5-9"),
+                            help='Months to fit on (default "5-9", the fire season)')
+        parser.add_argument("--city", action="append", choices=list(services.CITIES),
+                            help="Only refit this city (repeatable)")
+        parser.add_argument("--min-r", type=float, default=refit.MIN_R)
+        parser.add_argument("--max-p", type=float, default=refit.MAX_P)
+        parser.add_argument("--min-n", type=int, default=refit.MIN_N)
+        parser.add_argument("--write", action="store_true", help="Save the result as a new coefficient set")
+        parser.add_argument("--name", help="Name for the saved set (default: UTC timestamp)")
+        parser.add_argument("--activate", action="store_true", help="Serve the saved set")
+        parser.add_argument("--use", metavar="VERSION", help="Activate an existing set and exit")
+
+    def handle(self, *args, **options):
+        if options["use"]:
+            try:
+                refit.activate(options["use"])
+            except FileNotFoundError as e:
+                raise CommandError(str(e))
+            self.stdout.write(self.style.SUCCESS(f"Serving coefficient set {options['use']}"))
+            return
+
+        if options["store"]:
+            store = services.load_history_store()
+            if store is None:
+                raise CommandError("No history store; run manage.py build_history_store first.")
+
+            def blocks_for(ids):
+                return store.blocks(ids, start=options["start"], end=options["end"])
+        else:
+            def blocks_for(ids):
+                return backtest.history_blocks(ids, start=options["start"], end=options["end"])
+
+        t0 = time.monotonic()
+        results = refit.refit(
+            blocks_for, cities=options["city"], months=options["months"],
+            min_r=options["min_r"], max_p=options["max_p"], min_n=options["min_n"],
+        )
+        elapsed = time.monotonic() - t0
+        if not any(results.values()):
+            raise CommandError("No paired history to fit.")
+
+        for city, rows in results.items():
+            included = {row["id"]: row for row in rows if row["included"]}
+            if not included:
+                self.stdout.write(f"{city:10s} fitted {len(rows):3d}  included   0  (keeps its current stations)")
+                continue
+            current = {st["id"] for st in services.load_stations(city)}
+            added = sorted(set(included) - current)
+            dropped = sorted(current - set(included))
+            self.stdout.write(
+                f"{city:10s} fitted {len(rows):3d}  included {len(included):3d}  "
+                f"added {', '.join(added) or '-'}  dropped {', '.join(dropped) or '-'}"
+            )
+            if options["verbosity"] >= 2:
+                for row in rows:
+                    mark = "+" if row["included"] else " "
+                    self.stdout.write(
+                        f"   {mark} {row['id']:>10s} {row['city_name'][:20]:20s} {row['distance']:7.1f} km  "
+                        f"R {row['R']:.4f}  slope {row['slope']:.4f}  intercept {row['intercept']:.4f}  "
+                        f"p {row['p_value']:.2e}  N {row['n']}"
+                    )
+        self.stdout.write(f"Refit in {elapsed:.1f}s")
+
+        if options["write"]:
+            criteria = {"min_r": options["min_r"], "max_p": options["max_p"], "min_n": options["min_n"]}
+            version = refit.write(results, criteria=criteria, months=options["months"], version=options["name"])
+            self.stdout.write(self.style.SUCCESS(f"Wrote coefficient set {version}"))
+            if options["activate"]:
+                refit.activate(version)
+                self.stdout.write(self.style.SUCCESS(f"Serving coefficient set {version}"))
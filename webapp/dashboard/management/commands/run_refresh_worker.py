@@ -0,0 +1,89 @@
+"""
+Run refreshes in a worker process instead of inside /api/refresh/.
+
+Executes queued RefreshJobs (enqueued by /api/refresh/ when
+REFRESH_USE_WORKER is set) and, with --interval, queues one itself on a
+schedule, so refresh duration no longer depends on the web timeout:
+
+    python manage.py run_refresh_worker --interval 900
+"""
+
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from django.utils import timezone
+
+from dashboard import apikeys, refresh
+from dashboard.models import RefreshJob
+
+PURGE_INTERVAL = 3600  # Seconds between deleting old job rows
+USAGE_INTERVAL = 60    # Seconds between API key usage write-backs
+MAX_BACKOFF = 300      # Longest wait after repeated errors (doubles from --poll)
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Process queued refresh jobs and optionally schedule refreshes."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--interval", type=int, default=0,
+                            help="Queue a refresh every N seconds (default: only run queued jobs)")
+        parser.add_argument("--poll", type=float, default=5.0,
+                            help="Seconds between queue checks (default: %(default)s)")
+        parser.add_argument("--once", action="store_true", help="Run queued jobs, then exit")
+
+    def handle(self, *args, **options):
+        self.interval = options["interval"]
+        self.last_purge = self.last_usage = 0.0
+        failures = 0
+        while True:
+            # Drop connections the database closed or that outlived CONN_MAX_AGE
+            close_old_connections()
+            try:
+                job = self.step()
+            except Exception:
+                if options["once"]:
+                    raise
+                failures += 1
+                delay = min(MAX_BACKOFF, options["poll"] * 2 ** failures)
+                logger.exception("Refresh worker error, retrying in %.0fs", delay)
+                time.sleep(delay)
+                continue
+            failures = 0
+
+            if job is not None:
+                self.report(job)
+                continue
+            if options["once"]:
+                break
+            time.sleep(options["poll"])
+
+    def step(self):
+        """Housekeeping, then run the next queued job. Returns it, or None."""
+        if time.monotonic() - self.last_purge >= PURGE_INTERVAL:
+            RefreshJob.purge()
+            self.last_purge = time.monotonic()
+        if time.monotonic() - self.last_usage >= USAGE_INTERVAL:
+            apikeys.flush()
+            self.last_usage = time.monotonic()
+
+        if self.interval:
+            last = RefreshJob.last_requested_at()
+            if last is None or (timezone.now() - last).total_seconds() >= self.interval:
+                RefreshJob.enqueue("schedule")
+
+        return refresh.run_next_job()
+
+    def report(self, job):
+        took = (job.finished_at - job.started_at).total_seconds()
+        if job.summary.get("skipped"):
+            self.stdout.write(f"{job} ({job.source}) skipped: {job.summary['skipped']}")
+        elif job.status == RefreshJob.DONE:
+            self.stdout.write(self.style.SUCCESS(
+                f"{job} ({job.source}) in {took:.1f}s: {job.summary.get('stations_fetched', 0)} stations"
+            ))
+        else:
+            self.stderr.write(f"{job} ({job.source}) failed after {took:.1f}s:\n{job.error}")
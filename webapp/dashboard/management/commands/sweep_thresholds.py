@@ -0,0 +1,104 @@
+"""
+Sweep rule thresholds per city over the stored hourly history.
+
+Prepares one backtest.History from ReadingHistory, scores every threshold
+set in a process pool and prints each city's Pareto front (detection
+rate vs false alarm rate). Fields not given keep their default value.
+
+Usage:
+    python manage.py sweep_thresholds --months 5-9 \\
+        --rule1 30:60:5 --rule2-distant 25:50:5 --rule2-intermediate 15:30:5 \\
+        --rule3 30:60:5 --city-elevated 20
+    python manage.py sweep_thresholds ... --samples 5000 --seed 1 --write
+"""
+
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from dashboard import backtest, services, sweep
+
+from .backtest import parse_date, parse_months
+
+
+def _rate(value):
+    return f"{value:.1%}"
+
+
+class Command(BaseCommand):
+    help = "Search per-city rule thresholds against stored hourly history."
+
+    def add_arguments(self, parser):
+        for field in services.THRESHOLD_FIELDS:
+            parser.add_argument(
+                f"--{field.replace('_', '-')}", dest=field,
+                help='Values to try: "lo:hi:step", "a,b,c" or one value',
+            )
+        parser.add_argument("--samples", type=int, help="Random search: number of combinations to try")
+        parser.add_argument("--seed", type=int)
+        parser.add_argument("--workers", type=int, help="Worker processes (default: all cores)")
+        parser.add_argument("--start", type=parse_date)
+        parser.add_argument("--end", type=parse_date)
+        parser.add_argument("--months", type=parse_months, help='e.g. "5-9" for the fire season')
+        parser.add_argument("--max-false-alarm", type=float, default=0.0,
+                            help="False alarm rate allowed when picking each city's thresholds")
+        parser.add_argument("--write", action="store_true",
+                            help=f"Write the picked thresholds to {services.THRESHOLDS_PATH}")
+        parser.add_argument("--store", action="store_true",
+                            help="Read the memory-mapped history store instead of the database")
+        parser.add_argument("--json", action="store_true", help="Print the Pareto fronts as JSON")
+
+    def handle(self, *args, **options):
+        try:
+            values = {f: sweep.parse_values(options[f]) for f in services.THRESHOLD_FIELDS if options[f]}
+        except ValueError as e:
+            raise CommandError(f"Invalid threshold values: {e}")
+        candidates = sweep.candidates(values, samples=options["samples"], seed=options["seed"])
+
+        t0 = time.monotonic()
+        stations = services.load_all_stations()
+        ids = backtest.History.station_ids(stations)
+        if options["store"]:
+            store = services.load_history_store()
+            if store is None:
+                raise CommandError("No history store; run manage.py build_history_store first.")
+            blocks = store.blocks(ids, start=options["start"], end=options["end"])
+        else:
+            blocks = backtest.history_blocks(ids, start=options["start"], end=options["end"])
+        history = backtest.History.prepare(stations, blocks, months=options["months"])
+        if not len(history):
+            raise CommandError("No hourly history to sweep over.")
+        t1 = time.monotonic()
+        points = sweep.run(history, candidates, workers=options["workers"])
+        t2 = time.monotonic()
+
+        fronts = {city: sweep.pareto_front(p) for city, p in points.items()}
+        picks = {city: sweep.best(front, options["max_false_alarm"]) for city, front in fronts.items()}
+
+        if options["json"]:
+            self.stdout.write(json.dumps({
+                city: [dict(p._asdict(), candidate=p.candidate._asdict()) for p in front]
+                for city, front in fronts.items()
+            }, indent=2))
+        else:
+            self.stdout.write(
+                f"{len(candidates)} threshold sets over {len(history)} hours: "
+                f"history {t1 - t0:.1f}s, sweep {t2 - t1:.1f}s ({len(candidates) / max(t2 - t1, 1e-9):.0f}/s)"
+            )
+            for city, front in fronts.items():
+                self.stdout.write(f"\n{city}: {len(front)} points on the Pareto front")
+                for p in front:
+                    marker = "*" if p is picks[city] else " "
+                    fields = " ".join(f"{k}={v:g}" for k, v in p.candidate._asdict().items())
+                    self.stdout.write(
+                        f" {marker} detection {_rate(p.detection_rate):>6s}  false alarms "
+                        f"{_rate(p.false_alarm_rate):>6s}  events {p.events:3d}  {fields}"
+                    )
+
+        if options["write"]:
+            chosen = {city: p.candidate for city, p in picks.items() if p is not None}
+            sweep.write_thresholds(chosen)
+            self.stdout.write(self.style.SUCCESS(
+                f"Wrote thresholds for {', '.join(chosen) or 'no cities'} to {services.THRESHOLDS_PATH}"
+            ))
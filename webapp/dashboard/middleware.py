@@ -4,7 +4,7 @@ Security and rate limiting middleware for the PM2.5 EWS application.
 
 import time
 import hashlib
-from collections import defaultdict
+from collections import OrderedDict
 from threading import Lock
 from functools import wraps
 
@@ -15,10 +15,19 @@ from django.conf import settings
 
 class RateLimitMiddleware:
     """
-    Rate limiting middleware using a sliding window algorithm.
+    Rate limiting middleware using a sliding window counter.
 
     Limits requests per IP address to prevent abuse and DDoS attacks.
     Uses Django's cache backend for distributed rate limiting.
+
+    Each client has one integer counter per fixed window. The request
+    count over the last `window` seconds is estimated as
+
+        previous_window_count * (1 - elapsed_fraction) + current_count
+
+    so a request costs one atomic cache.incr (plus one cache.get of the
+    previous window's count, once per client, window and process), and
+    state per client is two integers no matter how high the limit is.
     """
 
     # Default rate limits (requests per window)
@@ -36,16 +45,27 @@ class RateLimitMiddleware:
         'api': ['/api/'],
     }
 
+    # Not rate limited: health checks, the SSE stream (one long-lived request
+    # per page; EventSource reconnects on its own after proxy timeouts) and
+    # the cron endpoint, which is protected by CRON_SECRET
+    EXEMPT_PATHS = ('/health/', '/api/live/stream/', '/api/refresh/')
+
+    # Max clients tracked in process (previous-window memo and local fallback)
+    LOCAL_MAX_ENTRIES = 10000
+
     def __init__(self, get_response):
         self.get_response = get_response
-        # Fallback in-memory store if cache is unavailable
-        self._local_store = defaultdict(list)
+        # Previous-window counts already read from the cache, LRU-evicted
+        self._previous = OrderedDict()
+        # Fallback in-memory store if cache is unavailable:
+        # key -> [window index, current count, previous count], LRU-evicted
+        self._local_store = OrderedDict()
         self._lock = Lock()
 
     def __call__(self, request):
-        # Skip rate limiting for static files and health checks
+        # Skip rate limiting for static files and exempt endpoints
         path = request.path
-        if path.startswith('/static/') or path == '/health/':
+        if path.startswith('/static/') or path in self.EXEMPT_PATHS:
             return self.get_response(request)
 
         # Get client identifier (IP + User-Agent hash for better fingerprinting)
@@ -53,7 +73,7 @@ class RateLimitMiddleware:
         category = self._get_category(path)
 
         # Check rate limit
-        is_allowed, retry_after = self._check_rate_limit(client_id, category)
+        is_allowed, retry_after, remaining, limit = self._check_rate_limit(client_id, category)
 
         if not is_allowed:
             return JsonResponse({
@@ -63,10 +83,11 @@ class RateLimitMiddleware:
 
         response = self.get_response(request)
 
-        # Add rate limit headers to response
-        remaining, limit = self._get_remaining(client_id, category)
-        response['X-RateLimit-Limit'] = str(limit)
-        response['X-RateLimit-Remaining'] = str(max(0, remaining))
+        # Add rate limit headers to response (computed by the check above),
+        # unless the view reported its own limit (per-key limits on /api/v1/)
+        if not response.has_header('X-RateLimit-Limit'):
+            response['X-RateLimit-Limit'] = str(limit)
+            response['X-RateLimit-Remaining'] = str(max(0, remaining))
 
         return response
 
@@ -94,64 +115,87 @@ class RateLimitMiddleware:
                     return category
         return 'default'
 
+    def _remember(self, store, key, value):
+        """Insert into an LRU OrderedDict, evicting the oldest entries."""
+        store[key] = value
+        store.move_to_end(key)
+        while len(store) > self.LOCAL_MAX_ENTRIES:
+            store.popitem(last=False)
+
+    @staticmethod
+    def _decide(limit, window, elapsed, current, previous):
+        """Apply the sliding window estimate.
+
+        Returns (is_allowed, retry_after, remaining). `current` already
+        includes this request.
+        """
+        weight = 1 - elapsed / window
+        estimate = previous * weight + current
+        if estimate <= limit:
+            return True, 0, int(limit - estimate)
+
+        # Time until the previous window's share decays enough, or until the
+        # next window if the current one alone is over the limit
+        if current < limit and previous > 0:
+            wait = window * (1 - (limit - current) / previous) - elapsed
+        else:
+            wait = window - elapsed
+        return False, int(max(wait, 0)) + 1, 0
+
     def _check_rate_limit(self, client_id, category):
-        """Check if request is within rate limits using sliding window."""
+        """Check if request is within rate limits using a sliding window counter.
+
+        Returns (is_allowed, retry_after, remaining, limit).
+        """
         limit, window = self.DEFAULT_LIMITS.get(category, self.DEFAULT_LIMITS['default'])
-        cache_key = f"ratelimit:{category}:{client_id}"
         now = time.time()
+        index, elapsed = divmod(now, window)
+        index = int(index)
+        base_key = f"ratelimit:{category}:{client_id}"
 
         try:
-            # Try to use cache backend
-            timestamps = cache.get(cache_key, [])
-
-            # Remove expired timestamps (sliding window)
-            cutoff = now - window
-            timestamps = [ts for ts in timestamps if ts > cutoff]
-
-            if len(timestamps) >= limit:
-                # Calculate retry-after
-                oldest = min(timestamps) if timestamps else now
-                retry_after = int(oldest + window - now) + 1
-                return False, retry_after
-
-            # Add current timestamp
-            timestamps.append(now)
-            cache.set(cache_key, timestamps, timeout=window + 10)
-
-            return True, 0
-
+            current = self._incr(f"{base_key}:{index}", window)
+            previous = self._previous_count(base_key, index)
         except Exception:
             # Fallback to local memory (less accurate but functional)
-            return self._check_local_rate_limit(client_id, category, limit, window, now)
+            current, previous = self._count_local(base_key, index)
 
-    def _check_local_rate_limit(self, client_id, category, limit, window, now):
-        """Fallback local rate limiting when cache is unavailable."""
-        key = f"{category}:{client_id}"
+        return (*self._decide(limit, window, elapsed, current, previous), limit)
 
+    def _incr(self, key, window):
+        """Atomically count a request in the current window's counter."""
+        try:
+            return cache.incr(key)
+        except ValueError:
+            # First request this window: create the counter. Kept for two
+            # windows so the next window can still read it.
+            if cache.add(key, 1, timeout=window * 2 + 10):
+                return 1
+            return cache.incr(key)
+
+    def _previous_count(self, base_key, index):
+        """Count of the (finished) previous window, read once per process."""
         with self._lock:
-            cutoff = now - window
-            self._local_store[key] = [ts for ts in self._local_store[key] if ts > cutoff]
-
-            if len(self._local_store[key]) >= limit:
-                oldest = min(self._local_store[key])
-                retry_after = int(oldest + window - now) + 1
-                return False, retry_after
-
-            self._local_store[key].append(now)
-            return True, 0
-
-    def _get_remaining(self, client_id, category):
-        """Get remaining requests for rate limit headers."""
-        limit, window = self.DEFAULT_LIMITS.get(category, self.DEFAULT_LIMITS['default'])
-        cache_key = f"ratelimit:{category}:{client_id}"
+            cached = self._previous.get(base_key)
+            if cached is not None and cached[0] == index:
+                self._previous.move_to_end(base_key)
+                return cached[1]
+        count = cache.get(f"{base_key}:{index - 1}", 0)
+        with self._lock:
+            self._remember(self._previous, base_key, (index, count))
+        return count
 
-        try:
-            timestamps = cache.get(cache_key, [])
-            cutoff = time.time() - window
-            current_count = len([ts for ts in timestamps if ts > cutoff])
-            return limit - current_count, limit
-        except Exception:
-            return limit, limit
+    def _count_local(self, key, index):
+        """Fallback local counters when cache is unavailable."""
+        with self._lock:
+            entry = self._local_store.get(key)
+            if entry is None or entry[0] < index - 1:
+                entry = [index, 0, 0]
+            elif entry[0] == index - 1:
+                entry = [index, 0, entry[1]]
+            entry[1] += 1
+            self._remember(self._local_store, key, entry)
+            return entry[1], entry[2]
 
 
 class SecurityHeadersMiddleware:
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0009_devicetoken'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StationMapping',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('station_id', models.CharField(max_length=20, unique=True)),
+                ('waqi_uid', models.IntegerField()),
+                ('distance_km', models.FloatField(blank=True, null=True)),
+                ('matched_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
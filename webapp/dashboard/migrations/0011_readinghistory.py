@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0010_stationmapping'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReadingHistory',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('station', models.CharField(max_length=20)),
+                ('city', models.CharField(blank=True, max_length=50)),
+                ('observed_at', models.DateTimeField()),
+                ('pm25', models.FloatField()),
+                ('source', models.CharField(default='waqi', max_length=12)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['observed_at'], name='dashboard_r_observe_f43110_idx')],
+                'constraints': [models.UniqueConstraint(fields=('station', 'observed_at', 'city'), name='reading_station_hour_city_uniq')],
+            },
+        ),
+    ]
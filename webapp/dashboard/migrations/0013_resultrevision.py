@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0012_cachedresult_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ResultRevision',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.PositiveBigIntegerField(unique=True)),
+                ('timestamp', models.DateTimeField(db_index=True)),
+                ('results', models.JSONField(default=list)),
+                ('city_alerts', models.JSONField(default=dict)),
+            ],
+        ),
+    ]
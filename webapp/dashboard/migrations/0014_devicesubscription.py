@@ -0,0 +1,41 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:24
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def backfill_subscriptions(apps, schema_editor):
+    """Create subscription rows from each device's cities list."""
+    DeviceToken = apps.get_model("dashboard", "DeviceToken")
+    DeviceSubscription = apps.get_model("dashboard", "DeviceSubscription")
+    batch = []
+    for device_id, cities in DeviceToken.objects.values_list("id", "cities").iterator(chunk_size=2000):
+        for city in dict.fromkeys(cities or ["*"]):
+            batch.append(DeviceSubscription(device_id=device_id, city=city))
+        if len(batch) >= 5000:
+            DeviceSubscription.objects.bulk_create(batch)
+            batch = []
+    DeviceSubscription.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0013_resultrevision'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeviceSubscription',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('city', models.CharField(max_length=50)),
+                ('device', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='subscriptions', to='dashboard.devicetoken')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['city', 'device'], name='dashboard_d_city_0bfe28_idx')],
+                'constraints': [models.UniqueConstraint(fields=('device', 'city'), name='device_city_uniq')],
+            },
+        ),
+        migrations.RunPython(backfill_subscriptions, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0014_devicesubscription'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CityAlertState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('city', models.CharField(max_length=50, unique=True)),
+                ('level', models.CharField(default='LOW', max_length=20)),
+                ('announced_level', models.CharField(default='LOW', max_length=20)),
+                ('peak_level', models.CharField(default='LOW', max_length=20)),
+                ('event_started_at', models.DateTimeField(blank=True, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-17 02:04
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def drop_duplicate_queued(apps, schema_editor):
+    """Keep the oldest queued job; earlier racing enqueues may have added more."""
+    RefreshJob = apps.get_model("dashboard", "RefreshJob")
+    queued = RefreshJob.objects.filter(status="queued").order_by("id")
+    first = queued.values_list("id", flat=True).first()
+    queued.exclude(id=first).update(
+        status="failed", finished_at=timezone.now(), error="Duplicate of an earlier queued job")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0017_refreshjob'),
+    ]
+
+    operations = [
+        migrations.RunPython(drop_duplicate_queued, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='refreshjob',
+            constraint=models.UniqueConstraint(condition=models.Q(('status', 'queued')), fields=('status',), name='refreshjob_one_queued'),
+        ),
+    ]
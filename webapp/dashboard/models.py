@@ -1,10 +1,11 @@
 import datetime
 import secrets
-from django.db import models
+from django.db import IntegrityError, models, transaction
 from django.contrib.auth.models import User
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 
 
 class UserProfile(models.Model):
@@ -40,36 +41,18 @@ class APIKey(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     last_used = models.DateTimeField(null=True, blank=True)
     is_active = models.BooleanField(default=True)
-    # Rate limiting (per key)
+    # Rate limiting (per key), counted by dashboard/apikeys.py: here when
+    # there is no shared cache, otherwise a periodically written-back copy.
     requests_this_hour = models.IntegerField(default=0)
     hour_started = models.DateTimeField(null=True, blank=True)
 
-    RATE_LIMIT = 100  # requests per hour per key
+    RATE_LIMIT = 100  # requests per clock hour per key
 
     def save(self, *args, **kwargs):
         if not self.key:
             self.key = secrets.token_hex(32)  # 64-char hex string
         super().save(*args, **kwargs)
 
-    def check_rate_limit(self):
-        """Check and update rate limit. Returns (allowed, remaining, reset_seconds)."""
-        now = timezone.now()
-        # Reset if hour has passed
-        if not self.hour_started or (now - self.hour_started).total_seconds() >= 3600:
-            self.hour_started = now
-            self.requests_this_hour = 0
-
-        remaining = max(0, self.RATE_LIMIT - self.requests_this_hour)
-        reset_seconds = int(3600 - (now - self.hour_started).total_seconds())
-
-        if self.requests_this_hour >= self.RATE_LIMIT:
-            return False, 0, reset_seconds
-
-        self.requests_this_hour += 1
-        self.last_used = now
-        self.save(update_fields=["requests_this_hour", "hour_started", "last_used"])
-        return True, remaining - 1, reset_seconds
-
     def __str__(self):
         return f"{self.name or 'API Key'} ({self.key[:8]}...)"
 
@@ -81,6 +64,125 @@ class ReadingSnapshot(models.Model):
     timestamp = models.DateTimeField(auto_now=True)
 
 
+class ReadingHistory(models.Model):
+    """Time series of PM2.5 readings: one row per station, target city and hour.
+
+    Live refreshes append with one bulk insert (see record()). Hourly WAQI
+    rows older than HOURLY_RETENTION are rolled up into one daily-mean row
+    per station and city by `manage.py prune_reading_history`; rows from
+    other sources (bulk-loaded archives) are never pruned.
+    """
+    SOURCE_WAQI = "waqi"
+    SOURCE_WAQI_DAILY = "waqi_daily"
+
+    HOURLY_RETENTION = datetime.timedelta(days=90)
+
+    station = models.CharField(max_length=20)
+    city = models.CharField(max_length=50, blank=True)  # Target city ("" if not city-specific)
+    observed_at = models.DateTimeField()
+    pm25 = models.FloatField()
+    source = models.CharField(max_length=12, default=SOURCE_WAQI)
+
+    class Meta:
+        constraints = [
+            # Also serves as the (station, observed_at) lookup index, so
+            # each insert maintains only two indexes besides the primary key.
+            models.UniqueConstraint(
+                fields=["station", "observed_at", "city"], name="reading_station_hour_city_uniq",
+            ),
+        ]
+        indexes = [
+            models.Index(fields=["observed_at"]),  # For retention/rollup scans
+        ]
+
+    @classmethod
+    def record(cls, rows, observed_at, source=SOURCE_WAQI):
+        """Insert [(station_id, city, pm25), ...] for one hour in a single bulk insert.
+
+        observed_at is truncated to the hour; a second refresh within the
+        same hour is ignored rather than duplicated.
+        """
+        hour = observed_at.replace(minute=0, second=0, microsecond=0)
+        objs = [
+            cls(station=sid, city=city, observed_at=hour, pm25=pm25, source=source)
+            for sid, city, pm25 in rows
+        ]
+        if objs:
+            cls.objects.bulk_create(objs, batch_size=1000, ignore_conflicts=True)
+        return len(objs)
+
+    @classmethod
+    def rollup(cls, now=None):
+        """Replace hourly WAQI rows older than HOURLY_RETENTION with daily means.
+
+        Works one day at a time, each day in its own transaction. Returns
+        (hourly_rows_removed, daily_rows_written).
+        """
+        from django.db.models import Avg
+
+        cutoff = (now or timezone.now()) - cls.HOURLY_RETENTION
+        cutoff = cutoff.replace(hour=0, minute=0, second=0, microsecond=0)
+        hourly = cls.objects.filter(source=cls.SOURCE_WAQI, observed_at__lt=cutoff)
+
+        removed = written = 0
+        oldest = hourly.order_by("observed_at").values_list("observed_at", flat=True).first()
+        while oldest is not None and oldest < cutoff:
+            day = oldest.replace(hour=0, minute=0, second=0, microsecond=0)
+            day_rows = hourly.filter(observed_at__gte=day, observed_at__lt=day + datetime.timedelta(days=1))
+            with transaction.atomic():
+                means = list(day_rows.values("station", "city").annotate(mean=Avg("pm25")))
+                removed += day_rows.delete()[0]
+                cls.objects.bulk_create([
+                    cls(station=m["station"], city=m["city"], observed_at=day,
+                        pm25=round(m["mean"], 1), source=cls.SOURCE_WAQI_DAILY)
+                    for m in means
+                ], batch_size=1000, ignore_conflicts=True)
+                written += len(means)
+            oldest = hourly.order_by("observed_at").values_list("observed_at", flat=True).first()
+        return removed, written
+
+    def __str__(self):
+        return f"{self.station} {self.observed_at:%Y-%m-%d %H:00} {self.pm25}"
+
+
+class StationMapping(models.Model):
+    """Remembers which WAQI station (uid) each of our stations was matched to.
+
+    Lets a refresh read a station's value straight from the bbox payload by
+    uid instead of re-running the nearest-station search, and keeps the
+    source stable when two WAQI monitors are at similar distances.
+    """
+    station_id = models.CharField(max_length=20, unique=True)
+    waqi_uid = models.IntegerField()
+    distance_km = models.FloatField(null=True, blank=True)
+    matched_at = models.DateTimeField(auto_now=True)
+
+    MAX_AGE = datetime.timedelta(days=14)  # Re-match after this long
+
+    @classmethod
+    def load_current(cls):
+        """Return {station_id: waqi_uid} for mappings younger than MAX_AGE."""
+        cutoff = timezone.now() - cls.MAX_AGE
+        return dict(
+            cls.objects.filter(matched_at__gte=cutoff).values_list("station_id", "waqi_uid")
+        )
+
+    @classmethod
+    def record(cls, matches):
+        """Upsert {station_id: (waqi_uid, distance_km)} in one query."""
+        if not matches:
+            return
+        cls.objects.bulk_create(
+            [cls(station_id=sid, waqi_uid=uid, distance_km=dist) for sid, (uid, dist) in matches.items()],
+            update_conflicts=True,
+            unique_fields=["station_id"],
+            update_fields=["waqi_uid", "distance_km", "matched_at"],
+        )
+
+    def __str__(self):
+        return f"{self.station_id} -> WAQI @{self.waqi_uid}"
+
+
 class CachedResult(models.Model):
     """Stores the latest server-side refresh results. Single row (key='latest')."""
     key = models.CharField(max_length=20, unique=True, default="latest")
@@ -88,6 +190,158 @@ class CachedResult(models.Model):
     city_alerts = models.JSONField(default=dict)
     readings = models.JSONField(default=dict)
     timestamp = models.DateTimeField(auto_now=True)
+    # Incremented by every refresh; used as the SSE event id (dashboard/stream.py)
+    version = models.PositiveBigIntegerField(default=0)
+
+
+class ResultRevision(models.Model):
+    """The last few refresh results, by version, for /api/v1/live/?since=.
+
+    Written with the CachedResult of each refresh; older revisions are
+    pruned so the table stays at KEEP rows.
+    """
+    version = models.PositiveBigIntegerField(unique=True)
+    timestamp = models.DateTimeField(db_index=True)
+    results = models.JSONField(default=list)
+    city_alerts = models.JSONField(default=dict)
+
+    KEEP = 48  # One day of half-hourly refreshes
+
+    @classmethod
+    def record(cls, cached):
+        """Store a CachedResult as a revision and prune old ones."""
+        cls.objects.create(
+            version=cached.version,
+            timestamp=cached.timestamp,
+            results=cached.results,
+            city_alerts=cached.city_alerts,
+        )
+        cls.objects.filter(version__lte=cached.version - cls.KEEP).delete()
+
+    @classmethod
+    def resolve(cls, since):
+        """Version of the revision a ?since= value refers to, or None.
+
+        `since` is a version number or the ISO timestamp of a refresh; a
+        timestamp resolves to the newest revision at or before it.
+        """
+        since = since.strip().replace(" ", "+")  # "+" in an unescaped offset
+        if since.isdigit():
+            qs = cls.objects.filter(version=int(since))
+        else:
+            moment = parse_datetime(since)
+            if moment is None:
+                return None
+            if timezone.is_naive(moment):
+                moment = timezone.make_aware(moment, datetime.timezone.utc)
+            qs = cls.objects.filter(timestamp__lte=moment).order_by("-version")
+        return qs.values_list("version", flat=True).first()
+
+    def __str__(self):
+        return f"Revision {self.version} @ {self.timestamp}"
+
+
+class RefreshJob(models.Model):
+    """Queued refresh run, executed by `manage.py run_refresh_worker`.
+
+    /api/refresh/ only enqueues (when REFRESH_USE_WORKER is set), so the
+    web request returns at once and the refresh runs in its own process.
+    """
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+    status = models.CharField(max_length=10, default=QUEUED)
+    source = models.CharField(max_length=20, default="cron")  # cron, schedule, manual
+    requested_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    summary = models.JSONField(default=dict, blank=True)
+    error = models.TextField(blank=True)
+
+    STALE_AFTER = datetime.timedelta(minutes=15)  # Running longer = worker died
+    RETENTION = datetime.timedelta(days=7)
+
+    class Meta:
+        constraints = [
+            # At most one queued job: concurrent enqueues can't both insert
+            models.UniqueConstraint(
+                fields=["status"], condition=models.Q(status="queued"), name="refreshjob_one_queued",
+            ),
+        ]
+        indexes = [
+            models.Index(fields=["status", "requested_at"]),
+        ]
+
+    @classmethod
+    def enqueue(cls, source="cron"):
+        """Queue a refresh unless one is already waiting. Returns (job, created)."""
+        while True:
+            job = cls.objects.filter(status=cls.QUEUED).order_by("id").first()
+            if job is not None:
+                return job, False
+            try:
+                with transaction.atomic():
+                    return cls.objects.create(source=source), True
+            except IntegrityError:
+                continue  # Another request queued one first; return that
+
+    @classmethod
+    def claim(cls):
+        """Mark the oldest queued job running and return it (None if none)."""
+        now = timezone.now()
+        with transaction.atomic():
+            # Jobs left running by a dead worker are given up on
+            cls.objects.filter(status=cls.RUNNING, started_at__lt=now - cls.STALE_AFTER).update(
+                status=cls.FAILED, finished_at=now, error="Worker stopped before finishing")
+            job = (
+                cls.objects.select_for_update(skip_locked=True)
+                .filter(status=cls.QUEUED).order_by("id").first()
+            )
+            if job is None:
+                return None
+            job.status = cls.RUNNING
+            job.started_at = now
+            job.save(update_fields=["status", "started_at"])
+        return job
+
+    def finish(self, summary=None, error=""):
+        self.status = self.FAILED if error else self.DONE
+        self.summary = summary or {}
+        self.error = error
+        self.finished_at = timezone.now()
+        self.save(update_fields=["status", "summary", "error", "finished_at"])
+
+    @classmethod
+    def last_requested_at(cls):
+        return cls.objects.order_by("-id").values_list("requested_at", flat=True).first()
+
+    @classmethod
+    def purge(cls, now=None):
+        cutoff = (now or timezone.now()) - cls.RETENTION
+        return cls.objects.filter(requested_at__lt=cutoff).exclude(
+            status__in=[cls.QUEUED, cls.RUNNING]).delete()[0]
+
+    def __str__(self):
+        return f"Refresh #{self.id} ({self.status})"
+
+
+class CityAlertState(models.Model):
+    """Last alert level per city, for detecting transitions between refreshes.
+
+    See dashboard/alerts.py for how levels move and which changes are
+    announced as events.
+    """
+    city = models.CharField(max_length=50, unique=True)
+    level = models.CharField(max_length=20, default="LOW")            # Level at the last refresh
+    announced_level = models.CharField(max_length=20, default="LOW")  # Level of the last event
+    peak_level = models.CharField(max_length=20, default="LOW")       # Highest level this event
+    event_started_at = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.city}: {self.level}"
 
 
 class Suggestion(models.Model):
@@ -161,7 +415,150 @@ class DeviceToken(models.Model):
         return f"{self.platform}: {self.token[:20]}..."
 
 
+class DeviceSubscription(models.Model):
+    """One row per (device, city) a device gets alerts for.
+
+    Indexed copy of DeviceToken.cities used to target pushes: an alert
+    query reads only the devices subscribed to that city or to all cities
+    (city=ALL_CITIES, stored for an empty cities list).
+    """
+    ALL_CITIES = "*"
+
+    device = models.ForeignKey(DeviceToken, on_delete=models.CASCADE, related_name="subscriptions")
+    city = models.CharField(max_length=50)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["device", "city"], name="device_city_uniq"),
+        ]
+        indexes = [
+            models.Index(fields=["city", "device"]),
+        ]
+
+    @classmethod
+    def sync(cls, device, cities):
+        """Replace a device's subscriptions with `cities` (empty = all cities)."""
+        cls.objects.filter(device=device).delete()
+        cls.objects.bulk_create([cls(device=device, city=c) for c in (cities or [cls.ALL_CITIES])])
+
+    @classmethod
+    def tokens_for(cls, city, platform="ios", chunk_size=2000):
+        """Stream the tokens of active devices subscribed to `city`."""
+        return (
+            DeviceToken.objects
+            .filter(is_active=True, platform=platform, subscriptions__city__in=[city, cls.ALL_CITIES])
+            .values_list("token", flat=True)
+            .iterator(chunk_size=chunk_size)
+        )
+
+    def __str__(self):
+        return f"{self.device_id} -> {self.city}"
+
+
+class PushMessage(models.Model):
+    """One notification sent to many devices (payload stored once)."""
+    city = models.CharField(max_length=50)
+    kind = models.CharField(max_length=30)   # e.g. air_quality_alert
+    payload = models.TextField()             # Encoded APNs JSON
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def receipts(self):
+        """Delivery counts for this message: {status: count}."""
+        return dict(
+            self.deliveries.values_list("status").annotate(n=models.Count("id")).order_by()
+        )
+
+    def __str__(self):
+        return f"{self.kind} for {self.city} @ {self.created_at}"
+
+
+class PushOutbox(models.Model):
+    """One pending or finished delivery of a PushMessage to a device token.
+
+    Enqueued in bulk by push.py and drained by `manage.py drain_push_outbox`.
+    The row doubles as the delivery receipt (status, attempts, last_error).
+    """
+    PENDING = "pending"
+    SENT = "sent"
+    FAILED = "failed"       # Permanent error or out of retries
+    INVALID = "invalid"     # Token rejected by APNs; device deactivated
+
+    message = models.ForeignKey(PushMessage, on_delete=models.CASCADE, related_name="deliveries")
+    token = models.CharField(max_length=255)
+    status = models.CharField(max_length=10, default=PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.CharField(max_length=100, blank=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    ENQUEUE_BATCH = 5000
+    RETENTION = datetime.timedelta(days=7)  # Finished rows kept as receipts
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["status", "next_attempt_at"]),
+            models.Index(fields=["token"]),
+        ]
+
+    @classmethod
+    def enqueue(cls, message, tokens):
+        """Queue `message` for every token in the iterable, in bulk. Returns the count."""
+        total = 0
+        batch = []
+        for token in tokens:
+            batch.append(cls(message=message, token=token))
+            if len(batch) >= cls.ENQUEUE_BATCH:
+                cls.objects.bulk_create(batch)
+                total += len(batch)
+                batch = []
+        if batch:
+            cls.objects.bulk_create(batch)
+            total += len(batch)
+        return total
+
+    @classmethod
+    def claim(cls, limit, lease):
+        """Take up to `limit` due rows for sending.
+
+        Pushes their next_attempt_at `lease` into the future, so other
+        workers skip them and a crashed worker's rows come back later.
+        """
+        now = timezone.now()
+        with transaction.atomic():
+            rows = list(
+                # of=("self",): lock only the outbox rows, not the shared PushMessage
+                cls.objects.select_for_update(skip_locked=True, of=("self",))
+                .filter(status=cls.PENDING, next_attempt_at__lte=now)
+                .order_by("next_attempt_at", "id")
+                .select_related("message")[:limit]
+            )
+            if rows:
+                cls.objects.filter(id__in=[r.id for r in rows]).update(next_attempt_at=now + lease)
+        return rows
+
+    @classmethod
+    def purge(cls, now=None):
+        """Delete finished rows older than RETENTION and their empty messages."""
+        cutoff = (now or timezone.now()) - cls.RETENTION
+        # Finished rows have next_attempt_at set to when they finished
+        removed = cls.objects.filter(next_attempt_at__lt=cutoff).exclude(status=cls.PENDING).delete()[0]
+        PushMessage.objects.filter(created_at__lt=cutoff, deliveries__isnull=True).delete()
+        return removed
+
+    def __str__(self):
+        return f"{self.message_id} -> {self.token[:20]}... ({self.status})"
+
+
 @receiver(post_save, sender=User)
 def create_user_profile(sender, instance, created, **kwargs):
     if created:
         UserProfile.objects.create(user=instance)
+
+
+@receiver(post_save, sender=APIKey)
+@receiver(post_delete, sender=APIKey)
+def invalidate_api_key(sender, instance, **kwargs):
+    # Drop the cached lookup on every change, including revocation and the
+    # cascade from deleting the user, so a dead key stops authenticating
+    from . import apikeys
+    apikeys.invalidate(instance.key)
@@ -0,0 +1,329 @@
+"""
+Pre-encoded live API payloads.
+
+Each refresh renders the /api/live/ and /api/v1/live/ response data once
+and stores it in the cache. Both bodies end with "age_seconds", counted in
+AGE_BUCKET steps (the old /api/live/ response cache held the age for as
+long): the first request in a bucket encodes the body as JSON bytes plus
+gzip and brotli variants and caches them, and the views pick a variant
+from Accept-Encoding and return the bytes as-is. Every other request does
+no JSON serialization or per-station formatting.
+
+The exact data age is also sent in the X-Data-Age header. ETags name the
+refresh and the age bucket, so polling clients mostly get 304 Not Modified.
+
+/api/v1/live/?since=<version> bodies (only the stations that changed since
+an earlier refresh) are built from ResultRevision rows the first time a
+given (since, latest) pair is requested and cached without an age.
+"""
+
+import datetime
+import gzip
+import json
+import time
+
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse
+from django.utils.cache import patch_vary_headers
+
+try:
+    import brotli
+except ImportError:  # Optional: serve gzip/identity only
+    brotli = None
+
+
+PAYLOAD_NAMES = ("live", "v1_live")
+CACHE_KEY = "payload:{}"
+AGE_KEY = "payload:{}:{}:{}"  # (name, refresh version, age bucket) -> variants
+VERSION_KEY = "payload:version"  # Timestamp of the refresh the payloads came from
+DELTA_KEY = "payload:v1_delta:{}:{}"  # (since version, latest refresh timestamp)
+# Refreshes overwrite the payloads; the TTL only bounds how stale a
+# process-local cache (LocMemCache without Redis) can get.
+PAYLOAD_TTL = 60
+# Delta keys include the latest refresh, so they never go stale
+DELTA_TTL = 3600
+# age_seconds granularity; each bucket's bodies are encoded once
+AGE_BUCKET = 30
+# Brotli quality for the per-bucket bodies: 9 is ~15x faster than 11 for
+# a few percent more bytes
+AGE_BROTLI_QUALITY = 9
+
+# Level name to integer mapping (matches Toronto PM2.5 Methodology v3.0)
+LEVEL_MAP = {
+    "LOW": 1,
+    "MODERATE": 2,
+    "HIGH": 3,
+    "VERY HIGH": 4,
+    "EXTREME": 5,
+}
+
+
+def format_station_for_api(station_result):
+    """Format a station result for API response with integer level."""
+    level_name = station_result.get("level_name", "NONE")
+    return {
+        "id": station_result.get("id"),
+        "name": station_result.get("station"),
+        "city": station_result.get("target_city"),
+        "lat": station_result.get("lat"),
+        "lon": station_result.get("lon"),
+        "pm25": round(station_result.get("pm25", 0), 1),
+        "predicted": round(station_result.get("predicted", 0), 1),
+        "level": LEVEL_MAP.get(level_name, 0),
+        "level_name": level_name,
+        "health_advisory": station_result.get("health", ""),
+    }
+
+
+def _render(name, results, city_alerts, timestamp, version):
+    if name == "live":
+        return {
+            "results": results,
+            "city_alerts": city_alerts,
+            "timestamp": timestamp,
+        }
+    stations = [format_station_for_api(r) for r in results or []]
+    return {
+        "stations": stations,
+        "count": len(stations),
+        "timestamp": timestamp,
+        "version": version,
+    }
+
+
+def _alert_state(alert):
+    if not alert:
+        return None
+    return {"alert": alert.get("alert", False), "level_name": alert.get("level_name"), "rule": alert.get("rule")}
+
+
+def _render_delta(since, latest):
+    """v1 delta body between two ResultRevision-like objects."""
+    from . import stream
+    changed, removed = stream.diff_results(since.results, latest.results)
+    transitions = []
+    for city in dict.fromkeys([*since.city_alerts, *latest.city_alerts]):
+        before = _alert_state(since.city_alerts.get(city))
+        after = _alert_state(latest.city_alerts.get(city))
+        if before != after:
+            transitions.append({"city": city, "from": before, "to": after})
+    removed_stations = []
+    for key in removed:
+        city, _, sid = key.partition(":")
+        removed_stations.append({"id": sid, "city": city})
+    stations = [format_station_for_api(r) for r in changed]
+    return {
+        "since": since.version,
+        "version": latest.version,
+        "timestamp": latest.timestamp.isoformat(),
+        "stations": stations,
+        "count": len(stations),
+        "removed": removed_stations,
+        "alert_transitions": transitions,
+    }
+
+
+def encode(data, brotli_quality=11):
+    """Encode a dict as JSON bytes with gzip and (if available) brotli variants."""
+    body = json.dumps(data, cls=DjangoJSONEncoder, separators=(",", ":")).encode()
+    variants = {"identity": body, "gzip": gzip.compress(body, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants["br"] = brotli.compress(body, quality=brotli_quality)
+    return variants
+
+
+def build(cached):
+    """Render every payload for a CachedResult-like object."""
+    timestamp = cached.timestamp.isoformat()
+    return {
+        name: {
+            "timestamp": cached.timestamp.timestamp(),
+            "version": cached.version,
+            "data": _render(name, cached.results, cached.city_alerts, timestamp, cached.version),
+        }
+        for name in PAYLOAD_NAMES
+    }
+
+
+def age_bucket(ts, now=None):
+    """Age of refresh `ts` in seconds, rounded down to AGE_BUCKET."""
+    age = max(0, int((time.time() if now is None else now) - ts))
+    return age - age % AGE_BUCKET
+
+
+def variants(name, payload, age):
+    """Encoded bodies of `payload` with "age_seconds": `age` (a bucket)."""
+    key = AGE_KEY.format(name, payload["version"], age)
+    encoded = cache.get(key)
+    if encoded is None:
+        encoded = encode({**payload["data"], "age_seconds": age}, brotli_quality=AGE_BROTLI_QUALITY)
+        cache.set(key, encoded, AGE_BUCKET)
+    return encoded
+
+
+def publish(cached):
+    """Build payloads for a new refresh result and store them in the cache."""
+    built = build(cached)
+    entries = {CACHE_KEY.format(name): payload for name, payload in built.items()}
+    entries[VERSION_KEY] = cached.timestamp.timestamp()
+    cache.set_many(entries, timeout=PAYLOAD_TTL)
+    return built
+
+
+def live_version():
+    """Unix timestamp of the latest refresh, or None if there is none.
+
+    Reads a small cache key, falling back to a query for the timestamp
+    column only, so conditional requests never load the results blob.
+    """
+    ts = cache.get(VERSION_KEY)
+    if ts is None:
+        from .models import CachedResult
+        value = CachedResult.objects.filter(key="latest").values_list("timestamp", flat=True).first()
+        if value is None:
+            return None
+        ts = value.timestamp()
+        cache.set(VERSION_KEY, ts, PAYLOAD_TTL)
+    return ts
+
+
+def get(name, min_version=None):
+    """Return the cached payload, rebuilding it from the database on a miss.
+
+    min_version: also rebuild if the cached payload is from an older
+    refresh (another process's refresh, with a per-process cache).
+    Returns None if there is no refresh result yet.
+    """
+    payload = cache.get(CACHE_KEY.format(name))
+    if payload is None or (min_version is not None and payload.get("version", 0) < min_version):
+        from .models import CachedResult
+        try:
+            cached = CachedResult.objects.get(key="latest")
+        except CachedResult.DoesNotExist:
+            return None
+        payload = publish(cached)[name]
+    return payload
+
+
+def get_delta(since):
+    """Pre-encoded v1 delta from refresh `since` (version or timestamp string).
+
+    Returns None if `since` doesn't name a kept revision (or there is no
+    refresh yet); callers then serve the full payload.
+    """
+    from .models import ResultRevision
+    since = since.strip()
+    since_version = int(since) if since.isdigit() else ResultRevision.resolve(since)
+    ts = live_version()
+    if since_version is None or ts is None:
+        return None
+
+    key = DELTA_KEY.format(since_version, ts)
+    payload = cache.get(key)
+    if payload is None:
+        revisions = list(ResultRevision.objects.filter(version=since_version))
+        latest = ResultRevision.objects.order_by("-version").first()
+        if not revisions or latest is None or latest.version < since_version:
+            return None
+        payload = {
+            "name": f"v1_delta-{since_version}",
+            "timestamp": latest.timestamp.timestamp(),
+            "variants": encode(_render_delta(revisions[0], latest)),
+        }
+        cache.set(key, payload, DELTA_TTL)
+    return payload
+
+
+def _accepted_encodings(request):
+    """Parse Accept-Encoding into the set of codings with q > 0."""
+    accepted = set()
+    for part in request.headers.get("Accept-Encoding", "").split(","):
+        coding, _, params = part.strip().partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if q > 0:
+            accepted.add(coding)
+    return accepted
+
+
+def choose_encoding(request, available=None):
+    """Pick br, gzip or identity for this request's Accept-Encoding."""
+    if available is None:
+        available = ("br", "gzip") if brotli is not None else ("gzip",)
+    accepted = _accepted_encodings(request)
+    for encoding in ("br", "gzip"):
+        if encoding in available and (encoding in accepted or "*" in accepted):
+            return encoding
+    return "identity"
+
+
+def etag(name, ts, encoding, age=None):
+    """ETag for one encoding of a payload built from refresh `ts` (at age bucket `age`)."""
+    if age is None:
+        return f'"{name}-{int(ts * 1000000)}-{encoding}"'
+    return f'"{name}-{int(ts * 1000000)}-{age}-{encoding}"'
+
+
+def conditional(name):
+    """Keyword arguments for django's @condition on a live payload view."""
+    def etag_func(request, *args, **kwargs):
+        ts = live_version()
+        return etag(name, ts, choose_encoding(request), age_bucket(ts)) if ts is not None else None
+
+    def last_modified_func(request, *args, **kwargs):
+        ts = live_version()
+        return datetime.datetime.fromtimestamp(ts, tz=datetime.timezone.utc) if ts is not None else None
+
+    return {"etag_func": etag_func, "last_modified_func": last_modified_func}
+
+
+def stations_conditional():
+    """Keyword arguments for django's @condition on a station list view.
+
+    Station data only changes with the catalog, so its version is the ETag.
+    """
+    from . import services
+
+    def etag_func(request, *args, **kwargs):
+        return f'"stations-{services.station_catalog_version()[0]}"'
+
+    def last_modified_func(request, *args, **kwargs):
+        modified = services.station_catalog_version()[1]
+        return datetime.datetime.fromtimestamp(modified, tz=datetime.timezone.utc)
+
+    return {"etag_func": etag_func, "last_modified_func": last_modified_func}
+
+
+def respond(request, payload, name, status=200):
+    """Return the best pre-encoded variant of `payload` for this request.
+
+    Live payloads get the body for the current age bucket; deltas carry
+    their own "variants" and no age.
+    """
+    now = time.time()
+    age = None
+    encoded = payload.get("variants")
+    if encoded is None:
+        age = age_bucket(payload["timestamp"], now)
+        encoded = variants(name, payload, age)
+    encoding = choose_encoding(request, available=encoded)
+    body = encoded[encoding]
+
+    response = HttpResponse(body, content_type="application/json", status=status)
+    if encoding != "identity":
+        response["Content-Encoding"] = encoding
+    response["Content-Length"] = str(len(body))
+    patch_vary_headers(response, ["Accept-Encoding"])
+    response["ETag"] = etag(name, payload["timestamp"], encoding, age)
+    response["X-Data-Age"] = str(max(0, int(now - payload["timestamp"])))
+    return response
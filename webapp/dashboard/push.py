@@ -1,14 +1,37 @@
 """
 Push notification service for CLEAR25.
 Uses Apple Push Notification service (APNs) for iOS.
+
+Notifications go through one long-lived APNsDispatcher per process: a
+single HTTP/2 client (APNs multiplexes many concurrent streams over one
+connection) with up to MAX_IN_FLIGHT requests outstanding. The provider
+token (ES256 JWT) is signed once and reused for TOKEN_LIFETIME; Apple
+rejects tokens older than an hour and throttles refreshing them more
+often than every 20 minutes. The .p8 key is read once.
+
+Alerts are not sent inline: send_alert_notifications and friends write
+one PushMessage plus one PushOutbox row per device, and a worker
+(`manage.py drain_push_outbox`) sends them with drain_outbox, retrying
+transient failures per device with exponential backoff.
 """
 
+import datetime
 import json
+import logging
 import os
-import jwt
+import random
+import threading
 import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
 import httpx
-from django.conf import settings
+import jwt
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
 
 
 # APNs configuration (set these in environment variables)
@@ -17,36 +40,245 @@ APNS_TEAM_ID = os.environ.get("APNS_TEAM_ID", "")
 APNS_BUNDLE_ID = os.environ.get("APNS_BUNDLE_ID", "com.clear25.app")
 APNS_KEY_PATH = os.environ.get("APNS_KEY_PATH", "")  # Path to .p8 file
 APNS_KEY_CONTENT = os.environ.get("APNS_KEY_CONTENT", "")  # Or key content directly
+APNS_HOST = os.environ.get("APNS_HOST", "")  # Override, e.g. a local mock APNs server
 
 # APNs endpoints
 APNS_HOST_PROD = "https://api.push.apple.com"
 APNS_HOST_DEV = "https://api.sandbox.push.apple.com"
 
+TOKEN_LIFETIME = 50 * 60  # Re-sign the provider token after this many seconds
+MAX_IN_FLIGHT = 100       # Concurrent requests (HTTP/2 streams) per dispatcher
+REQUEST_TIMEOUT = 10.0
+
+_key_content = None
+
+
+def _load_key():
+    """Return the .p8 key content, reading the key file only once."""
+    global _key_content
+    if _key_content is None:
+        key_content = APNS_KEY_CONTENT
+        if not key_content and APNS_KEY_PATH and os.path.exists(APNS_KEY_PATH):
+            with open(APNS_KEY_PATH, "r") as f:
+                key_content = f.read()
+        _key_content = key_content
+    return _key_content or None
+
+
+class ProviderToken:
+    """APNs provider token, signed on first use and every TOKEN_LIFETIME."""
+
+    def __init__(self, key_id, team_id, key_content):
+        self.key_id = key_id
+        self.team_id = team_id
+        self.key_content = key_content
+        self._token = None
+        self._issued_at = 0.0
+        self._lock = threading.Lock()
+
+    def get(self):
+        with self._lock:
+            now = time.time()
+            if self._token is None or now - self._issued_at >= TOKEN_LIFETIME:
+                self._sign(now)
+            return self._token
+
+    def refresh(self, stale):
+        """Re-sign after APNs rejected `stale` (once, however many threads saw it)."""
+        with self._lock:
+            if self._token == stale:
+                self._sign(time.time())
+            return self._token
+
+    def _sign(self, now):
+        headers = {
+            "alg": "ES256",
+            "kid": self.key_id,
+        }
+        payload = {
+            "iss": self.team_id,
+            "iat": int(now),
+        }
+        self._token = jwt.encode(payload, self.key_content, algorithm="ES256", headers=headers)
+        self._issued_at = now
+
+
+_provider_token = None
+
 
 def _get_apns_token():
-    """Generate a JWT token for APNs authentication."""
-    if not all([APNS_KEY_ID, APNS_TEAM_ID]):
+    """Return the cached JWT for APNs authentication (None if not configured)."""
+    global _provider_token
+    key_content = _load_key()
+    if not all([APNS_KEY_ID, APNS_TEAM_ID, key_content]):
         return None
+    if _provider_token is None:
+        _provider_token = ProviderToken(APNS_KEY_ID, APNS_TEAM_ID, key_content)
+    return _provider_token.get()
 
-    # Get the key content
-    key_content = APNS_KEY_CONTENT
-    if not key_content and APNS_KEY_PATH and os.path.exists(APNS_KEY_PATH):
-        with open(APNS_KEY_PATH, "r") as f:
-            key_content = f.read()
-
-    if not key_content:
-        return None
 
-    headers = {
-        "alg": "ES256",
-        "kid": APNS_KEY_ID,
-    }
-    payload = {
-        "iss": APNS_TEAM_ID,
-        "iat": int(time.time()),
+def build_payload(title, body, data=None, badge=None, sound="default"):
+    """APNs JSON payload, encoded once so it can be sent to many devices."""
+    aps = {
+        "alert": {
+            "title": title,
+            "body": body,
+        },
+        "sound": sound,
     }
+    if badge is not None:
+        aps["badge"] = badge
 
-    return jwt.encode(payload, key_content, algorithm="ES256", headers=headers)
+    payload = {"aps": aps}
+    if data:
+        payload.update(data)
+    return json.dumps(payload, separators=(",", ":")).encode()
+
+
+class BatchResult:
+    """Outcome and throughput of one APNsDispatcher.send_many call."""
+
+    def __init__(self):
+        self.sent = 0
+        self.failed = 0
+        self.invalid_tokens = []   # Tokens APNs reported as no longer valid
+        self.errors = Counter()    # Failure reason -> count
+        self.elapsed = 0.0
+
+    @property
+    def per_second(self):
+        return (self.sent + self.failed) / self.elapsed if self.elapsed else 0.0
+
+    def add(self, device_token, success, error):
+        if success:
+            self.sent += 1
+            return
+        self.failed += 1
+        self.errors[error] += 1
+        if error == "token_invalid":
+            self.invalid_tokens.append(device_token)
+
+    def __str__(self):
+        return (f"{self.sent} sent, {self.failed} failed in {self.elapsed:.2f}s "
+                f"({self.per_second:.0f}/s)")
+
+
+class APNsDispatcher:
+    """Sends notifications over one shared HTTP/2 client.
+
+    `transport` (e.g. httpx.MockTransport) and `host` are for testing
+    against a mock APNs; the key and ids default to the APNS_* settings.
+    """
+
+    def __init__(self, host=None, max_in_flight=MAX_IN_FLIGHT, transport=None,
+                 key_content=None, key_id=None, team_id=None, bundle_id=None):
+        use_sandbox = os.environ.get("APNS_SANDBOX", "false").lower() == "true"
+        self.host = host or APNS_HOST or (APNS_HOST_DEV if use_sandbox else APNS_HOST_PROD)
+        self.max_in_flight = max_in_flight
+        self.bundle_id = bundle_id or APNS_BUNDLE_ID
+
+        key_content = key_content or _load_key()
+        key_id = key_id or APNS_KEY_ID
+        team_id = team_id or APNS_TEAM_ID
+        self._token = ProviderToken(key_id, team_id, key_content) if all([key_id, team_id, key_content]) else None
+
+        self._client = httpx.Client(
+            http2=True,
+            transport=transport,
+            timeout=REQUEST_TIMEOUT,
+            limits=httpx.Limits(max_connections=max_in_flight, max_keepalive_connections=max_in_flight),
+        )
+
+    @property
+    def configured(self):
+        return self._token is not None
+
+    def close(self):
+        self._client.close()
+
+    def send(self, device_token, payload):
+        """Send pre-encoded `payload` to one device. Returns (success, error)."""
+        if not self.configured:
+            return False, "APNs not configured"
+
+        url = f"{self.host}/3/device/{device_token}"
+        token = self._token.get()
+        for attempt in range(2):
+            headers = {
+                "authorization": f"bearer {token}",
+                "apns-topic": self.bundle_id,
+                "apns-push-type": "alert",
+                "apns-priority": "10",
+                "content-type": "application/json",
+            }
+            try:
+                response = self._client.post(url, headers=headers, content=payload)
+            except httpx.HTTPError as e:
+                return False, str(e) or e.__class__.__name__
+
+            if response.status_code == 200:
+                return True, None
+            elif response.status_code == 410:
+                # Device token is no longer valid
+                return False, "token_invalid"
+
+            try:
+                reason = response.json().get("reason") if response.content else None
+            except ValueError:
+                reason = None
+            if reason == "ExpiredProviderToken" and attempt == 0:
+                token = self._token.refresh(token)
+                continue
+            return False, reason or f"HTTP {response.status_code}"
+
+    def send_many(self, device_tokens, payload, on_result=None):
+        """Send `payload` to every token with at most max_in_flight outstanding.
+
+        `device_tokens` can be any iterable (e.g. a queryset iterator); it
+        is consumed as requests complete. `on_result(token, success, error)`
+        is called (in the calling thread) for each one. Returns a BatchResult.
+        """
+        result = BatchResult()
+        started = time.perf_counter()
+        tokens = iter(device_tokens)
+
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as pool:
+            pending = {}
+
+            def fill():
+                while len(pending) < self.max_in_flight:
+                    device_token = next(tokens, None)
+                    if device_token is None:
+                        return
+                    pending[pool.submit(self.send, device_token, payload)] = device_token
+
+            fill()
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    device_token = pending.pop(future)
+                    success, error = future.result()
+                    result.add(device_token, success, error)
+                    if on_result is not None:
+                        on_result(device_token, success, error)
+                fill()
+
+        result.elapsed = time.perf_counter() - started
+        logger.info("APNs batch to %s: %s", self.host, result)
+        return result
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+def get_dispatcher():
+    """Return the process-wide dispatcher (and its HTTP/2 connection)."""
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            _dispatcher = APNsDispatcher()
+        return _dispatcher
 
 
 def send_push_notification(device_token, title, body, data=None, badge=None, sound="default"):
@@ -64,56 +296,25 @@ def send_push_notification(device_token, title, body, data=None, badge=None, sou
     Returns:
         (success: bool, error: str or None)
     """
-    token = _get_apns_token()
-    if not token:
-        return False, "APNs not configured"
+    payload = build_payload(title, body, data=data, badge=badge, sound=sound)
+    return get_dispatcher().send(device_token, payload)
 
-    # Build the payload
-    aps = {
-        "alert": {
-            "title": title,
-            "body": body,
-        },
-        "sound": sound,
-    }
-    if badge is not None:
-        aps["badge"] = badge
 
-    payload = {"aps": aps}
-    if data:
-        payload.update(data)
+# Levels worth a push; lower alerts are shown in the app only
+NOTIFY_LEVELS = ("HIGH", "VERY HIGH", "EXTREME")
 
-    # Use production endpoint (change to DEV for testing)
-    use_sandbox = os.environ.get("APNS_SANDBOX", "false").lower() == "true"
-    host = APNS_HOST_DEV if use_sandbox else APNS_HOST_PROD
-    url = f"{host}/3/device/{device_token}"
 
-    headers = {
-        "authorization": f"bearer {token}",
-        "apns-topic": APNS_BUNDLE_ID,
-        "apns-push-type": "alert",
-        "apns-priority": "10",
-    }
+def _enqueue_for_city(city, kind, payload):
+    """Queue `payload` for active iOS devices subscribed to `city` or to all cities.
 
-    try:
-        with httpx.Client(http2=True) as client:
-            response = client.post(
-                url,
-                headers=headers,
-                json=payload,
-                timeout=10.0,
-            )
-
-        if response.status_code == 200:
-            return True, None
-        elif response.status_code == 410:
-            # Device token is no longer valid
-            return False, "token_invalid"
-        else:
-            error_data = response.json() if response.content else {}
-            return False, error_data.get("reason", f"HTTP {response.status_code}")
-    except Exception as e:
-        return False, str(e)
+    Only writes to the outbox (see drain_outbox); nothing is sent here.
+    """
+    from .models import DeviceSubscription, PushMessage, PushOutbox
+
+    if not get_dispatcher().configured:
+        return 0
+    message = PushMessage.objects.create(city=city, kind=kind, payload=payload.decode())
+    return PushOutbox.enqueue(message, DeviceSubscription.tokens_for(city))
 
 
 def send_alert_notifications(city, level_name, pm25_value, health_advisory):
@@ -125,15 +326,13 @@ def send_alert_notifications(city, level_name, pm25_value, health_advisory):
         level_name: Alert level (e.g., "HIGH", "VERY HIGH", "EXTREME")
         pm25_value: Predicted PM2.5 value
         health_advisory: Health advisory text
-    """
-    from .models import DeviceToken
 
+    Returns:
+        Number of deliveries queued
+    """
     # Only send for significant alerts
-    if level_name not in ["HIGH", "VERY HIGH", "EXTREME"]:
-        return 0, 0
-
-    # Get all active device tokens
-    devices = DeviceToken.objects.filter(is_active=True)
+    if level_name not in NOTIFY_LEVELS:
+        return 0
 
     title = f"Air Quality Alert: {city}"
     body = f"{level_name} - PM2.5: {pm25_value:.1f} µg/m³"
@@ -149,32 +348,144 @@ def send_alert_notifications(city, level_name, pm25_value, health_advisory):
         "pm25": pm25_value,
         "type": "air_quality_alert",
     }
+    return _enqueue_for_city(city, "air_quality_alert", build_payload(title, body, data=data))
+
+
+def send_improvement_notifications(city, level_name, pm25_value):
+    """
+    Tell a city's subscribers that an alert they were sent has eased.
+
+    Args:
+        city: City name
+        level_name: New (lower) level; "LOW" means the alert is over
+        pm25_value: Predicted PM2.5 value
+
+    Returns:
+        Number of deliveries queued
+    """
+    if level_name == "LOW":
+        title = f"Air Quality Alert Over: {city}"
+    else:
+        title = f"Air Quality Improving: {city}"
+    body = f"{level_name} - PM2.5: {pm25_value:.1f} µg/m³"
+
+    data = {
+        "city": city,
+        "level": level_name,
+        "pm25": pm25_value,
+        "type": "air_quality_improving",
+    }
+    return _enqueue_for_city(city, "air_quality_improving", build_payload(title, body, data=data))
 
-    sent = 0
-    failed = 0
-    tokens_to_deactivate = []
-
-    for device in devices:
-        # Check if device is subscribed to this city
-        if device.cities and city not in device.cities:
-            continue
-
-        if device.platform == "ios":
-            success, error = send_push_notification(
-                device.token,
-                title,
-                body,
-                data=data,
-            )
-            if success:
-                sent += 1
-            else:
-                failed += 1
-                if error == "token_invalid":
-                    tokens_to_deactivate.append(device.token)
 
-    # Deactivate invalid tokens
-    if tokens_to_deactivate:
-        DeviceToken.objects.filter(token__in=tokens_to_deactivate).update(is_active=False)
+def notify_events(events):
+    """Queue pushes for alert transitions from alerts.detect_transitions.
 
-    return sent, failed
+    Escalations to a NOTIFY_LEVELS level queue an alert; de-escalations
+    from one queue an update. Returns {city: deliveries queued}.
+    """
+    from .alerts import ESCALATION
+
+    results = {}
+    for event in events:
+        pm25 = event.alert.get("predicted_pm25", 0.0)
+        if event.kind == ESCALATION:
+            results[event.city] = send_alert_notifications(
+                event.city, event.to_level, pm25, event.alert.get("health", ""))
+        elif event.from_level in NOTIFY_LEVELS:
+            results[event.city] = send_improvement_notifications(event.city, event.to_level, pm25)
+    return results
+
+
+# ---------------------------------------------------------------------------
+# Outbox draining
+# ---------------------------------------------------------------------------
+
+DRAIN_BATCH = 5000                              # Rows claimed per drain pass
+CLAIM_LEASE = datetime.timedelta(minutes=5)     # Claimed rows retry after this if a worker dies
+MAX_ATTEMPTS = 8
+RETRY_BASE = 30                                 # Seconds; doubled per attempt
+RETRY_MAX = 3600
+
+# APNs reasons that mean the token will never work again
+INVALID_TOKEN_REASONS = {"token_invalid", "BadDeviceToken", "Unregistered", "DeviceTokenNotForTopic"}
+# Reasons that won't succeed on retry (payload/topic problems)
+PERMANENT_REASONS = {
+    "PayloadEmpty", "PayloadTooLarge", "BadTopic", "TopicDisallowed", "MissingTopic",
+    "BadPriority", "BadExpirationDate", "BadCollapseId", "BadMessageId", "DuplicateHeaders",
+}
+# Everything else (TooManyRequests/429, ServiceUnavailable/503, InternalServerError,
+# connection errors, ...) is retried with exponential backoff.
+
+
+def retry_delay(attempts):
+    """Backoff before retry number `attempts` (1-based), with full jitter."""
+    ceiling = min(RETRY_MAX, RETRY_BASE * 2 ** (attempts - 1))
+    return datetime.timedelta(seconds=random.uniform(ceiling / 2, ceiling))
+
+
+def drain_outbox(batch_size=DRAIN_BATCH, dispatcher=None):
+    """Send one batch of due outbox rows and record the outcomes.
+
+    Outcomes are written with a handful of bulk updates: sent rows,
+    invalid tokens (plus deactivating those devices and dropping their
+    other pending rows), permanent failures, and retries grouped by
+    attempt count. Returns a BatchResult (elapsed covers sending only),
+    or None if nothing was due.
+    """
+    from .models import DeviceToken, PushOutbox
+
+    dispatcher = dispatcher or get_dispatcher()
+    rows = PushOutbox.claim(batch_size, CLAIM_LEASE)
+    if not rows:
+        return None
+
+    total = BatchResult()
+    sent, invalid, failed, retry = [], {}, {}, {}
+    by_message = {}
+    for row in rows:
+        by_message.setdefault(row.message_id, (row.message, []))[1].append(row)
+
+    for message, message_rows in by_message.values():
+        by_token = {row.token: row for row in message_rows}
+
+        def record(token, success, error):
+            row = by_token[token]
+            if success:
+                sent.append(row.id)
+            elif error in INVALID_TOKEN_REASONS:
+                invalid.setdefault(error, []).append(row)
+            elif error in PERMANENT_REASONS or row.attempts + 1 >= MAX_ATTEMPTS:
+                failed.setdefault(error[:100], []).append(row.id)
+            else:
+                retry.setdefault((row.attempts + 1, error[:100]), []).append(row.id)
+
+        result = dispatcher.send_many(list(by_token), message.payload.encode(), on_result=record)
+        total.sent += result.sent
+        total.failed += result.failed
+        total.errors.update(result.errors)
+        total.invalid_tokens.extend(result.invalid_tokens)
+        total.elapsed += result.elapsed
+
+    now = timezone.now()
+    with transaction.atomic():
+        if sent:
+            PushOutbox.objects.filter(id__in=sent).update(
+                status=PushOutbox.SENT, sent_at=now, next_attempt_at=now, last_error="")
+        tokens = set()
+        for error, invalid_rows in invalid.items():
+            tokens.update(row.token for row in invalid_rows)
+            PushOutbox.objects.filter(id__in=[row.id for row in invalid_rows]).update(
+                status=PushOutbox.INVALID, next_attempt_at=now, last_error=error)
+        if tokens:
+            # Batched pruning: deactivate and skip the device's other queued pushes
+            DeviceToken.objects.filter(token__in=tokens).update(is_active=False)
+            PushOutbox.objects.filter(token__in=tokens, status=PushOutbox.PENDING).update(
+                status=PushOutbox.INVALID, next_attempt_at=now, last_error="token_invalid")
+        for error, ids in failed.items():
+            PushOutbox.objects.filter(id__in=ids).update(
+                status=PushOutbox.FAILED, attempts=F("attempts") + 1, next_attempt_at=now, last_error=error)
+        for (attempts, error), ids in retry.items():
+            PushOutbox.objects.filter(id__in=ids).update(
+                attempts=attempts, next_attempt_at=now + retry_delay(attempts), last_error=error)
+    return total
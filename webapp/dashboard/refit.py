@@ -0,0 +1,266 @@
+"""
+Refit the station regressions from paired hourly history.
+
+For every candidate station of a city (the "All Stations Data" sheet of its
+workbook) fits PM2.5_city = slope x PM2.5_station + intercept by least
+squares against the city's target station (services.CITIES[...]["naps_id"])
+and reports R, p-value, standard error and N:
+
+  - Hourly stations pair with the city reading of the same hour; daily-mean
+    stations (EPA "Daily", stored at 00:00 UTC) pair with the city's mean
+    over that day (at least MIN_DAILY_HOURS readings).
+  - The history is streamed in blocks (backtest.history_blocks or
+    HistoryStore.blocks) and reduced to running sums per station (n, Σx,
+    Σy, Σx², Σy², Σxy), so every station of every city is fitted with a
+    few array operations per block and memory does not grow with the span.
+  - Stations are kept by the README criteria (R >= MIN_R, p < MAX_P,
+    N >= MIN_N) and tiered by distance (Tier 1 > 250 km, Tier 2 100-250 km;
+    closer stations are excluded, as in the workbooks).
+
+write() saves a result as a versioned coefficient set that
+services.load_stations serves once activated.
+"""
+
+import datetime
+import json
+import math
+import os
+
+import numpy as np
+
+from . import backtest, services
+
+MIN_R = 0.30
+MAX_P = 0.001
+MIN_N = 100
+MIN_DISTANCE_KM = 100   # Closer stations are excluded ("Too close")
+TIER1_KM = 250          # Tier 1 beyond this distance
+MIN_DAILY_HOURS = 18    # City readings needed for a daily mean
+
+
+def _betacf(a, b, x):
+    """Continued fraction for the incomplete beta function (modified Lentz)."""
+    tiny = 1e-300
+    c, d = 1.0, 1.0 - (a + b) * x / (a + 1.0)
+    d = 1.0 / (d if abs(d) > tiny else tiny)
+    h = d
+    for m in range(1, 10000):
+        m2 = 2 * m
+        for num in (m * (b - m) * x / ((a + m2 - 1.0) * (a + m2)),
+                    -(a + m) * (a + b + m) * x / ((a + m2) * (a + m2 + 1.0))):
+            d = 1.0 + num * d
+            d = 1.0 / (d if abs(d) > tiny else tiny)
+            c = 1.0 + num / c
+            c = c if abs(c) > tiny else tiny
+            h *= d * c
+        if abs(d * c - 1.0) < 1e-12:
+            break
+    return h
+
+
+def betainc(a, b, x):
+    """Regularized incomplete beta function I_x(a, b)."""
+    if x <= 0.0:
+        return 0.0
+    if x >= 1.0:
+        return 1.0
+    log_front = (math.lgamma(a + b) - math.lgamma(a) - math.lgamma(b)
+                 + a * math.log(x) + b * math.log1p(-x))
+    if x < (a + 1.0) / (a + b + 2.0):
+        return math.exp(log_front) * _betacf(a, b, x) / a
+    return 1.0 - math.exp(log_front) * _betacf(b, a, 1.0 - x) / b
+
+
+def p_value(r, n):
+    """Two-sided p-value of Pearson's r with n pairs (t test, n - 2 df)."""
+    df = n - 2
+    if df <= 0 or not math.isfinite(r):
+        return 1.0
+    if abs(r) >= 1.0:
+        return 0.0
+    t2 = r * r * df / (1.0 - r * r)
+    return betainc(df / 2.0, 0.5, df / (df + t2))
+
+
+def _daily_mean(y):
+    """Mean of y over [t, t + 24) for every hour t (NaN if too few readings)."""
+    valid = ~np.isnan(y)
+    counts = np.concatenate([[0], np.cumsum(valid)])
+    sums = np.concatenate([[0.0], np.cumsum(np.where(valid, y, 0.0))])
+    end = np.minimum(np.arange(len(y)) + 24, len(y))
+    n = counts[end] - counts[:len(y)]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(n >= MIN_DAILY_HOURS, (sums[end] - sums[:len(y)]) / n, np.nan)
+
+
+class _Sums:
+    """Running least-squares sums for the candidate stations of one city."""
+
+    def __init__(self, columns, daily):
+        self.columns = columns     # Block columns of the candidates
+        self.daily = daily         # Per candidate: pairs with the daily city mean
+        k = len(columns)
+        self.n = np.zeros(k, dtype=np.int64)
+        self.sx, self.sy, self.sxx, self.syy, self.sxy = (np.zeros(k) for _ in range(5))
+
+    def add(self, x, y_hourly, y_daily):
+        """x: [hours, candidates]; y_*: [hours] city readings for the same hours."""
+        y = np.where(self.daily[None, :], y_daily[:, None], y_hourly[:, None])
+        pair = ~(np.isnan(x) | np.isnan(y))
+        x = np.where(pair, x, 0.0)
+        y = np.where(pair, y, 0.0)
+        self.n += pair.sum(axis=0)
+        self.sx += x.sum(axis=0)
+        self.sy += y.sum(axis=0)
+        self.sxx += np.einsum("ij,ij->j", x, x)
+        self.syy += np.einsum("ij,ij->j", y, y)
+        self.sxy += np.einsum("ij,ij->j", x, y)
+
+    def fit(self):
+        """(slope, intercept, R, std error, n) arrays; NaN where undefined."""
+        n = self.n.astype(np.float64)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            sxx = self.sxx - self.sx * self.sx / n
+            syy = self.syy - self.sy * self.sy / n
+            sxy = self.sxy - self.sx * self.sy / n
+            slope = sxy / sxx
+            intercept = (self.sy - slope * self.sx) / n
+            r = sxy / np.sqrt(sxx * syy)
+            stderr = np.sqrt((1.0 - r * r) * syy / ((n - 2.0) * sxx))
+        return slope, intercept, r, stderr, self.n
+
+
+def tier_for(distance):
+    """README tiers by distance: 1 (> 250 km), 2 (100-250 km), None (too close)."""
+    if distance > TIER1_KM:
+        return 1
+    if distance >= MIN_DISTANCE_KM:
+        return 2
+    return None
+
+
+def refit(blocks_for, cities=None, months=None, min_r=MIN_R, max_p=MAX_P, min_n=MIN_N):
+    """Fit every candidate station of `cities` (default: all).
+
+    blocks_for(station_ids) must return (first_hour, [hours, ids] block)
+    pairs in time order, e.g. backtest.history_blocks or HistoryStore.blocks.
+    months: optional set of months (1-12) to fit on, e.g. the fire season.
+    Returns {city: [row dict, ...]} with every candidate that had data,
+    sorted like the workbooks; row["included"] says whether it meets the
+    criteria.
+    """
+    cities = list(cities or services.CITIES)
+    candidates = {city: services.load_candidate_stations(city) for city in cities}
+    targets = [services.CITIES[city]["naps_id"] for city in cities]
+
+    # Pass 1: the target series (one float per hour and city, so held whole)
+    parts, first_hour = [], None
+    for start, block in blocks_for(targets):
+        if first_hour is None:
+            first_hour = start
+        if months is not None:
+            in_season = np.isin(backtest.months_of(start, len(block)), list(months))
+            block = np.where(in_season[:, None], block, np.nan)
+        parts.append(block)
+    if first_hour is None:
+        return {city: [] for city in cities}
+    city_pm = np.concatenate(parts)
+    city_daily = np.column_stack([_daily_mean(city_pm[:, c]) for c in range(len(cities))])
+
+    # Pass 2: all candidates at once, accumulated per city
+    ids = list(dict.fromkeys(st["id"] for city in cities for st in candidates[city]))
+    column = {sid: i for i, sid in enumerate(ids)}
+    sums = [
+        _Sums(
+            np.array([column[st["id"]] for st in candidates[city]], dtype=np.int64),
+            np.array([st["data_type"].lower() == "daily" for st in candidates[city]]),
+        )
+        for city in cities
+    ]
+    for start, block in blocks_for(ids):
+        lo = start - first_hour
+        hi = lo + len(block)
+        # Hours outside the target series' span have no city readings to pair with
+        if hi <= 0 or lo >= len(city_pm):
+            continue
+        block = block[max(-lo, 0):len(block) - max(hi - len(city_pm), 0)]
+        lo, hi = max(lo, 0), min(hi, len(city_pm))
+        for c, s in enumerate(sums):
+            s.add(block[:, s.columns], city_pm[lo:hi, c], city_daily[lo:hi, c])
+
+    results = {}
+    for c, city in enumerate(cities):
+        slope, intercept, r, stderr, n = sums[c].fit()
+        rows = []
+        for i, st in enumerate(candidates[city]):
+            if n[i] < 3 or not np.isfinite(r[i]):
+                continue
+            p = p_value(float(r[i]), int(n[i]))
+            tier = tier_for(st["distance"])
+            rows.append(dict(
+                st,
+                tier=tier,
+                R=round(float(r[i]), 4),
+                slope=round(float(slope[i]), 4),
+                intercept=round(float(intercept[i]), 4),
+                p_value=p,
+                std_error=round(float(stderr[i]), 4),
+                n=int(n[i]),
+                included=bool(
+                    tier is not None and st["id"] not in services.EXCLUDED_STATION_IDS
+                    and r[i] >= min_r and p < max_p and n[i] >= min_n
+                ),
+            ))
+        rows.sort(key=lambda row: (row["tier"] or 3, -row["distance"]))
+        results[city] = rows
+    return results
+
+
+def write(results, criteria=None, months=None, version=None, path=None):
+    """Save the included stations of `results` as a coefficient set.
+
+    criteria: {"min_r", "max_p", "min_n"} used for the fit (recorded only).
+    Cities without an included station are left out, so they keep their
+    workbook stations. Returns the version name (default: the UTC time).
+    Activate it with activate().
+    """
+    path = path or services.COEFFICIENTS_DIR
+    now = datetime.datetime.now(datetime.timezone.utc)
+    version = version or now.strftime("%Y%m%dT%H%M%SZ")
+    fields = services.CATALOG_FIELDS
+    results = {city: [row for row in rows if row["included"]] for city, rows in results.items()}
+    results = {city: rows for city, rows in results.items() if rows}
+    data = {
+        "format": services.COEFFICIENTS_FORMAT,
+        "version": version,
+        "created_at": int(now.timestamp()),
+        "criteria": criteria or {"min_r": MIN_R, "max_p": MAX_P, "min_n": MIN_N},
+        "months": sorted(months) if months else None,
+        "fields": fields,
+        "cities": {
+            city: [[row[f] for f in fields] for row in rows]
+            for city, rows in results.items()
+        },
+        "stats": {
+            city: {row["id"]: {"p_value": row["p_value"], "n": row["n"], "std_error": row["std_error"]}
+                   for row in rows}
+            for city, rows in results.items()
+        },
+    }
+    os.makedirs(path, exist_ok=True)
+    tmp = os.path.join(path, f"{version}.json.tmp")
+    with open(tmp, "w") as f:
+        json.dump(data, f, separators=(",", ":"))
+    os.replace(tmp, os.path.join(path, f"{version}.json"))
+    return version
+
+
+def activate(version, path=None):
+    """Make `version` the coefficient set services.load_stations serves."""
+    path = path or services.COEFFICIENTS_DIR
+    if not os.path.exists(os.path.join(path, f"{version}.json")):
+        raise FileNotFoundError(f"No coefficient set {version} in {path}")
+    tmp = os.path.join(path, "CURRENT.tmp")
+    with open(tmp, "w") as f:
+        f.write(version + "\n")
+    os.replace(tmp, os.path.join(path, "CURRENT"))
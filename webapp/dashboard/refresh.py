@@ -0,0 +1,258 @@
+"""
+Refresh pipeline: fetch WAQI readings, evaluate, persist.
+
+Persistence uses a fixed number of queries per refresh no matter how many
+cities are configured: one bulk read of the previous snapshots, then one
+transaction with bulk upserts for snapshots, station mappings, the
+reading history, the cached result and its ResultRevision. The live API
+data is then rendered once (payloads.publish) and the change event
+for SSE clients is published (stream.publish_event). City alert level
+transitions (alerts.py) are the only thing that queues push
+notifications; the transitions and the queued pushes (PushMessage and
+PushOutbox rows, delivered by a separate worker) are written in the same
+transaction, so an announced transition can't lose its pushes.
+
+Overlapping runs (a cron retry while a slow refresh is still waiting on
+WAQI, or the cron and the worker at once) are kept apart twice over:
+  - run_refresh holds a single-flight lock. On PostgreSQL it is a
+    transaction-level advisory lock, shared by every instance and released
+    when the run's transaction ends; elsewhere it is cache.add with a lease (so a crashed
+    run can't block refreshes for longer than LOCK_LEASE), shared only when
+    the cache is. A run that can't get it returns without fetching.
+  - The write is fenced on CachedResult.version: a run only commits if the
+    version is still the one it read before fetching. If the lease expired
+    and a newer run committed first, the older run rolls back instead of
+    overwriting newer results.
+"""
+
+import contextlib
+import datetime
+import os
+import traceback
+import uuid
+import zlib
+
+from django.core.cache import cache
+from django.db import IntegrityError, connection, transaction
+from django.utils import timezone
+
+from . import alerts, payloads, push, services, stream
+from .models import CachedResult, ReadingHistory, ReadingSnapshot, RefreshJob, ResultRevision, StationMapping
+
+# Snapshots in this age range count as "the previous hour" for Rule 2
+PREVIOUS_MIN_AGE = datetime.timedelta(minutes=20)
+PREVIOUS_MAX_AGE = datetime.timedelta(hours=3)
+
+# Single-flight lock. On PostgreSQL: transaction-level advisory lock
+# LOCK_ID, held for the run's transaction. Otherwise the cache key
+# LOCK_KEY, whose lease covers the WAQI deadline plus evaluation and the
+# write; that cache is shared only when REDIS_URL is set, the
+# version fence covers the rest.
+LOCK_KEY = "refresh:lock"
+LOCK_ID = zlib.crc32(LOCK_KEY.encode())
+LOCK_LEASE = services.WAQI_DEADLINE + 75
+
+
+class StaleRefresh(Exception):
+    """A newer refresh committed its results while this one was running."""
+
+
+def refresh_lock():
+    """Hold the refresh lock for the block; yields False if another run has it."""
+    if connection.vendor == "postgresql":
+        return _advisory_lock(LOCK_ID)
+    return _cache_lock()
+
+
+@contextlib.contextmanager
+def _advisory_lock(lock_id):
+    # Transaction-scoped, so it is released at commit or rollback and can't
+    # stay behind on a persistent connection. The run (WAQI fetch included)
+    # happens inside this transaction; save_refresh's atomic() nests as a
+    # savepoint and its on_commit hooks fire when this one commits.
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_try_advisory_xact_lock(%s)", [lock_id])
+            acquired = cursor.fetchone()[0]
+        yield acquired
+
+
+@contextlib.contextmanager
+def _cache_lock():
+    token = uuid.uuid4().hex
+    acquired = cache.add(LOCK_KEY, token, LOCK_LEASE)
+    try:
+        yield acquired
+    finally:
+        # Only release our own lease, not one taken after ours expired
+        if acquired and cache.get(LOCK_KEY) == token:
+            cache.delete(LOCK_KEY)
+
+
+def current_version():
+    """Version of the stored results (0 before the first refresh)."""
+    return CachedResult.objects.filter(key="latest").values_list("version", flat=True).first() or 0
+
+
+def load_previous_readings(cities, now):
+    """Merge the previous readings of all cities in a single query."""
+    previous = {}
+    snapshots = ReadingSnapshot.objects.filter(city__in=list(cities)).values_list("readings", "timestamp")
+    for readings, timestamp in snapshots:
+        if PREVIOUS_MIN_AGE <= now - timestamp <= PREVIOUS_MAX_AGE:
+            previous.update(readings)
+    return previous
+
+
+def readings_by_city(stations, readings):
+    """Group readings by target city: {city: {station_id: pm25}}."""
+    city_readings = {}
+    for st in stations:
+        sid = st["id"]
+        if sid in readings:
+            city_readings.setdefault(st.get("target_city", ""), {})[sid] = readings[sid]
+    return city_readings
+
+
+def _write_result(expected_version, result, readings):
+    """Store the new CachedResult only if it is still at `expected_version`.
+
+    Returns (cached, previous results); raises StaleRefresh otherwise.
+    """
+    previous_results = (
+        CachedResult.objects.select_for_update()
+        .filter(key="latest", version=expected_version).values_list("results", flat=True).first()
+    )
+    cached = CachedResult(
+        key="latest",
+        results=result["stations"],
+        city_alerts=result["city_alerts"],
+        readings=readings,
+        version=expected_version + 1,
+        timestamp=timezone.now(),
+    )
+    fields = ["results", "city_alerts", "readings", "timestamp", "version"]
+    updated = CachedResult.objects.filter(key="latest", version=expected_version).update(
+        **{f: getattr(cached, f) for f in fields}
+    )
+    if updated:
+        return cached, previous_results
+    if expected_version == 0:
+        # First refresh ever: the unique key makes concurrent inserts fail
+        try:
+            with transaction.atomic():
+                cached.save(force_insert=True)
+            return cached, []
+        except IntegrityError:
+            pass
+    raise StaleRefresh(f"results moved past version {expected_version}")
+
+
+def save_refresh(stations, readings, result, now, matched=None, expected_version=None):
+    """Persist one refresh atomically with bulk upserts.
+
+    `expected_version` is the CachedResult version read before fetching;
+    if another refresh committed since, nothing is written and StaleRefresh
+    is raised. Returns the city alert transitions (alerts.AlertEvent) it
+    recorded.
+    """
+    city_readings = readings_by_city(stations, readings)
+    with transaction.atomic():
+        if city_readings:
+            # timestamp is auto_now, so bulk_create stamps it on insert and update
+            ReadingSnapshot.objects.bulk_create(
+                [ReadingSnapshot(city=city, readings=cr) for city, cr in city_readings.items()],
+                update_conflicts=True,
+                unique_fields=["city"],
+                update_fields=["readings", "timestamp"],
+            )
+        StationMapping.record(matched)
+        ReadingHistory.record(
+            [(sid, city, pm) for city, cr in city_readings.items() for sid, pm in cr.items()],
+            observed_at=now,
+        )
+        if expected_version is None:
+            expected_version = current_version()
+        # Raises (rolling back the snapshots and history above) if stale
+        cached, previous_results = _write_result(expected_version, result, readings)
+        ResultRevision.record(cached)
+        event = stream.build_event(cached.version, cached.timestamp, previous_results, result)
+        transitions = alerts.detect_transitions(result["city_alerts"], now)
+        # Queue pushes only on alert level transitions, not on every refresh.
+        # Queued here so they commit (or roll back) with the transitions.
+        push.notify_events(transitions)
+
+        def publish():
+            # Render the live response bodies once, after the data is committed
+            payloads.publish(cached)
+            stream.publish_event(event)
+
+        transaction.on_commit(publish)
+    return transitions
+
+
+def run_refresh(config):
+    """Fetch, evaluate and store the latest readings. Returns a summary dict.
+
+    Skips the run (ok=False, skipped=...) if another refresh holds the lock
+    or committed newer results while this one was fetching.
+    """
+    with refresh_lock() as acquired:
+        if not acquired:
+            return {"ok": False, "skipped": "locked"}
+        try:
+            return _run_refresh(config, current_version())
+        except StaleRefresh:
+            return {"ok": False, "skipped": "stale"}
+
+
+def _run_refresh(config, expected_version):
+    api_key = config.get("api_key", "")
+    stations = services.load_all_stations()
+    now = timezone.now()
+
+    # Resolve known stations by WAQI uid; record new geometric matches
+    mapping = StationMapping.load_current()
+    overrides = services.load_location_mapping(config)
+    mapping.update(overrides)
+    matched = {}
+    readings = services.fetch_latest_pm25(api_key, stations, mapping=mapping, matched=matched)
+    # A stored match whose uid vanished is replaced; manual overrides are not
+    for sid in overrides:
+        matched.pop(sid, None)
+
+    previous_readings = load_previous_readings(services.CITIES, now)
+    result = services.evaluate(stations, readings, previous_readings=previous_readings)
+
+    transitions = save_refresh(stations, readings, result, now, matched=matched,
+                               expected_version=expected_version)
+
+    return {
+        "ok": True,
+        "version": expected_version + 1,
+        "stations_fetched": len(readings),
+        "stations_evaluated": len(result["stations"]),
+        "alert_transitions": [
+            {"city": e.city, "kind": e.kind, "from": e.from_level, "to": e.to_level} for e in transitions
+        ],
+    }
+
+
+def use_worker():
+    """True if /api/refresh/ should enqueue a RefreshJob instead of running inline."""
+    return os.environ.get("REFRESH_USE_WORKER", "").lower() in ("1", "true", "yes")
+
+
+def run_next_job():
+    """Run the oldest queued RefreshJob, if any. Returns the job or None."""
+    job = RefreshJob.claim()
+    if job is None:
+        return None
+    try:
+        config = services.load_config()
+        if not config.get("api_key"):
+            raise ValueError("No WAQI API token configured")
+        job.finish(run_refresh(config))
+    except Exception:
+        job.finish(error=traceback.format_exc())
+    return job
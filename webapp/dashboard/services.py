@@ -3,14 +3,21 @@ Core logic for the PM2.5 Early Warning System.
 Loads Excel data, runs regression predictions, fetches live PM2.5 from PurpleAir.
 """
 
+import hashlib
 import json
 import math
 import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
 
-import openpyxl
+import numpy as np
 import requests
+import requests.adapters
 from django.conf import settings
 
+from . import engine, history_store
+
 DATA_DIR = settings.DATA_DIR
 CONFIG_PATH = os.path.join(DATA_DIR, "config.json")
 
@@ -56,11 +63,12 @@ CONFIRMATION_WINDOW_HOURS = 96  # 4 days - Time for intermediate confirmation (R
 # Station IDs to exclude (too far from target city to be useful)
 EXCLUDED_STATION_IDS = {"50308", "50310", "50314"}
 
+# naps_id: the city's target station in the regressions (ground truth for backtests)
 CITIES = {
-    "Toronto":   {"label": "Toronto",   "lat": 43.7479, "lon": -79.2741},
-    "Montreal":  {"label": "Montréal",  "lat": 45.5027, "lon": -73.6639},
-    "Edmonton":  {"label": "Edmonton",  "lat": 53.5482, "lon": -113.3681},
-    "Vancouver": {"label": "Vancouver", "lat": 49.3686, "lon": -123.2767},
+    "Toronto":   {"label": "Toronto",   "lat": 43.7479, "lon": -79.2741,  "naps_id": "60410"},
+    "Montreal":  {"label": "Montréal",  "lat": 45.5027, "lon": -73.6639,  "naps_id": "50109"},
+    "Edmonton":  {"label": "Edmonton",  "lat": 53.5482, "lon": -113.3681, "naps_id": "90121"},
+    "Vancouver": {"label": "Vancouver", "lat": 49.3686, "lon": -123.2767, "naps_id": "100138"},
 }
 
 DEMO_DATA = {
@@ -101,17 +109,25 @@ def _find_col(headers, *candidates):
 _station_cache = {}
 
 
-def load_stations(city_key):
-    if city_key in _station_cache:
-        return _station_cache[city_key]
+def _workbook_path(city_key):
+    return os.path.join(DATA_DIR, f"{city_key}_PM25_EWS_Regression.xlsx")
 
-    fn = os.path.join(DATA_DIR, f"{city_key}_PM25_EWS_Regression.xlsx")
+
+def _parse_workbook(city_key):
+    """Parse a city's regression workbook into a sorted station list.
+
+    Reads "Included Stations" and "All Stations Data" from a single open
+    workbook. Returns None if the workbook does not exist.
+    """
+    fn = _workbook_path(city_key)
     if not os.path.exists(fn):
-        return []
+        return None
+
+    import openpyxl  # only needed when the catalog is missing or stale
 
     wb = openpyxl.load_workbook(fn, read_only=True, data_only=True)
-    ws = wb["Included Stations"]
-    rows = list(ws.iter_rows(values_only=True))
+    rows = list(wb["Included Stations"].iter_rows(values_only=True))
+    coord_rows = list(wb["All Stations Data"].iter_rows(values_only=True))
     wb.close()
 
     if len(rows) < 3:
@@ -160,8 +176,8 @@ def load_stations(city_key):
         except (ValueError, TypeError):
             continue
 
-    # Load lat/lon from All Stations Data sheet
-    coord_map = _load_coords(city_key)
+    # Attach lat/lon from All Stations Data sheet
+    coord_map = _parse_coords(coord_rows)
     for st in stations:
         c = coord_map.get(st["id"])
         if c:
@@ -172,6 +188,254 @@ def load_stations(city_key):
             st["lon"] = None
 
     stations.sort(key=lambda s: (s["tier"], -s["distance"]))
+    return stations
+
+
+def _parse_coords(rows):
+    """Parse 'All Stations Data' rows. Returns {station_id: (lat, lon)}."""
+    if len(rows) < 3:
+        return {}
+
+    headers = [str(h).strip() if h else "" for h in rows[1]]
+    col_id = _find_col(headers, "station id")
+    col_lat = _find_col(headers, "lat")
+    col_lon = _find_col(headers, "lon")
+
+    coords = {}
+    for row in rows[2:]:
+        if row[col_id] is None:
+            continue
+        sid = str(row[col_id]).strip()
+        try:
+            lat = float(row[col_lat])
+            lon = float(row[col_lon])
+            coords[sid] = (lat, lon)
+        except (ValueError, TypeError):
+            continue
+    return coords
+
+
+def load_candidate_stations(city_key):
+    """Every station analysed for a city ("All Stations Data"), included or not.
+
+    Used by the offline history tools (ingestion, refits), so it reads the
+    workbook directly rather than the catalog. Returns [] without a workbook.
+    """
+    cache_key = f"{city_key}:candidates"
+    if cache_key in _station_cache:
+        return _station_cache[cache_key]
+    fn = _workbook_path(city_key)
+    if not os.path.exists(fn):
+        return []
+
+    import openpyxl
+
+    wb = openpyxl.load_workbook(fn, read_only=True, data_only=True)
+    rows = list(wb["All Stations Data"].iter_rows(values_only=True))
+    wb.close()
+    if len(rows) < 3:
+        return []
+
+    headers = [str(h).strip() if h else "" for h in rows[1]]
+    col_id = _find_col(headers, "station id")
+    col_city = _find_col(headers, "city")
+    col_lat = _find_col(headers, "lat")
+    col_lon = _find_col(headers, "lon")
+    col_dist = _find_col(headers, "distance")
+    col_dir = _find_col(headers, "direction")
+    col_dtype = _find_col(headers, "data type")
+
+    stations = []
+    for row in rows[2:]:
+        if row[col_id] is None or not str(row[col_id]).strip():
+            continue
+        try:
+            stations.append({
+                "id": str(row[col_id]).strip(),
+                "city_name": str(row[col_city] or ""),
+                "lat": float(row[col_lat]),
+                "lon": float(row[col_lon]),
+                "distance": float(row[col_dist]) if row[col_dist] else 0,
+                "direction": str(row[col_dir] or ""),
+                "data_type": str(row[col_dtype] or "") if col_dtype is not None else "Hourly",
+            })
+        except (ValueError, TypeError):
+            continue
+    _station_cache[cache_key] = stations
+    return stations
+
+
+# ---------------------------------------------------------------------------
+# Station catalog (precompiled at build time)
+# ---------------------------------------------------------------------------
+# `manage.py build_station_catalog` compiles every regression workbook into
+# one JSON file so cold starts don't pay for openpyxl. Each city is stored as
+# a field list plus rows. The catalog records a SHA-256 of every source
+# workbook; if a workbook changes (or CATALOG_FORMAT is bumped) the catalog
+# is considered stale and we fall back to parsing Excel.
+
+CATALOG_PATH = os.path.join(DATA_DIR, "station_catalog.json")
+CATALOG_FORMAT = 1
+CATALOG_FIELDS = [
+    "id", "city_name", "distance", "direction", "tier",
+    "R", "slope", "intercept", "data_type", "lat", "lon",
+]
+
+# None = not loaded yet, False = missing/stale, dict = valid catalog
+_catalog = None
+
+
+def _file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(65536), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def build_station_catalog():
+    """Parse all regression workbooks into a catalog dict (see CATALOG_PATH)."""
+    sources = {}
+    cities = {}
+    for city_key in CITIES:
+        stations = _parse_workbook(city_key)
+        if stations is None:
+            continue
+        fn = _workbook_path(city_key)
+        sources[os.path.basename(fn)] = _file_sha256(fn)
+        cities[city_key] = [[st[f] for f in CATALOG_FIELDS] for st in stations]
+    return {
+        "format": CATALOG_FORMAT,
+        "generated_at": int(time.time()),
+        "excluded": sorted(EXCLUDED_STATION_IDS),
+        "sources": sources,
+        "fields": CATALOG_FIELDS,
+        "cities": cities,
+    }
+
+
+def write_station_catalog(path=CATALOG_PATH):
+    """Build the station catalog and write it to `path`. Returns the catalog."""
+    catalog = build_station_catalog()
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(catalog, f, separators=(",", ":"))
+    os.replace(tmp, path)
+    return catalog
+
+
+def _catalog_is_current(catalog):
+    if catalog.get("format") != CATALOG_FORMAT or catalog.get("fields") != CATALOG_FIELDS:
+        return False
+    if set(catalog.get("excluded", [])) != EXCLUDED_STATION_IDS:
+        return False
+    sources = catalog.get("sources", {})
+    for city_key in CITIES:
+        fn = _workbook_path(city_key)
+        if not os.path.exists(fn):
+            continue
+        if sources.get(os.path.basename(fn)) != _file_sha256(fn):
+            return False
+    return True
+
+
+def load_station_catalog():
+    """Return the precompiled catalog, or None if it is missing or stale."""
+    global _catalog
+    if _catalog is None:
+        try:
+            with open(CATALOG_PATH, "r") as f:
+                catalog = json.load(f)
+            _catalog = catalog if _catalog_is_current(catalog) else False
+        except (FileNotFoundError, json.JSONDecodeError):
+            _catalog = False
+    return _catalog or None
+
+
+_catalog_version = None
+
+
+def station_catalog_version():
+    """Return (version, last_modified) for the station data being served.
+
+    version is a short digest of the source workbook hashes (and the active
+    refitted coefficient version), so it changes whenever any of them
+    changes; last_modified is a Unix timestamp.
+    Used for ETag/Last-Modified on the stations endpoints.
+    """
+    global _catalog_version
+    if _catalog_version is None:
+        catalog = load_station_catalog()
+        if catalog:
+            sources = catalog["sources"]
+            modified = catalog["generated_at"]
+        else:
+            sources, modified = {}, 0
+            for city_key in CITIES:
+                fn = _workbook_path(city_key)
+                if os.path.exists(fn):
+                    sources[os.path.basename(fn)] = _file_sha256(fn)
+                    modified = max(modified, int(os.path.getmtime(fn)))
+        key = [CATALOG_FORMAT, sorted(sources.items())]
+        # A refitted coefficient set changes the stations served, too
+        coefficients = load_coefficients()
+        if coefficients:
+            key.append(coefficients["version"])
+            modified = max(modified, coefficients["created_at"])
+        digest = hashlib.sha256(json.dumps(key).encode()).hexdigest()[:16]
+        _catalog_version = (digest, modified)
+    return _catalog_version
+
+
+# ---------------------------------------------------------------------------
+# Refitted coefficients (`manage.py refit_coefficients`)
+# ---------------------------------------------------------------------------
+# Each refit is written as COEFFICIENTS_DIR/<version>.json (same field/row
+# layout as the catalog, plus p-value, N and standard error per station).
+# The version named in COEFFICIENTS_DIR/CURRENT, if any, replaces the
+# workbook station lists of the cities it covers.
+
+COEFFICIENTS_DIR = os.path.join(DATA_DIR, "coefficients")
+COEFFICIENTS_FORMAT = 1
+
+# None = not loaded yet, False = no active set, dict = active set
+_coefficients = None
+
+
+def load_coefficients():
+    """Return the active refitted coefficient set, or None."""
+    global _coefficients
+    if _coefficients is None:
+        try:
+            with open(os.path.join(COEFFICIENTS_DIR, "CURRENT"), "r") as f:
+                version = f.read().strip()
+            with open(os.path.join(COEFFICIENTS_DIR, f"{version}.json"), "r") as f:
+                coefficients = json.load(f)
+            ok = (coefficients.get("format") == COEFFICIENTS_FORMAT
+                  and coefficients.get("fields") == CATALOG_FIELDS)
+            _coefficients = coefficients if ok else False
+        except (FileNotFoundError, json.JSONDecodeError):
+            _coefficients = False
+    return _coefficients or None
+
+
+def load_stations(city_key):
+    if city_key in _station_cache:
+        return _station_cache[city_key]
+
+    coefficients = load_coefficients()
+    catalog = load_station_catalog()
+    if coefficients and city_key in coefficients["cities"]:
+        fields = coefficients["fields"]
+        stations = [dict(zip(fields, row)) for row in coefficients["cities"][city_key]]
+    elif catalog and city_key in catalog["cities"]:
+        fields = catalog["fields"]
+        stations = [dict(zip(fields, row)) for row in catalog["cities"][city_key]]
+    else:
+        stations = _parse_workbook(city_key)
+        if stations is None:
+            return []
+
     _station_cache[city_key] = stations
     return stations
 
@@ -199,38 +463,6 @@ def get_all_demo_data():
     return merged
 
 
-def _load_coords(city_key):
-    """Load lat/lon from 'All Stations Data' sheet. Returns {station_id: (lat, lon)}."""
-    fn = os.path.join(DATA_DIR, f"{city_key}_PM25_EWS_Regression.xlsx")
-    if not os.path.exists(fn):
-        return {}
-    wb = openpyxl.load_workbook(fn, read_only=True, data_only=True)
-    ws = wb["All Stations Data"]
-    rows = list(ws.iter_rows(values_only=True))
-    wb.close()
-
-    if len(rows) < 3:
-        return {}
-
-    headers = [str(h).strip() if h else "" for h in rows[1]]
-    col_id = _find_col(headers, "station id")
-    col_lat = _find_col(headers, "lat")
-    col_lon = _find_col(headers, "lon")
-
-    coords = {}
-    for row in rows[2:]:
-        if row[col_id] is None:
-            continue
-        sid = str(row[col_id]).strip()
-        try:
-            lat = float(row[col_lat])
-            lon = float(row[col_lon])
-            coords[sid] = (lat, lon)
-        except (ValueError, TypeError):
-            continue
-    return coords
-
-
 # ---------------------------------------------------------------------------
 # Core logic
 # ---------------------------------------------------------------------------
@@ -263,29 +495,93 @@ def lead_time_str(tier, dist):
     return "2-12 hrs"
 
 
-def _weighted_prediction(city_rows):
-    """Calculate R-value weighted average prediction for a city.
+# Vectorized engine inputs (see engine.py)
+DEFAULT_THRESHOLDS = engine.Thresholds(
+    rule1=RULE1_TRIGGER,
+    rule2_distant=RULE2_DISTANT_TRIGGER,
+    rule2_intermediate=RULE2_INTERMEDIATE,
+    rule3=RULE3_CORRIDOR_TRIGGER,
+)
+LEVEL_MINS = np.array([lvl["min"] for lvl in ALERT_LEVELS], dtype=np.float64)
 
-    Stations with higher R-values (better correlation) have more influence.
-    Uses R² as weight to emphasize high-correlation stations even more.
-    Falls back to simple average if no valid R-values.
-    """
-    weighted_sum = 0.0
-    weight_total = 0.0
+# Per-city overrides of the rule thresholds and CITY_ELEVATED_THRESHOLD, as
+# chosen by `manage.py sweep_thresholds --write`:
+#   {"cities": {"Toronto": {"rule1": 45, "rule3": 50, "city_elevated": 20}}}
+THRESHOLDS_PATH = os.path.join(DATA_DIR, "thresholds.json")
+THRESHOLD_FIELDS = engine.Thresholds._fields + ("city_elevated",)
 
-    for r in city_rows:
-        R = r.get("R", 0)
-        pred = r["predicted"]
-        # Use R² as weight (squares emphasize high-R stations)
-        # Minimum weight of 0.1 to include all stations somewhat
-        weight = max(R * R, 0.1)
-        weighted_sum += weight * pred
-        weight_total += weight
+_threshold_overrides = None
+_threshold_cache = {}
 
-    if weight_total > 0:
-        return weighted_sum / weight_total
-    # Fallback to simple average
-    return sum(r["predicted"] for r in city_rows) / len(city_rows) if city_rows else 0
+
+def load_threshold_overrides():
+    """{city: {field: value}} from THRESHOLDS_PATH ({} if there is none)."""
+    global _threshold_overrides
+    if _threshold_overrides is None:
+        try:
+            with open(THRESHOLDS_PATH, "r") as f:
+                _threshold_overrides = json.load(f).get("cities", {})
+        except (FileNotFoundError, json.JSONDecodeError):
+            _threshold_overrides = {}
+    return _threshold_overrides
+
+
+def city_thresholds(city_names):
+    """(engine.Thresholds, city elevated threshold) for cities in this order.
+
+    Fields stay scalars unless a city has overrides, in which case they
+    are arrays with one entry per city (as engine.evaluate_arrays accepts).
+    """
+    key = tuple(city_names)
+    if key not in _threshold_cache:
+        overrides = load_threshold_overrides()
+        if not any(city in overrides for city in city_names):
+            _threshold_cache[key] = (DEFAULT_THRESHOLDS, CITY_ELEVATED_THRESHOLD)
+        else:
+            defaults = dict(DEFAULT_THRESHOLDS._asdict(), city_elevated=CITY_ELEVATED_THRESHOLD)
+            columns = {
+                field: np.array([float(overrides.get(city, {}).get(field, defaults[field]))
+                                 for city in city_names])
+                for field in THRESHOLD_FIELDS
+            }
+            _threshold_cache[key] = (
+                engine.Thresholds(*(columns[f] for f in engine.Thresholds._fields)),
+                columns["city_elevated"],
+            )
+    return _threshold_cache[key]
+
+# StationTable per station list, keyed by id(). The table keeps a reference
+# to its list so the id can't be reused while the entry is alive.
+_table_cache = {}
+_TABLE_CACHE_MAX = 16
+
+
+def station_table(stations):
+    """Return the (cached) column-oriented StationTable for a station list."""
+    table = _table_cache.get(id(stations))
+    if table is None or table.stations is not stations:
+        if len(_table_cache) >= _TABLE_CACHE_MAX:
+            _table_cache.clear()
+        table = engine.StationTable(stations, lead_fn=lead_time_str)
+        _table_cache[id(stations)] = table
+    return table
+
+
+def _city_alert(ev, city, alert):
+    lvl = ALERT_LEVELS[int(ev.city_level[city])] if alert else ALERT_LEVELS[0]
+    weighted = round(float(ev.weighted[city]), 1)
+    return {
+        "alert": alert,
+        "rule": None,
+        "trigger_stations": [],
+        "predicted_pm25": weighted,
+        "weighted_pm25": weighted,
+        "max_pm25": round(float(ev.max_predicted[city]), 1),
+        "level_name": lvl["name"],
+        "level_hex": lvl["hex"],
+        "level_text_color": lvl["text_color"],
+        "health": lvl["health"],
+    }
 
 
 def evaluate(stations, readings, previous_readings=None):
@@ -295,147 +591,94 @@ def evaluate(stations, readings, previous_readings=None):
     - Rule 1: Regional Alert - Any station > 40 µg/m³ (immediate trigger)
     - Rule 2: Distant Sequential - Distant station > 35 µg/m³ + intermediate > 20 µg/m³
     - Rule 3: Corridor Detection - Upwind corridor station > 40 µg/m³
+    (default thresholds; data/thresholds.json can override them per city)
 
     previous_readings: dict of {station_id: pm25} from the previous hour,
                        used for Rule 2 (sequential confirmation).
 
-    Predictions are weighted by R-value (correlation coefficient) so that
-    more reliable stations have greater influence on city-level predictions.
+    Predictions are weighted by R² (minimum weight 0.1) so that more
+    reliable stations have greater influence on city-level predictions.
+
+    The rules run in engine.evaluate_arrays; this function only converts
+    the array result back into the station/city dicts the views return.
     """
-    if previous_readings is None:
-        previous_readings = {}
+    table = station_table(stations)
+    pm = table.gather(readings)
+    prev = table.gather(previous_readings) if previous_readings else None
+    thresholds, _ = city_thresholds(table.city_names)
+    ev = engine.evaluate_arrays(table, pm, prev, thresholds, LEVEL_MINS)
 
-    # Build per-station results
     results = []
-    for st in stations:
-        sid = st["id"]
-        if sid not in readings:
-            continue
-        pm = readings[sid]
-        pred = st["slope"] * pm + st["intercept"]
-        lvl = get_alert_level(pred)
+    for row, pred, lvl_idx in zip(ev.rows.tolist(), ev.predicted.tolist(), ev.level.tolist()):
+        st = stations[row]
+        lvl = ALERT_LEVELS[lvl_idx]
         results.append({
-            "station": st["city_name"], "id": sid,
+            "station": st["city_name"], "id": st["id"],
             "dist": st["distance"], "dir": st["direction"],
-            "tier": st["tier"], "R": st["R"], "pm25": pm,
-            "predicted": round(pred, 1),
+            "tier": st["tier"], "R": st["R"], "pm25": readings[st["id"]],
+            "predicted": pred,
             "level_name": lvl["name"], "level_hex": lvl["hex"],
             "level_text_color": lvl["text_color"], "health": lvl["health"],
-            "lead": lead_time_str(st["tier"], st["distance"]),
+            "lead": table.lead[row],
             "target_city": st.get("target_city", ""),
         })
-    results.sort(key=lambda x: x["predicted"], reverse=True)
-
-    # --- City-level alert determination using 3-rule system ---
-    # Group results by target city
-    city_results = {}
-    for r in results:
-        city = r.get("target_city", "")
-        city_results.setdefault(city, []).append(r)
 
     city_alerts = {}
-    for city, city_rows in city_results.items():
-        alert_triggered = False
-        trigger_rule = None
-        trigger_stations = []
-
-        # Calculate R-weighted prediction for this city
-        weighted_pred = _weighted_prediction(city_rows)
-        max_predicted = max((r["predicted"] for r in city_rows), default=0)
-
-        # Categorize stations by distance (Tier indicates distance range)
-        # Tier 1: 100-600 km (regional) - Rule 1
-        # Tier 2+: Varies by city - can be distant or corridor
-        regional_stations = [r for r in city_rows if r["tier"] == 1 and r["dist"] <= 600]
-        distant_stations = [r for r in city_rows if r["dist"] > 600]
-        corridor_stations = [r for r in city_rows if r["tier"] >= 2 and r["dist"] <= 400]
-
-        # ═══════════════════════════════════════════════════════════════════
-        # Rule 1: Regional Station Alert (100-600 km)
-        # Any regional station > 40 µg/m³ triggers immediate alert
-        # ═══════════════════════════════════════════════════════════════════
-        for r in regional_stations:
-            if r["pm25"] >= RULE1_TRIGGER:
-                alert_triggered = True
-                trigger_rule = "rule1"
-                trigger_stations.append(r["station"])
-                break
-
-        # ═══════════════════════════════════════════════════════════════════
-        # Rule 2: Distant Sequential Detection (600+ km)
-        # Distant station > 35 µg/m³ AND intermediate station > 20 µg/m³
-        # Uses previous readings to confirm smoke is moving toward city
-        # ═══════════════════════════════════════════════════════════════════
-        if not alert_triggered and previous_readings:
-            # Check for distant trigger stations (> 35 µg/m³)
-            distant_triggers = [
-                r for r in distant_stations
-                if r["pm25"] >= RULE2_DISTANT_TRIGGER
-            ]
-            # Check for intermediate confirmation (> 20 µg/m³, sustained)
-            intermediate_confirmed = [
-                r for r in city_rows
-                if 200 <= r["dist"] <= 600  # Intermediate range
-                and r["pm25"] >= RULE2_INTERMEDIATE
-                and previous_readings.get(r["id"], 0) >= RULE2_INTERMEDIATE
+    for city in ev.city_order.tolist():
+        alert = bool(ev.alert[city])
+        entry = _city_alert(ev, city, alert)
+        if alert:
+            entry["rule"] = engine.RULE_NAMES[int(ev.rule[city])]
+            entry["trigger_stations"] = [
+                stations[row]["city_name"]
+                for row in (int(ev.trigger_a[city]), int(ev.trigger_b[city]))
+                if row >= 0
             ]
-            # Need distant trigger AND intermediate confirmation
-            if distant_triggers and intermediate_confirmed:
-                alert_triggered = True
-                trigger_rule = "rule2"
-                trigger_stations = [distant_triggers[0]["station"], intermediate_confirmed[0]["station"]]
-
-        # ═══════════════════════════════════════════════════════════════════
-        # Rule 3: Corridor Detection (upwind stations < 400 km)
-        # Corridor station > 40 µg/m³ indicates smoke entering from
-        # specific direction (e.g., NE for Quebec smoke, NW for Alberta)
-        # ═══════════════════════════════════════════════════════════════════
-        if not alert_triggered:
-            for r in corridor_stations:
-                if r["pm25"] >= RULE3_CORRIDOR_TRIGGER:
-                    alert_triggered = True
-                    trigger_rule = "rule3"
-                    trigger_stations.append(r["station"])
-                    break
-
-        # Use weighted prediction for city-level alert determination
-        alert_prediction = weighted_pred
-
-        if alert_triggered:
-            lvl = get_alert_level(alert_prediction)
-            # Only issue alert if predicted > 20 (above LOW threshold)
-            if lvl["name"] != "LOW":
-                city_alerts[city] = {
-                    "alert": True,
-                    "rule": trigger_rule,
-                    "trigger_stations": trigger_stations,
-                    "predicted_pm25": round(alert_prediction, 1),
-                    "weighted_pm25": round(weighted_pred, 1),
-                    "max_pm25": round(max_predicted, 1),
-                    "level_name": lvl["name"],
-                    "level_hex": lvl["hex"],
-                    "level_text_color": lvl["text_color"],
-                    "health": lvl["health"],
-                }
-
-        if city not in city_alerts:
-            low_lvl = ALERT_LEVELS[0]
-            city_alerts[city] = {
-                "alert": False,
-                "rule": None,
-                "trigger_stations": [],
-                "predicted_pm25": round(weighted_pred, 1),
-                "weighted_pm25": round(weighted_pred, 1),
-                "max_pm25": round(max_predicted, 1),
-                "level_name": low_lvl["name"],
-                "level_hex": low_lvl["hex"],
-                "level_text_color": low_lvl["text_color"],
-                "health": low_lvl["health"],
-            }
+        city_alerts[table.city_names[city]] = entry
 
     return {"stations": results, "city_alerts": city_alerts}
 
 
+# ---------------------------------------------------------------------------
+# Hourly history store (history_store.py)
+# ---------------------------------------------------------------------------
+
+HISTORY_STORE_DIR = os.environ.get("HISTORY_STORE_DIR") or os.path.join(DATA_DIR, "history")
+
+# ((path, meta.json mtime), HistoryStore) of the open store
+_history_store = None
+
+
+def load_history_store(path=HISTORY_STORE_DIR):
+    """Return the memory-mapped hourly history store, or None if not built.
+
+    Opening only reads meta.json and maps the matrix, so this is cheap;
+    the store is reopened when `manage.py build_history_store` replaces it.
+    """
+    global _history_store
+    try:
+        mtime = os.path.getmtime(os.path.join(path, history_store.META_FILE))
+    except OSError:
+        return None
+    if _history_store is None or _history_store[0] != (path, mtime):
+        _history_store = ((path, mtime), history_store.HistoryStore.open(path))
+    return _history_store[1]
+
+
+def history_slices(station_ids, start=None, end=None):
+    """Zero-copy hourly PM2.5 series from the history store.
+
+    start/end: datetimes (naive = UTC) or epoch hours, end exclusive.
+    Returns (first_hour, {station_id: float32 view}) with NaN for missing
+    hours; stations not in the store are left out. (None, {}) if there is
+    no store.
+    """
+    store = load_history_store()
+    if store is None:
+        return None, {}
+    return store.select(station_ids, start, end)
+
+
 # ---------------------------------------------------------------------------
 # WAQI (World Air Quality Index) — aqicn.org
 # ---------------------------------------------------------------------------
@@ -466,15 +709,29 @@ def _aqi_to_ugm3(aqi):
 
 
 def load_config():
-    # Prefer environment variable over config file
-    if os.environ.get("WAQI_API_TOKEN"):
-        return {"api_key": os.environ["WAQI_API_TOKEN"]}
+    config = {}
     try:
         with open(CONFIG_PATH, "r") as f:
-            return json.load(f)
+            config = json.load(f)
     except (FileNotFoundError, json.JSONDecodeError):
         pass
-    return {}
+    # Prefer environment variable over config file
+    if os.environ.get("WAQI_API_TOKEN"):
+        config["api_key"] = os.environ["WAQI_API_TOKEN"]
+    return config
+
+
+def load_location_mapping(config=None):
+    """Manual {station_id: waqi_uid} overrides from config.json's location_mapping."""
+    if config is None:
+        config = load_config()
+    mapping = {}
+    for sid, uid in (config.get("location_mapping") or {}).items():
+        try:
+            mapping[str(sid)] = int(uid)
+        except (TypeError, ValueError):
+            continue
+    return mapping
 
 
 def _haversine(lat1, lon1, lat2, lon2):
@@ -486,25 +743,129 @@ def _haversine(lat1, lon1, lat2, lon2):
     return R * 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
 
 
-def _fetch_waqi_bbox(token, lat1, lng1, lat2, lng2):
-    """Fetch WAQI stations within a bounding box. Returns list of station dicts."""
-    try:
-        resp = requests.get(
-            f"{WAQI_BASE}/v2/map/bounds",
-            params={
-                "latlng": f"{lat1},{lng1},{lat2},{lng2}",
-                "networks": "all",
-                "token": token,
-            },
-            timeout=30,
+MATCH_RADIUS_KM = 30  # Max distance between one of our stations and a WAQI station
+_KM_PER_DEG_LAT = 111.195
+
+
+class WaqiIndex:
+    """Lat/lon grid over WAQI stations for "nearest within N km" lookups.
+
+    Built once per bbox response. Stations are bucketed into CELL_DEG
+    cells, so a lookup only measures the handful of stations in the cells
+    that can lie within the radius instead of every station returned.
+    """
+
+    CELL_DEG = 0.5
+
+    def __init__(self, waqi_stations, cell_deg=CELL_DEG):
+        self.stations = waqi_stations
+        self.cell_deg = cell_deg
+        self._n_lon = int(round(360 / cell_deg))
+        self._cells = {}
+        for i, ws in enumerate(waqi_stations):
+            self._cells.setdefault(self._cell(ws["lat"], ws["lon"]), []).append(i)
+
+    def _cell(self, lat, lon):
+        return (
+            math.floor(lat / self.cell_deg),
+            math.floor((lon + 180) / self.cell_deg) % self._n_lon,
         )
-        if resp.status_code != 200:
-            return []
-        data = resp.json()
-    except requests.RequestException:
-        return []
 
-    if data.get("status") != "ok":
+    def nearest(self, lat, lon, max_km=MATCH_RADIUS_KM):
+        """Return (station, distance_km) of the nearest station within max_km.
+
+        Returns (None, None) if there is none. Ties go to the station that
+        came first in the response, matching a linear scan.
+        """
+        dlat = max_km / _KM_PER_DEG_LAT
+        # Widest longitude span is at the pole-most edge of the search band
+        cos_lat = math.cos(math.radians(min(90.0, abs(lat) + dlat)))
+        if cos_lat < 1e-6:
+            lon_rings = self._n_lon // 2
+        else:
+            lon_rings = min(self._n_lon // 2, math.ceil(dlat / cos_lat / self.cell_deg))
+        lat_rings = math.ceil(dlat / self.cell_deg)
+
+        row, col = self._cell(lat, lon)
+        best = None  # (distance, index)
+        for r in range(row - lat_rings, row + lat_rings + 1):
+            for c in range(col - lon_rings, col + lon_rings + 1):
+                for i in self._cells.get((r, c % self._n_lon), ()):
+                    ws = self.stations[i]
+                    d = _haversine(lat, lon, ws["lat"], ws["lon"])
+                    if d < max_km and (best is None or (d, i) < best):
+                        best = (d, i)
+        if best is None:
+            return None, None
+        return self.stations[best[1]], best[0]
+
+
+# HTTP behaviour for WAQI requests. Boxes are fetched concurrently over a
+# shared keep-alive pool; each request gets its own timeout, the whole fetch
+# gets WAQI_DEADLINE, and transient failures are retried with jittered
+# exponential backoff while time remains.
+WAQI_TIMEOUT = (5, 20)       # (connect, read) seconds per request
+WAQI_DEADLINE = 45           # seconds for all boxes together
+WAQI_RETRIES = 2             # extra attempts after the first
+WAQI_BACKOFF = 0.5           # base backoff in seconds (doubled per attempt)
+WAQI_MAX_WORKERS = 8
+_RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+_waqi_session = None
+
+
+def _get_waqi_session():
+    """Shared requests session so bbox calls reuse pooled connections."""
+    global _waqi_session
+    if _waqi_session is None:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=WAQI_MAX_WORKERS,
+        )
+        session.mount("https://", adapter)
+        _waqi_session = session
+    return _waqi_session
+
+
+def _fetch_waqi_bbox(token, lat1, lng1, lat2, lng2, deadline=None):
+    """Fetch WAQI stations within a bounding box. Returns list of station dicts.
+
+    deadline: time.monotonic() value after which no new attempt is made
+    (defaults to WAQI_DEADLINE from now).
+    """
+    if deadline is None:
+        deadline = time.monotonic() + WAQI_DEADLINE
+    session = _get_waqi_session()
+
+    data = None
+    for attempt in range(WAQI_RETRIES + 1):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return []
+        timeout = (min(WAQI_TIMEOUT[0], remaining), min(WAQI_TIMEOUT[1], remaining))
+        try:
+            resp = session.get(
+                f"{WAQI_BASE}/v2/map/bounds",
+                params={
+                    "latlng": f"{lat1},{lng1},{lat2},{lng2}",
+                    "networks": "all",
+                    "token": token,
+                },
+                timeout=timeout,
+            )
+            if resp.status_code == 200:
+                data = resp.json()
+                break
+            if resp.status_code not in _RETRY_STATUSES:
+                return []
+        except requests.RequestException:
+            pass
+        if attempt < WAQI_RETRIES:
+            # Full jitter: sleep a random fraction of the exponential step
+            backoff = random.uniform(0, WAQI_BACKOFF * (2 ** attempt))
+            time.sleep(min(backoff, max(0, deadline - time.monotonic())))
+
+    if not data or data.get("status") != "ok":
         return []
 
     result = []
@@ -516,7 +877,9 @@ def _fetch_waqi_bbox(token, lat1, lng1, lat2, lng2):
             lat = entry["lat"]
             lon = entry["lon"]
             pm25 = _aqi_to_ugm3(int(aqi_val))
+            uid = entry.get("uid")
             result.append({
+                "uid": int(uid) if uid is not None else None,
                 "lat": float(lat),
                 "lon": float(lon),
                 "pm25": pm25,
@@ -527,49 +890,152 @@ def _fetch_waqi_bbox(token, lat1, lng1, lat2, lng2):
     return result
 
 
-def fetch_latest_pm25(api_key, stations):
-    """Fetch PM2.5 for stations using per-city WAQI bounding-box queries.
+def _fetch_waqi_bboxes(token, boxes):
+    """Fetch several bounding boxes concurrently.
 
-    Groups stations by target_city and makes one bounding-box request
-    per city. WAQI returns AQI values which are converted to µg/m³.
+    Returns one station list per box, in order. Boxes that fail or don't
+    finish before WAQI_DEADLINE come back as empty lists, so one slow box
+    can't hold up the rest.
     """
-    # Only stations with coordinates
-    with_coords = [s for s in stations if s.get("lat") and s.get("lon")]
-    if not with_coords:
-        return {}
+    if not boxes:
+        return []
+    deadline = time.monotonic() + WAQI_DEADLINE
+    results = [[] for _ in boxes]
+    pool = ThreadPoolExecutor(max_workers=min(WAQI_MAX_WORKERS, len(boxes)))
+    try:
+        futures = {
+            pool.submit(_fetch_waqi_bbox, token, *box, deadline=deadline): i
+            for i, box in enumerate(boxes)
+        }
+        done, _ = wait(futures, timeout=max(0, deadline - time.monotonic()))
+        for future in done:
+            if future.exception() is None:
+                results[futures[future]] = future.result()
+    finally:
+        # Don't block on stragglers; their own timeouts stop at the deadline
+        pool.shutdown(wait=False, cancel_futures=True)
+    return results
+
+
+# Tiled bbox planning: stations are deduplicated by coordinate (shared
+# stations such as 60106 appear under several target cities) and covered
+# by one tight bbox per occupied TILE_DEG grid cell, instead of one huge
+# min/max box per city. Neighbouring tiles are then merged while that adds
+# at most TILE_MERGE_SLACK deg² of extra area, to keep the request count down.
+TILE_DEG = 2.0          # grid cell size used to group stations into tiles
+TILE_PAD = 0.5          # ~55 km padding so WAQI stations within 30 km are included
+TILE_MERGE_SLACK = 2.0  # deg² of extra coverage accepted per merge
+
+
+def _bbox_area(b):
+    return (b[2] - b[0]) * (b[3] - b[1])
+
+
+def _bbox_union(a, b):
+    return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+
+
+def _merge_tiles(tiles, slack):
+    """Greedily merge the pair of tiles whose union wastes the least area."""
+    tiles = list(tiles)
+    while len(tiles) > 1:
+        best = None
+        for i in range(len(tiles)):
+            for j in range(i + 1, len(tiles)):
+                waste = (_bbox_area(_bbox_union(tiles[i], tiles[j]))
+                         - _bbox_area(tiles[i]) - _bbox_area(tiles[j]))
+                if waste <= slack and (best is None or waste < best[0]):
+                    best = (waste, i, j)
+        if best is None:
+            break
+        _, i, j = best
+        merged = _bbox_union(tiles[i], tiles[j])
+        tiles = [t for k, t in enumerate(tiles) if k not in (i, j)] + [merged]
+    return tiles
 
-    # Group stations by target city
-    city_groups = {}
-    for s in with_coords:
-        city = s.get("target_city", "")
-        city_groups.setdefault(city, []).append(s)
 
-    readings = {}
-    pad = 0.5  # ~55 km padding
-
-    for city, city_stations in city_groups.items():
-        lats = [s["lat"] for s in city_stations]
-        lons = [s["lon"] for s in city_stations]
-        # WAQI bbox: lat1,lng1 = SW corner, lat2,lng2 = NE corner
-        lat1 = min(lats) - pad
-        lng1 = min(lons) - pad
-        lat2 = max(lats) + pad
-        lng2 = max(lons) + pad
-
-        waqi_stations = _fetch_waqi_bbox(api_key, lat1, lng1, lat2, lng2)
-        if not waqi_stations:
+def plan_waqi_tiles(stations, tile_deg=TILE_DEG, pad=TILE_PAD, merge_slack=TILE_MERGE_SLACK):
+    """Cover station coordinates with a small set of bounding boxes.
+
+    Returns (tiles, coord_ids): tiles is a list of (lat1, lng1, lat2, lng2)
+    boxes (SW corner, NE corner) and coord_ids maps each unique
+    (lat, lon) to the station ids located there.
+    """
+    coord_ids = {}
+    for st in stations:
+        if not (st.get("lat") and st.get("lon")):
             continue
+        ids = coord_ids.setdefault((st["lat"], st["lon"]), [])
+        if st["id"] not in ids:
+            ids.append(st["id"])
+
+    cells = {}
+    for lat, lon in coord_ids:
+        key = (math.floor(lat / tile_deg), math.floor(lon / tile_deg))
+        cells.setdefault(key, []).append((lat, lon))
+
+    tiles = []
+    for key in sorted(cells):
+        lats = [c[0] for c in cells[key]]
+        lons = [c[1] for c in cells[key]]
+        tiles.append((min(lats) - pad, min(lons) - pad, max(lats) + pad, max(lons) + pad))
+    return _merge_tiles(tiles, merge_slack), coord_ids
+
+
+def fetch_latest_pm25(api_key, stations, mapping=None, matched=None):
+    """Fetch PM2.5 for stations using tiled WAQI bounding-box queries.
+
+    Station coordinates are deduplicated across target cities and
+    covered by small tiles (see plan_waqi_tiles), which are fetched in
+    parallel. WAQI returns AQI values which are converted to µg/m³.
+
+    mapping: optional {station_id: waqi_uid}. Mapped stations are read
+             straight from the payload by uid. Unmapped stations (or ones
+             whose uid is missing from this payload) are matched to the
+             nearest WAQI station within 30 km.
+    matched: optional dict; every geometric match (unmapped stations, and
+             mapped ones whose uid was missing so the stale mapping gets
+             replaced) is added to it as {station_id: (waqi_uid,
+             distance_km)} so the caller can persist them.
+
+    Each reading is fanned back out to every station id at that location.
+    """
+    mapping = mapping or {}
+    tiles, coord_ids = plan_waqi_tiles(stations)
+    if not tiles:
+        return {}
+
+    # Tiles overlap at their padded edges; keep each WAQI station once
+    waqi_stations = []
+    by_uid = {}
+    seen = set()
+    for tile_stations in _fetch_waqi_bboxes(api_key, tiles):
+        for ws in tile_stations:
+            key = ws["uid"] if ws["uid"] is not None else (ws["lat"], ws["lon"], ws["name"])
+            if key not in seen:
+                seen.add(key)
+                waqi_stations.append(ws)
+                if ws["uid"] is not None:
+                    by_uid[ws["uid"]] = ws
+    if not waqi_stations:
+        return {}
 
-        # Match each station to nearest WAQI station within 30 km
-        for st in city_stations:
-            best_dist = 30  # km max
-            best_pm = None
-            for ws in waqi_stations:
-                d = _haversine(st["lat"], st["lon"], ws["lat"], ws["lon"])
-                if d < best_dist:
-                    best_dist = d
-                    best_pm = ws["pm25"]
-            if best_pm is not None:
-                readings[st["id"]] = best_pm
+    readings = {}
+    index = None  # Built only if some location needs a geometric match
+    for (lat, lon), ids in coord_ids.items():
+        uid = next((mapping[sid] for sid in ids if sid in mapping), None)
+        ws = by_uid.get(uid) if uid is not None else None
+        if ws is None:
+            # Match to the nearest WAQI station within 30 km
+            if index is None:
+                index = WaqiIndex(waqi_stations)
+            ws, dist = index.nearest(lat, lon)
+            if ws is None:
+                continue
+            if matched is not None and ws["uid"] is not None:
+                for sid in ids:
+                    matched[sid] = (ws["uid"], round(dist, 2))
+        for sid in ids:
+            readings[sid] = ws["pm25"]
 
     return readings
@@ -8,6 +8,8 @@ let map = null;
 let mapMarkers = [];
 let lastResults = null;
 let lastCityAlerts = null;
+let liveData = null;        // Latest live payload, kept current by the SSE stream
+let showingLive = false;    // False while a demo scenario is displayed
 
 // ═══════════════════════════════════════════════════════════════════════════
 // PUSH NOTIFICATIONS (Capacitor)
@@ -310,6 +312,7 @@ async function runDemo() {
     try {
         const resp = await fetch("/api/demo/");
         const data = await resp.json();
+        showingLive = false;
         handleResults(data.results, "Demo: All cities wildfire scenario", data.city_alerts);
     } catch (e) {
         statusEl.textContent = `Error: ${e}`;
@@ -322,13 +325,7 @@ async function loadLiveData() {
         const resp = await fetch("/api/live/");
         const data = await resp.json();
         if (data.results && data.results.length > 0) {
-            const age = data.age_seconds || 0;
-            const mins = Math.floor(age / 60);
-            let label;
-            if (mins < 1) label = "Live data · just updated";
-            else if (mins < 60) label = `Live data · updated ${mins} min ago`;
-            else label = `Live data · updated ${Math.floor(mins / 60)}h ${mins % 60}m ago`;
-            handleResults(data.results, label, data.city_alerts);
+            showLiveData(data);
             return true;
         }
     } catch (e) { /* ignore */ }
@@ -499,12 +496,60 @@ async function mapRunDemo() {
     try {
         const resp = await fetch("/api/demo/");
         const data = await resp.json();
+        showingLive = false;
         handleResults(data.results, "Demo: All cities", data.city_alerts);
     } catch (e) {
         mapStatus.textContent = `Error: ${e}`;
     }
 }
 
+function showLiveData(data) {
+    liveData = data;
+    showingLive = true;
+    const age = data.age_seconds || 0;
+    const mins = Math.floor(age / 60);
+    let label;
+    if (mins < 1) label = "Live data · just updated";
+    else if (mins < 60) label = `Live data · updated ${mins} min ago`;
+    else label = `Live data · updated ${Math.floor(mins / 60)}h ${mins % 60}m ago`;
+    handleResults(data.results, label, data.city_alerts);
+}
+
+// ---- Live updates (Server-Sent Events) ----
+// /api/live/stream/ sends a "snapshot" (full /api/live/ body) and then an
+// "update" per refresh with only the changed stations, so the page never
+// polls. EventSource reconnects on its own and resumes via Last-Event-ID.
+function stationKey(r) {
+    return `${r.target_city || ""}:${r.id}`;
+}
+
+function applyLiveUpdate(update) {
+    if (!liveData || !liveData.results) return;
+    const byKey = new Map(liveData.results.map((r) => [stationKey(r), r]));
+    for (const key of update.removed || []) byKey.delete(key);
+    for (const r of update.changed || []) byKey.set(stationKey(r), r);
+    // Keep the server's ordering: predicted PM2.5, worst first
+    const results = [...byKey.values()].sort((a, b) => b.predicted - a.predicted);
+    // Updates are sent as soon as a refresh commits
+    receiveLiveData({ results, city_alerts: update.city_alerts, timestamp: update.timestamp, age_seconds: 0 });
+}
+
+function receiveLiveData(data) {
+    // While a demo is displayed, keep the live data current without rendering it
+    if (showingLive || !liveData) showLiveData(data);
+    else liveData = data;
+}
+
+function subscribeLiveUpdates() {
+    if (!window.EventSource) return;
+    const source = new EventSource("/api/live/stream/");
+    source.addEventListener("snapshot", (e) => {
+        const data = JSON.parse(e.data);
+        if (data.results && data.results.length > 0) receiveLiveData(data);
+    });
+    source.addEventListener("update", (e) => applyLiveUpdate(JSON.parse(e.data)));
+}
+
 // Init
 async function init() {
     await loadStations();
@@ -512,6 +557,7 @@ async function init() {
     if (!hasLive) {
         statusEl.textContent = "No live data yet — run demo or wait for next refresh";
     }
+    subscribeLiveUpdates();
     initFeedbackBoard();
     initPushNotifications();
 }
@@ -0,0 +1,199 @@
+"""
+Server-Sent Events for live alert updates (/api/live/stream/).
+
+Each refresh publishes an "update" event with the new city alerts and
+only the stations whose pm25 / predicted / level changed since the
+previous refresh. Events are stored in the cache keyed by the refresh
+version (CachedResult.version), which is also the SSE event id, so a
+reconnecting client's Last-Event-ID can be replayed from there. Clients
+that are too far behind (or new) get one "snapshot" event with the full
+live payload instead. Without a shared cache, events published by another
+process (cron, worker) aren't visible here: the version is re-read from
+the database within LATEST_TTL and clients get a snapshot.
+
+The view is async: idle connections wait on a per-process watcher that
+polls one small cache key, so they hold no worker thread and don't each
+hit the cache. It only works through ews.asgi: a WSGI handler collects
+the whole generator before sending the first byte, so under WSGI the
+view answers 204 instead and clients stay on the one-shot /api/live/.
+"""
+
+import asyncio
+import json
+import time
+import weakref
+
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+
+from . import payloads
+
+LATEST_KEY = "stream:latest"     # Version of the newest published event
+# Short, so a process whose cache isn't shared (LocMemCache without
+# REDIS_URL) re-reads the version from the database soon after a refresh
+# made by another process (cron, worker)
+LATEST_TTL = payloads.PAYLOAD_TTL
+EVENT_KEY = "stream:event:{}"    # Event payload per version
+EVENT_TTL = 6 * 3600             # Events kept for Last-Event-ID replay
+MAX_REPLAY = 12                  # More missed events than this -> snapshot
+
+POLL_SECONDS = 5                 # How often each process checks for a new version
+HEARTBEAT_SECONDS = 15           # Comment line to keep proxies from closing idle streams
+MAX_STREAM_SECONDS = 15 * 60     # Close and let EventSource reconnect with Last-Event-ID
+RETRY_MS = 5000                  # Client reconnect delay
+
+
+def _station_key(r):
+    return f"{r.get('target_city', '')}:{r.get('id')}"
+
+
+def diff_results(previous, current):
+    """Stations in `current` that are new or whose pm25/predicted/level changed.
+
+    Returns (changed_station_dicts, removed_keys) where keys are
+    "target_city:station_id".
+    """
+    before = {
+        _station_key(r): (r.get("pm25"), r.get("predicted"), r.get("level_name"))
+        for r in previous or []
+    }
+    changed = []
+    seen = set()
+    for r in current or []:
+        key = _station_key(r)
+        seen.add(key)
+        if before.get(key) != (r.get("pm25"), r.get("predicted"), r.get("level_name")):
+            changed.append(r)
+    removed = [key for key in before if key not in seen]
+    return changed, removed
+
+
+def build_event(version, timestamp, previous_results, result):
+    changed, removed = diff_results(previous_results, result["stations"])
+    return {
+        "version": version,
+        "timestamp": timestamp.isoformat(),
+        "city_alerts": result["city_alerts"],
+        "changed": changed,
+        "removed": removed,
+    }
+
+
+def publish_event(event):
+    """Store a refresh event and advance the latest version."""
+    cache.set(EVENT_KEY.format(event["version"]), event, EVENT_TTL)
+    cache.set(LATEST_KEY, event["version"], LATEST_TTL)
+
+
+def _db_version():
+    from .models import CachedResult
+    return CachedResult.objects.filter(key="latest").values_list("version", flat=True).first()
+
+
+async def current_version():
+    version = await cache.aget(LATEST_KEY)
+    if version is None:
+        version = await sync_to_async(_db_version)()
+        if version:
+            await cache.aset(LATEST_KEY, version, LATEST_TTL)
+    return version or None
+
+
+class _VersionWatcher:
+    """Polls the latest version once per process and wakes waiting streams."""
+
+    def __init__(self):
+        self.version = None
+        self._changed = asyncio.Event()
+        self._task = None
+
+    def _ensure_running(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                version = await current_version()
+            except Exception:
+                version = None
+            if version is not None and version != self.version:
+                self.version = version
+                self._changed.set()
+                self._changed = asyncio.Event()
+            await asyncio.sleep(POLL_SECONDS)
+
+    async def wait(self, timeout):
+        """Wait up to `timeout` seconds for a new version; return the latest known."""
+        self._ensure_running()
+        changed = self._changed
+        try:
+            await asyncio.wait_for(changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self.version
+
+
+# One watcher per event loop (ASGI servers run one loop per process)
+_watchers = weakref.WeakKeyDictionary()
+
+
+def _watcher():
+    loop = asyncio.get_running_loop()
+    watcher = _watchers.get(loop)
+    if watcher is None:
+        watcher = _watchers[loop] = _VersionWatcher()
+    return watcher
+
+
+def _frame(event, event_id, data):
+    return f"event: {event}\nid: {event_id}\ndata: {data}\n\n"
+
+
+def _snapshot_body(version):
+    payload = payloads.get("live", min_version=version)
+    if payload is None:
+        return None
+    return payloads.variants("live", payload, payloads.age_bucket(payload["timestamp"]))["identity"]
+
+
+async def _snapshot_frame(version):
+    body = await sync_to_async(_snapshot_body)(version)
+    if body is None:
+        return None
+    return _frame("snapshot", version, body.decode())
+
+
+async def _catch_up(sent, latest):
+    """Frames that bring a client from version `sent` to `latest`."""
+    if sent is not None and 0 < latest - sent <= MAX_REPLAY:
+        keys = [EVENT_KEY.format(v) for v in range(sent + 1, latest + 1)]
+        events = await cache.aget_many(keys)
+        if len(events) == len(keys):
+            return [
+                _frame("update", events[k]["version"], json.dumps(events[k], separators=(",", ":")))
+                for k in keys
+            ]
+    frame = await _snapshot_frame(latest)
+    return [frame] if frame else []
+
+
+async def event_stream(last_event_id=None):
+    """Async generator of SSE frames for one client connection."""
+    yield f"retry: {RETRY_MS}\n\n"
+    sent = last_event_id
+    deadline = time.monotonic() + MAX_STREAM_SECONDS
+    latest = await current_version()
+    while True:
+        if latest is not None and (sent is None or latest > sent):
+            for frame in await _catch_up(sent, latest):
+                yield frame
+            sent = latest
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        newest = await _watcher().wait(min(HEARTBEAT_SECONDS, remaining))
+        if newest is not None and (latest is None or newest > latest):
+            latest = newest
+        else:
+            yield ": keepalive\n\n"
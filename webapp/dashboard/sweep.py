@@ -0,0 +1,156 @@
+"""
+Threshold sensitivity sweep over a backtest History.
+
+Scores many threshold sets (grid or random search over
+services.THRESHOLD_FIELDS) against one prepared backtest.History and
+reports, per city, the Pareto front of detection rate against false
+alarm rate. Cities are scored independently, so the best set for each
+city can be picked separately and written to services.THRESHOLDS_PATH.
+
+Each candidate only needs the small [hours, cities] arrays of the
+History, not the raw readings, so the History is handed to every pool
+worker once (by its initializer) and candidates are sent in chunks; the
+work is CPU-bound and independent, so it scales with the worker count.
+Note that city_elevated defines what counts as a smoke event, so
+candidates that differ in it are scored against different events.
+"""
+
+import itertools
+import json
+import os
+import random
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from . import backtest, engine, services
+
+# One threshold set; fields as services.THRESHOLD_FIELDS
+Candidate = namedtuple("Candidate", services.THRESHOLD_FIELDS)
+
+DEFAULT_CANDIDATE = Candidate(*services.DEFAULT_THRESHOLDS, services.CITY_ELEVATED_THRESHOLD)
+
+CHUNK_SIZE = 64   # Candidates per pool task
+
+# Per-city result of one candidate
+Point = namedtuple("Point", [
+    "candidate", "detection_rate", "false_alarm_rate", "events", "warnings", "median_lead",
+])
+
+
+def parse_values(spec):
+    """"30:60:5" (inclusive range), "30,40,50" or "40" -> sorted list of floats."""
+    values = set()
+    for part in spec.split(","):
+        if ":" in part:
+            lo, hi, step = (float(v) for v in part.split(":"))
+            if step <= 0:
+                raise ValueError(f"step must be positive: {part}")
+            values.update(np.round(np.arange(lo, hi + step / 2, step), 6).tolist())
+        else:
+            values.add(float(part))
+    return sorted(values)
+
+
+def candidates(values, samples=None, seed=None):
+    """Candidates from {field: [values]} (missing fields keep their default).
+
+    All combinations, or `samples` distinct random ones.
+    """
+    axes = [values.get(field) or [getattr(DEFAULT_CANDIDATE, field)] for field in Candidate._fields]
+    total = int(np.prod([len(axis) for axis in axes]))
+    if samples is None or samples >= total:
+        return [Candidate(*combo) for combo in itertools.product(*axes)]
+    rng = random.Random(seed)
+    chosen = set()
+    while len(chosen) < samples:
+        chosen.add(tuple(rng.choice(axis) for axis in axes))
+    return [Candidate(*combo) for combo in sorted(chosen)]
+
+
+def score_candidate(history, candidate):
+    """{city: Point} for one candidate."""
+    thresholds = engine.Thresholds(*candidate[:len(engine.Thresholds._fields)])
+    results = backtest.score(history, thresholds, city_threshold=candidate.city_elevated)
+    return {
+        city: Point(
+            candidate, r["detection_rate"], r["false_alarm_rate"], r["events"], r["warnings"],
+            r["lead_hours"]["median"] if r["lead_hours"] else None,
+        )
+        for city, r in results.items()
+    }
+
+
+_history = None
+
+
+def _init_worker(history):
+    global _history
+    _history = history
+
+
+def _score_chunk(chunk):
+    return [score_candidate(_history, candidate) for candidate in chunk]
+
+
+def run(history, candidate_list, workers=None):
+    """Score every candidate; returns {city: [Point, ...]} in candidate order.
+
+    workers: process count (default os.cpu_count(); 1 runs in-process).
+    """
+    workers = workers or os.cpu_count() or 1
+    chunks = [candidate_list[i:i + CHUNK_SIZE] for i in range(0, len(candidate_list), CHUNK_SIZE)]
+    if workers == 1:
+        _init_worker(history)
+        return _collect(map(_score_chunk, chunks))
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(history,)) as pool:
+        return _collect(pool.map(_score_chunk, chunks))
+
+
+def _collect(scored_chunks):
+    points = {}
+    for chunk in scored_chunks:
+        for per_city in chunk:
+            for city, point in per_city.items():
+                points.setdefault(city, []).append(point)
+    return points
+
+
+def pareto_front(points):
+    """Points no other point beats on both detection and false alarm rate.
+
+    Points without events or scored warnings are left out. Sorted by false
+    alarm rate; among equal points the longest median lead is kept.
+    """
+    scored = [p for p in points if p.detection_rate is not None and p.false_alarm_rate is not None]
+    scored.sort(key=lambda p: (p.false_alarm_rate, -p.detection_rate, -(p.median_lead or 0)))
+    front = []
+    for p in scored:
+        if not front or p.detection_rate > front[-1].detection_rate:
+            front.append(p)
+    return front
+
+
+def best(front, max_false_alarm_rate=0.0):
+    """Highest-detection point of a front within the false alarm budget (or None)."""
+    allowed = [p for p in front if p.false_alarm_rate <= max_false_alarm_rate]
+    return allowed[-1] if allowed else None
+
+
+def write_thresholds(choices, path=None):
+    """Write {city: Candidate} to services.THRESHOLDS_PATH (other cities are kept)."""
+    path = path or services.THRESHOLDS_PATH
+    try:
+        with open(path, "r") as f:
+            data = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        data = {}
+    cities = data.setdefault("cities", {})
+    for city, candidate in choices.items():
+        cities[city] = candidate._asdict()
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp, path)
+    return data
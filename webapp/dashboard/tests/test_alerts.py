@@ -0,0 +1,49 @@
+import datetime
+from unittest import mock
+
+from django.test import TestCase
+
+from dashboard import alerts, push
+from dashboard.models import CityAlertState
+
+START = datetime.datetime(2026, 7, 1, tzinfo=datetime.timezone.utc)
+REFRESH = datetime.timedelta(minutes=30)
+
+
+def city_alerts(level):
+    if level == "LOW":
+        return {"Toronto": {"alert": False, "level_name": "LOW", "predicted_pm25": 10.0}}
+    return {"Toronto": {"alert": True, "level_name": level, "predicted_pm25": 70.0}}
+
+
+class AlertTransitionTests(TestCase):
+    def replay(self, levels, start=START):
+        """Run one refresh per level; returns (alert pushes, improvement pushes)."""
+        with mock.patch.object(push, "send_alert_notifications", return_value=1) as alert, \
+                mock.patch.object(push, "send_improvement_notifications", return_value=1) as improving:
+            for i, level in enumerate(levels):
+                push.notify_events(alerts.detect_transitions(city_alerts(level), start + i * REFRESH))
+        return alert.call_count, improving.call_count
+
+    def test_flapping_sends_one_push_per_event(self):
+        # Three days of HIGH / MODERATE flapping every refresh
+        self.assertEqual(self.replay(["HIGH", "MODERATE"] * 72), (1, 0))
+
+    def test_rise_above_peak_is_announced(self):
+        self.assertEqual(self.replay(["HIGH", "MODERATE", "VERY HIGH", "HIGH", "VERY HIGH"]), (2, 0))
+
+    def test_quiet_return_within_cooldown(self):
+        # HIGH, LOW after 6 h, HIGH again at 48 h: subscribers were never told it ended
+        levels = ["HIGH"] + ["LOW"] * 95 + ["HIGH"]
+        self.assertEqual(self.replay(levels), (1, 0))
+
+    def test_de_escalation_after_cooldown(self):
+        cooldown_refreshes = alerts.EVENT_COOLDOWN // REFRESH
+        levels = ["HIGH"] + ["LOW"] * (cooldown_refreshes + 1)
+        self.assertEqual(self.replay(levels), (1, 1))
+        self.assertEqual(CityAlertState.objects.get(city="Toronto").announced_level, "LOW")
+
+    def test_new_event_after_cooldown(self):
+        cooldown_refreshes = alerts.EVENT_COOLDOWN // REFRESH
+        levels = ["HIGH"] + ["LOW"] * (cooldown_refreshes + 1) + ["HIGH", "MODERATE", "HIGH"]
+        self.assertEqual(self.replay(levels), (2, 1))
@@ -0,0 +1,145 @@
+import random
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from dashboard import services
+from dashboard.services import (
+    ALERT_LEVELS, RULE1_TRIGGER, RULE2_DISTANT_TRIGGER, RULE2_INTERMEDIATE, RULE3_CORRIDOR_TRIGGER,
+    get_alert_level, lead_time_str,
+)
+
+SEED = 20250207
+CITIES = ["Toronto", "Montreal", "Ottawa"]
+
+
+def scalar_evaluate(stations, readings, previous_readings=None):
+    """The per-station loop services.evaluate used before engine.py."""
+    previous_readings = previous_readings or {}
+    results = []
+    for st in stations:
+        sid = st["id"]
+        if sid not in readings:
+            continue
+        pm = readings[sid]
+        pred = st["slope"] * pm + st["intercept"]
+        lvl = get_alert_level(pred)
+        results.append({
+            "station": st["city_name"], "id": sid,
+            "dist": st["distance"], "dir": st["direction"],
+            "tier": st["tier"], "R": st["R"], "pm25": pm,
+            "predicted": round(pred, 1),
+            "level_name": lvl["name"], "level_hex": lvl["hex"],
+            "level_text_color": lvl["text_color"], "health": lvl["health"],
+            "lead": lead_time_str(st["tier"], st["distance"]),
+            "target_city": st.get("target_city", ""),
+        })
+    results.sort(key=lambda x: x["predicted"], reverse=True)
+
+    city_results = {}
+    for r in results:
+        city_results.setdefault(r["target_city"], []).append(r)
+
+    city_alerts = {}
+    for city, rows in city_results.items():
+        weight_total = sum(max(r["R"] * r["R"], 0.1) for r in rows)
+        weighted = sum(max(r["R"] * r["R"], 0.1) * r["predicted"] for r in rows) / weight_total
+        rule, triggers = None, []
+        for r in rows:
+            if r["tier"] == 1 and r["dist"] <= 600 and r["pm25"] >= RULE1_TRIGGER:
+                rule, triggers = "rule1", [r["station"]]
+                break
+        if rule is None and previous_readings:
+            distant = [r for r in rows if r["dist"] > 600 and r["pm25"] >= RULE2_DISTANT_TRIGGER]
+            confirmed = [
+                r for r in rows
+                if 200 <= r["dist"] <= 600 and r["pm25"] >= RULE2_INTERMEDIATE
+                and previous_readings.get(r["id"], 0) >= RULE2_INTERMEDIATE
+            ]
+            if distant and confirmed:
+                rule, triggers = "rule2", [distant[0]["station"], confirmed[0]["station"]]
+        if rule is None:
+            for r in rows:
+                if r["tier"] >= 2 and r["dist"] <= 400 and r["pm25"] >= RULE3_CORRIDOR_TRIGGER:
+                    rule, triggers = "rule3", [r["station"]]
+                    break
+
+        lvl = get_alert_level(weighted)
+        alert = rule is not None and lvl["name"] != "LOW"
+        if not alert:
+            lvl, rule, triggers = ALERT_LEVELS[0], None, []
+        city_alerts[city] = {
+            "alert": alert,
+            "rule": rule,
+            "trigger_stations": triggers,
+            "predicted_pm25": round(weighted, 1),
+            "weighted_pm25": round(weighted, 1),
+            "max_pm25": round(max(r["predicted"] for r in rows), 1),
+            "level_name": lvl["name"],
+            "level_hex": lvl["hex"],
+            "level_text_color": lvl["text_color"],
+            "health": lvl["health"],
+        }
+    return {"stations": results, "city_alerts": city_alerts}
+
+
+def random_stations(rng, n):
+    return [
+        {
+            "id": str(60000 + i),
+            "city_name": f"Station {i}",
+            "target_city": rng.choice(CITIES),
+            "tier": rng.choice([1, 1, 2, 3]),
+            "distance": rng.choice([rng.uniform(100, 1500), 200.0, 400.0, 600.0]),
+            "direction": rng.choice(["N", "NE", "W", "SW"]),
+            "R": rng.uniform(0.0, 0.95),
+            "slope": rng.uniform(0.2, 1.2),
+            "intercept": rng.uniform(-2.0, 8.0),
+        }
+        for i in range(n)
+    ]
+
+
+def random_readings(rng, stations, missing=0.2):
+    readings = {}
+    for st in stations:
+        if rng.random() >= missing:
+            # Mostly clean air, sometimes smoke, sometimes exactly on a threshold
+            readings[st["id"]] = rng.choice([
+                round(rng.uniform(0, 25), 1), round(rng.uniform(15, 120), 1),
+                float(rng.choice([20, 35, 40])),
+            ])
+    return readings
+
+
+def random_cases(trials=200):
+    """(trial, stations, readings, previous readings) from a fixed seed."""
+    rng = random.Random(SEED)
+    for trial in range(trials):
+        stations = random_stations(rng, rng.randint(1, 40))
+        readings = random_readings(rng, stations)
+        # Every fourth case has no previous hour, which skips Rule 2
+        previous = random_readings(rng, stations) if trial % 4 else {}
+        yield trial, stations, readings, previous
+
+
+@mock.patch.object(services, "city_thresholds",
+                   return_value=(services.DEFAULT_THRESHOLDS, services.CITY_ELEVATED_THRESHOLD))
+class EngineEquivalenceTests(SimpleTestCase):
+    """engine.evaluate_arrays (via services.evaluate) against the scalar rules."""
+
+    def test_matches_scalar_rules(self, _thresholds):
+        for trial, stations, readings, previous in random_cases():
+            with self.subTest(trial=trial):
+                self.assertEqual(
+                    services.evaluate(stations, readings, previous_readings=previous),
+                    scalar_evaluate(stations, readings, previous_readings=previous),
+                )
+
+    def test_every_rule_is_exercised(self, _thresholds):
+        # Guard against the random data drifting away from the thresholds
+        rules = set()
+        for _, stations, readings, previous in random_cases():
+            for alert in scalar_evaluate(stations, readings, previous)["city_alerts"].values():
+                rules.add(alert["rule"])
+        self.assertEqual(rules, {None, "rule1", "rule2", "rule3"})
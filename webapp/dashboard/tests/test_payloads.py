@@ -0,0 +1,82 @@
+import gzip
+import json
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import TestCase
+
+from dashboard import payloads
+from dashboard.models import APIKey, CachedResult
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+RESULTS = [
+    {"id": "60106", "station": "Downtown", "target_city": "Toronto", "lat": 43.66, "lon": -79.38,
+     "pm25": 45.24, "predicted": 52.06, "level_name": "MODERATE", "health": "Sensitive groups take care."},
+    {"id": "60107", "station": "Lakeshore", "target_city": "Toronto", "lat": 43.63, "lon": -79.42,
+     "pm25": 8.0, "predicted": 9.1, "level_name": "LOW", "health": ""},
+]
+CITY_ALERTS = {"Toronto": {"alert": True, "level_name": "MODERATE", "rule": "rule1"}}
+
+
+def decode(response):
+    body = response.content
+    encoding = response.get("Content-Encoding", "identity")
+    if encoding == "gzip":
+        body = gzip.decompress(body)
+    elif encoding == "br":
+        body = brotli.decompress(body)
+    return json.loads(body)
+
+
+class PayloadRoundTripTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.cached = CachedResult.objects.create(results=RESULTS, city_alerts=CITY_ALERTS, version=3)
+        self.ts = self.cached.timestamp.timestamp()
+        user = User.objects.create_user("api", password="x")
+        self.auth = {"HTTP_AUTHORIZATION": f"Bearer {APIKey.objects.create(user=user, key='k' * 40).key}"}
+
+    def get(self, path, encoding, age, **headers):
+        with mock.patch.object(payloads.time, "time", return_value=self.ts + age):
+            return self.client.get(path, HTTP_ACCEPT_ENCODING=encoding, **headers)
+
+    def encodings(self):
+        return ["identity", "gzip"] + (["br"] if brotli is not None else [])
+
+    def test_live_body_matches_the_stored_result(self):
+        for encoding in self.encodings():
+            with self.subTest(encoding=encoding):
+                response = self.get("/api/live/", encoding, age=95)
+                self.assertEqual(response.get("Content-Encoding", "identity"), encoding)
+                self.assertEqual(response["X-Data-Age"], "95")
+                self.assertEqual(decode(response), {
+                    "results": RESULTS,
+                    "city_alerts": CITY_ALERTS,
+                    "timestamp": self.cached.timestamp.isoformat(),
+                    "age_seconds": 90,
+                })
+
+    def test_v1_live_body_matches_the_stored_result(self):
+        for encoding in self.encodings():
+            with self.subTest(encoding=encoding):
+                data = decode(self.get("/api/v1/live/", encoding, age=31, **self.auth))
+                self.assertEqual(data["count"], 2)
+                self.assertEqual(data["version"], 3)
+                self.assertEqual(data["age_seconds"], 30)
+                self.assertEqual(data["stations"][0], {
+                    "id": "60106", "name": "Downtown", "city": "Toronto", "lat": 43.66, "lon": -79.38,
+                    "pm25": 45.2, "predicted": 52.1, "level": 2, "level_name": "MODERATE",
+                    "health_advisory": "Sensitive groups take care.",
+                })
+
+    def test_etag_changes_with_the_age_bucket(self):
+        etag = self.get("/api/live/", "gzip", age=10)["ETag"]
+        self.assertEqual(self.get("/api/live/", "gzip", age=25, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        response = self.get("/api/live/", "gzip", age=35, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(decode(response)["age_seconds"], 30)
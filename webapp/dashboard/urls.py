@@ -9,6 +9,7 @@ urlpatterns = [
     path("api/stations/", views.api_stations),
     path("api/demo/", views.api_demo),
     path("api/live/", views.api_live),
+    path("api/live/stream/", views.api_live_stream),
     path("api/refresh/", views.api_refresh),
     path("api/auth-status/", views.api_auth_status),
     path("accounts/logout/", views.logout_view, name="logout"),
@@ -10,6 +10,7 @@ from .core import (
     api_stations,
     api_demo,
     api_live,
+    api_live_stream,
     api_refresh,
     api_auth_status,
     logout_view,
@@ -60,6 +61,7 @@ __all__ = [
     "api_stations",
     "api_demo",
     "api_live",
+    "api_live_stream",
     "api_refresh",
     "api_auth_status",
     "logout_view",
@@ -4,28 +4,22 @@ Public API v1 endpoints for CLEAR25.
 
 from functools import wraps
 
+from django.db import transaction
 from django.http import JsonResponse
 from django.shortcuts import render
-from django.utils import timezone
 from django.views.decorators.csrf import csrf_exempt
-from django.views.decorators.http import require_http_methods
+from django.views.decorators.http import condition, require_http_methods
 
-from .. import services
-from ..models import APIKey, CachedResult, DeviceToken
-
-
-# Level name to integer mapping (matches Toronto PM2.5 Methodology v3.0)
-LEVEL_MAP = {
-    "LOW": 1,
-    "MODERATE": 2,
-    "HIGH": 3,
-    "VERY HIGH": 4,
-    "EXTREME": 5,
-}
+from .. import apikeys, payloads, services
+from ..models import APIKey, DeviceSubscription, DeviceToken
 
 
 def require_api_key(view_func):
-    """Decorator to require valid API key in Authorization header."""
+    """Decorator to require valid API key in Authorization header.
+
+    Lookups and request counts come from the shared cache, or from the
+    database when there is none (see apikeys.py).
+    """
     @wraps(view_func)
     def wrapper(request, *args, **kwargs):
         auth_header = request.headers.get("Authorization", "")
@@ -36,13 +30,12 @@ def require_api_key(view_func):
             }, status=401)
 
         key = auth_header[7:]  # Strip "Bearer "
-        try:
-            api_key = APIKey.objects.get(key=key, is_active=True)
-        except APIKey.DoesNotExist:
+        key_id = apikeys.lookup(key)
+        if key_id is None:
             return JsonResponse({"error": "Invalid API key"}, status=401)
 
         # Check rate limit
-        allowed, remaining, reset = api_key.check_rate_limit()
+        allowed, remaining, reset = apikeys.hit(key_id)
         if not allowed:
             response = JsonResponse({
                 "error": "Rate limit exceeded",
@@ -53,7 +46,7 @@ def require_api_key(view_func):
             response["X-RateLimit-Reset"] = str(reset)
             return response
 
-        request.api_key = api_key
+        request.api_key_id = key_id
         response = view_func(request, *args, **kwargs)
 
         # Add rate limit headers to successful responses
@@ -64,52 +57,46 @@ def require_api_key(view_func):
     return wrapper
 
 
-def _format_station_for_api(station_result):
-    """Format a station result for API response with integer level."""
-    level_name = station_result.get("level_name", "NONE")
-    return {
-        "id": station_result.get("id"),
-        "name": station_result.get("station"),
-        "city": station_result.get("target_city"),
-        "lat": station_result.get("lat"),
-        "lon": station_result.get("lon"),
-        "pm25": round(station_result.get("pm25", 0), 1),
-        "predicted": round(station_result.get("predicted", 0), 1),
-        "level": LEVEL_MAP.get(level_name, 0),
-        "level_name": level_name,
-        "health_advisory": station_result.get("health", ""),
-    }
-
-
 @require_http_methods(["GET"])
 @require_api_key
 def api_v1_live(request):
-    """Get current PM2.5 readings and predictions for all stations."""
-    try:
-        cached = CachedResult.objects.get(key="latest")
-        results = cached.results or []
-        timestamp = cached.timestamp.isoformat()
-        age_seconds = int((timezone.now() - cached.timestamp).total_seconds())
-    except CachedResult.DoesNotExist:
-        results = []
-        timestamp = None
-        age_seconds = None
-
-    # Format stations for API
-    stations = [_format_station_for_api(r) for r in results]
+    """Get current PM2.5 readings and predictions for all stations.
+
+    Served from the payload built at refresh time (encoded once per
+    age_seconds bucket), with ETag/Last-Modified so unchanged data comes
+    back as 304.
+
+    With ?since=<version or timestamp> of an earlier response, returns
+    only the stations that changed since then plus city alert transitions
+    (X-Delta: changes). If that refresh is no longer kept, the full
+    payload is returned instead (X-Delta: full).
+    """
+    since = request.GET.get("since")
+    if since:
+        payload = payloads.get_delta(since)
+        if payload is not None:
+            response = payloads.respond(request, payload, payload["name"])
+            response["X-Delta"] = "changes"
+            return response
+    response = _v1_live_full(request)
+    if since:
+        response["X-Delta"] = "full"
+    return response
 
-    return JsonResponse({
-        "stations": stations,
-        "count": len(stations),
-        "timestamp": timestamp,
-        "age_seconds": age_seconds,
-    })
+
+@condition(**payloads.conditional("v1_live"))
+def _v1_live_full(request):
+    payload = payloads.get("v1_live")
+    if payload is None:
+        return JsonResponse({"stations": [], "count": 0, "timestamp": None, "age_seconds": None})
+    return payloads.respond(request, payload, "v1_live")
 
 
 @require_http_methods(["GET"])
 @require_api_key
+@condition(**payloads.stations_conditional())
 def api_v1_stations(request):
-    """Get list of all monitoring stations."""
+    """Get list of all monitoring stations. Supports conditional GET."""
     city_filter = request.GET.get("city")
 
     if city_filter and city_filter not in services.CITIES:
@@ -183,25 +170,23 @@ def api_create_key(request):
 
     # GET: List user's API keys with rate limit info
     if request.method == "GET":
-        api_keys = request.user.api_keys.filter(is_active=True)
+        api_keys = list(request.user.api_keys.filter(is_active=True))
+        # Live counts for the current clock hour (and last use)
+        usage = apikeys.usage_many([ak.id for ak in api_keys])
         keys = []
         for ak in api_keys:
             # Calculate remaining requests
-            now = timezone.now()
-            has_active_window = ak.hour_started and (now - ak.hour_started).total_seconds() < 3600
-            if has_active_window:
-                requests_used = ak.requests_this_hour
-                reset_seconds = int(3600 - (now - ak.hour_started).total_seconds())
-            else:
-                requests_used = 0
-                reset_seconds = 0  # No active window
+            used, last_used = usage[ak.id]
+            requests_used = min(used, APIKey.RATE_LIMIT)
+            has_active_window = requests_used > 0
+            reset_seconds = apikeys.reset_seconds() if has_active_window else 0  # No active window
             remaining = max(0, APIKey.RATE_LIMIT - requests_used)
 
             keys.append({
                 "key": ak.key,
                 "name": ak.name,
                 "created_at": ak.created_at.isoformat() if ak.created_at else None,
-                "last_used": ak.last_used.isoformat() if ak.last_used else None,
+                "last_used": last_used.isoformat() if last_used else None,
                 "rate_limit": APIKey.RATE_LIMIT,
                 "requests_used": requests_used,
                 "requests_remaining": remaining,
@@ -248,7 +233,7 @@ def api_revoke_key(request):
     try:
         api_key = APIKey.objects.get(key=key, user=request.user)
         api_key.is_active = False
-        api_key.save()
+        api_key.save()  # Also drops the cached lookup (models.invalidate_api_key)
         return JsonResponse({"ok": True})
     except APIKey.DoesNotExist:
         return JsonResponse({"error": "API key not found"}, status=404)
@@ -284,16 +269,20 @@ def api_register_device(request):
                 "valid_cities": list(valid_cities)
             }, status=400)
 
-    # Create or update device token
-    device, created = DeviceToken.objects.update_or_create(
-        token=token,
-        defaults={
-            "platform": platform,
-            "cities": cities,
-            "is_active": True,
-            "user": request.user if request.user.is_authenticated else None,
-        }
-    )
+    cities = list(dict.fromkeys(cities))
+
+    # Create or update device token and its indexed subscriptions
+    with transaction.atomic():
+        device, created = DeviceToken.objects.update_or_create(
+            token=token,
+            defaults={
+                "platform": platform,
+                "cities": cities,
+                "is_active": True,
+                "user": request.user if request.user.is_authenticated else None,
+            }
+        )
+        DeviceSubscription.sync(device, cities)
 
     return JsonResponse({
         "ok": True,
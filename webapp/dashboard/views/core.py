@@ -2,19 +2,17 @@
 Core views: index, stations, demo, live data, refresh, authentication.
 """
 
-import datetime
 import os
 
 from django.contrib import auth
-from django.core.cache import cache
-from django.http import JsonResponse
+from django.core.handlers.asgi import ASGIRequest
+from django.http import HttpResponse, HttpResponseNotAllowed, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render, redirect
-from django.utils import timezone
 from django.views.decorators.cache import cache_page
-from django.views.decorators.http import require_http_methods
+from django.views.decorators.http import condition, require_http_methods
 
-from .. import services
-from ..models import ReadingSnapshot, CachedResult
+from .. import apikeys, payloads, refresh, services, stream
+from ..models import RefreshJob
 
 
 def index(request):
@@ -23,10 +21,11 @@ def index(request):
     return render(request, "dashboard/index.html", {"cities": cities})
 
 
+@condition(**payloads.stations_conditional())
 @cache_page(60 * 5)  # Cache for 5 minutes
 @require_http_methods(["GET"])
 def api_stations(request, city=None):
-    """Get station data. Cached for 5 minutes."""
+    """Get station data. Cached for 5 minutes; supports conditional GET."""
     if city and city not in services.CITIES:
         return JsonResponse({"error": "Invalid city"}, status=400)
 
@@ -60,36 +59,53 @@ def api_demo(request, city=None):
 
 
 @require_http_methods(["GET"])
+@condition(**payloads.conditional("live"))
 def api_live(request):
-    """Return the latest cached results from the server-side refresh.
+    """Return the latest results from the server-side refresh.
 
-    Public endpoint with short-term caching to reduce DB hits.
+    Public endpoint. The body is rendered at refresh time and encoded once
+    per age bucket (see payloads.py); the exact data age is in the
+    X-Data-Age header. Clients that send If-None-Match get 304 until the
+    next refresh or age bucket.
     """
-    cache_key = "api_live_response"
-    cached_response = cache.get(cache_key)
+    payload = payloads.get("live")
+    if payload is None:
+        return JsonResponse({"results": None, "city_alerts": {}, "timestamp": None})
+    return payloads.respond(request, payload, "live")
 
-    if cached_response:
-        return JsonResponse(cached_response)
 
-    try:
-        cached = CachedResult.objects.get(key="latest")
-        age_seconds = (timezone.now() - cached.timestamp).total_seconds()
-        response_data = {
-            "results": cached.results,
-            "city_alerts": cached.city_alerts,
-            "timestamp": cached.timestamp.isoformat(),
-            "age_seconds": int(age_seconds),
-        }
-        cache.set(cache_key, response_data, 30)
-        return JsonResponse(response_data)
-    except CachedResult.DoesNotExist:
-        return JsonResponse({"results": None, "city_alerts": {}, "timestamp": None})
+async def api_live_stream(request):
+    """Server-Sent Events stream of live updates (see stream.py).
+
+    Sends a "snapshot" event with the full /api/live/ body, then an
+    "update" event with city alerts and changed stations after each
+    refresh. Reconnecting clients resume from Last-Event-ID.
+
+    Only served under ASGI: a WSGI handler buffers the whole stream
+    before sending it. There the view returns 204, which tells
+    EventSource not to reconnect, and the page keeps its one-shot fetch.
+    """
+    # Method check inline: require_http_methods only wraps async views on Django 5+
+    if request.method != "GET":
+        return HttpResponseNotAllowed(["GET"])
+    if not isinstance(request, ASGIRequest):
+        return HttpResponse(status=204)
+
+    last_event_id = request.headers.get("Last-Event-ID", "")
+    last_event_id = int(last_event_id) if last_event_id.isdigit() else None
+
+    response = StreamingHttpResponse(
+        stream.event_stream(last_event_id), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"  # Disable proxy buffering (nginx)
+    return response
 
 
 def api_refresh(request):
     """Cron endpoint: fetch WAQI data, evaluate, store in DB.
 
-    Protected by CRON_SECRET environment variable.
+    Protected by CRON_SECRET environment variable. If REFRESH_USE_WORKER
+    is set, queues a RefreshJob for the worker and returns 202 instead.
     """
     cron_secret = os.environ.get("CRON_SECRET", "")
     auth_header = request.headers.get("Authorization", "")
@@ -101,49 +117,16 @@ def api_refresh(request):
     if not api_key:
         return JsonResponse({"error": "No WAQI API token configured"}, status=400)
 
-    try:
-        stations = services.load_all_stations()
-        readings = services.fetch_latest_pm25(api_key, stations)
-
-        # Load previous readings for Rule 2 (dual-station sustained check)
-        now = timezone.now()
-        previous_readings = {}
-        for city_key in services.CITIES:
-            try:
-                snap = ReadingSnapshot.objects.get(city=city_key)
-                age = now - snap.timestamp
-                if datetime.timedelta(minutes=20) <= age <= datetime.timedelta(hours=3):
-                    previous_readings.update(snap.readings)
-            except ReadingSnapshot.DoesNotExist:
-                pass
-
-        result = services.evaluate(stations, readings, previous_readings=previous_readings)
-
-        # Save current readings as snapshots for next refresh
-        city_readings = {}
-        for st in stations:
-            sid = st["id"]
-            if sid in readings:
-                tc = st.get("target_city", "")
-                city_readings.setdefault(tc, {})[sid] = readings[sid]
-        for city_key, cr in city_readings.items():
-            ReadingSnapshot.objects.update_or_create(city=city_key, defaults={"readings": cr})
-
-        # Store evaluated results in CachedResult
-        CachedResult.objects.update_or_create(
-            key="latest",
-            defaults={
-                "results": result["stations"],
-                "city_alerts": result["city_alerts"],
-                "readings": readings,
-            },
-        )
+    # Write cached API key usage back to the database (see apikeys.py)
+    apikeys.flush()
 
-        return JsonResponse({
-            "ok": True,
-            "stations_fetched": len(readings),
-            "stations_evaluated": len(result["stations"]),
-        })
+    # With a worker process (manage.py run_refresh_worker), only enqueue
+    if refresh.use_worker():
+        job, created = RefreshJob.enqueue("cron")
+        return JsonResponse({"ok": True, "queued": True, "job": job.id, "created": created}, status=202)
+
+    try:
+        return JsonResponse(refresh.run_refresh(config))
     except Exception as e:
         import traceback
         return JsonResponse({"error": str(e), "trace": traceback.format_exc()}, status=500)
@@ -0,0 +1,15 @@
+import os
+import sys
+
+# Ensure the webapp directory is on the Python path
+webapp_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if webapp_dir not in sys.path:
+    sys.path.insert(0, webapp_dir)
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "ews.settings")
+
+# ASGI entry point (e.g. `uvicorn ews.asgi:application`). Needed for the
+# SSE stream at /api/live/stream/, which answers 204 under WSGI;
+# everything else also works under WSGI.
+from django.core.asgi import get_asgi_application
+application = get_asgi_application()
@@ -42,10 +42,10 @@ MIDDLEWARE = [
     "django.middleware.csrf.CsrfViewMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
     "allauth.account.middleware.AccountMiddleware",
+    "dashboard.middleware.RateLimitMiddleware",
     # Custom middleware (uncomment after testing):
     # "dashboard.middleware.RequestSizeLimitMiddleware",
     # "dashboard.middleware.SecurityHeadersMiddleware",
-    # "dashboard.middleware.RateLimitMiddleware",
 ]
 
 ROOT_URLCONF = "ews.urls"
@@ -65,6 +65,7 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = "ews.wsgi.application"
+ASGI_APPLICATION = "ews.asgi.application"
 
 # Database — Supabase PostgreSQL via DATABASE_URL, fallback to SQLite for local dev
 DATABASE_URL = os.environ.get("DATABASE_URL", "")
@@ -185,7 +186,8 @@ else:
             "LOCATION": "ews-cache",
             "TIMEOUT": 300,
             "OPTIONS": {
-                "MAX_ENTRIES": 1000,
+                # Room for per-client rate limit counters next to the payloads
+                "MAX_ENTRIES": 10000,
             },
         }
     }
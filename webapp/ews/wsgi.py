@@ -26,11 +26,17 @@ def _ensure_migrated():
     except Exception:
         needs_migrate = True
     try:
-        from dashboard.models import ReadingSnapshot, CachedResult, Suggestion, APIKey, DeviceToken
+        from dashboard.models import ReadingSnapshot, CachedResult, CityAlertState, PushOutbox, RefreshJob, ResultRevision, Suggestion, APIKey, DeviceToken, DeviceSubscription, StationMapping
         ReadingSnapshot.objects.count()
-        CachedResult.objects.count()
+        StationMapping.objects.count()
+        ResultRevision.objects.count()
+        CityAlertState.objects.count()
+        CachedResult.objects.values_list("version").first()  # Check version column exists
         Suggestion.objects.count()
         DeviceToken.objects.count()  # Check push notification table
+        DeviceSubscription.objects.count()
+        PushOutbox.objects.count()
+        RefreshJob.objects.count()
         # Check APIKey exists and has rate limit fields
         ak = APIKey.objects.first()
         if ak: